@@ -0,0 +1,307 @@
+"""
+離線端對端基準測試：以本機假服務取代 Google Drive、Vision、Gemini 與 n8n，
+量測 docs/sec、各階段 p50/p95/p99、每份文件的 LLM 呼叫次數與提示位元組數，以及峰值 RSS。
+
+    python -m benchmarks.run_benchmark --docs 200 --catalog-rows 10000,100000,1000000 --fake-redis --output bench.jsonl
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, redirect_stdout
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.synthetic import make_documents, write_catalog
+from utils.fakes import FakeDriveServer, FakeGenerativeModel, FakeVisionClient, FakeWebhookReceiver
+
+CATALOG_FILE = '客戶訂單資料.csv'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='OCR 流水線離線基準測試')
+    parser.add_argument('--path', choices=('process', 'celery'), default='process',
+                        help='process：直接呼叫 OrderProcessor.process；celery：POST /upload，由進程內的 Celery worker（記憶體 broker）執行 chain')
+    parser.add_argument('--docs', type=int, default=100, help='文件數')
+    parser.add_argument('--concurrency', type=int, default=4, help='同時處理（或提交）的文件數（執行緒）')
+    parser.add_argument('--worker-concurrency', type=int, help='celery 路徑的 worker 執行緒數（預設同 --concurrency）')
+    parser.add_argument('--doc-timeout', type=float, default=300, help='celery 路徑等待單份文件完成的秒數上限')
+    parser.add_argument('--catalog-rows', default='10000', help='品名清單筆數，逗號分隔時每個大小各跑一次（各自獨立進程）')
+    parser.add_argument('--lines', type=int, default=12, help='每份文件的品項行數')
+    parser.add_argument('--image-size', default='1240x1754', help='合成圖片尺寸 寬x高')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--drive-latency', type=float, default=0.05)
+    parser.add_argument('--drive-error-rate', type=float, default=0.0)
+    parser.add_argument('--vision-latency', type=float, default=0.3)
+    parser.add_argument('--vision-error-rate', type=float, default=0.0)
+    parser.add_argument('--gemini-latency', type=float, default=0.8)
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0)
+    parser.add_argument('--webhook-latency', type=float, default=0.02)
+    parser.add_argument('--webhook-error-rate', type=float, default=0.0)
+    parser.add_argument('--fake-redis', action='store_true', help='以 fakeredis 取代 REDIS_URL（需另行安裝 fakeredis）')
+    parser.add_argument('--workdir', help='放置合成品名清單與 uploads 的目錄（預設為暫存目錄，結束後刪除）')
+    parser.add_argument('--output', help='把結果以 JSON 逐行附加到此檔案，方便追蹤歷次結果')
+    parser.add_argument('--verbose', action='store_true', help='顯示流水線本身的輸出')
+    return parser.parse_args(argv)
+
+
+def percentiles(values):
+    """p50/p95/p99（nearest-rank），單位毫秒"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+    return {
+        'count': len(ordered),
+        'p50_ms': round(pick(0.50) * 1000, 1),
+        'p95_ms': round(pick(0.95) * 1000, 1),
+        'p99_ms': round(pick(0.99) * 1000, 1)
+    }
+
+
+def peak_rss_mb():
+    # Linux 的 ru_maxrss 單位為 KB，macOS 為 bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def use_fake_redis():
+    """所有 Redis 客戶端改連同一個 fakeredis 伺服器"""
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit('--fake-redis 需要先安裝 fakeredis（pip install fakeredis）')
+    import redis
+    server = fakeredis.FakeServer()
+    redis.BlockingConnectionPool.from_url = classmethod(lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server).connection_pool)
+
+
+def install_fakes(vision_client, gemini_model):
+    """以假客戶端取代 vision.ImageAnnotatorClient 與 genai.GenerativeModel"""
+    from google.cloud import vision
+    import google.generativeai as genai
+    vision.ImageAnnotatorClient = lambda *args, **kwargs: vision_client
+    genai.GenerativeModel = lambda *args, **kwargs: gemini_model
+
+
+class StageRecorder:
+    """收集每段 span 的耗時"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+
+    def __call__(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+
+def run(args, rows):
+    width, height = (int(value) for value in args.image_size.lower().split('x'))
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ocr-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    catalog_path = os.path.join(workdir, CATALOG_FILE)
+    start = time.perf_counter()
+    write_catalog(catalog_path, rows)
+    catalog_write_s = time.perf_counter() - start
+
+    print(f"產生 {args.docs} 份合成文件（{args.lines} 行，{width}x{height}）...")
+    documents = make_documents(args.docs, rows, args.lines, (width, height), args.seed)
+    texts = {hashlib.sha256(image).hexdigest(): text for image, text in documents}
+    ordered_texts = [text for _, text in documents]
+
+    def text_for(content):
+        # 開啟預處理時圖片內容會改變，改以內容雜湊挑一份文字
+        digest = hashlib.sha256(content).hexdigest()
+        return texts.get(digest) or ordered_texts[int(digest[:8], 16) % len(ordered_texts)]
+
+    vision_client = FakeVisionClient(texts=text_for, latency=args.vision_latency, error_rate=args.vision_error_rate, seed=args.seed)
+    gemini_model = FakeGenerativeModel(latency=args.gemini_latency, error_rate=args.gemini_error_rate, seed=args.seed)
+    drive = FakeDriveServer(latency=args.drive_latency, error_rate=args.drive_error_rate, seed=args.seed).start()
+    webhooks = FakeWebhookReceiver(latency=args.webhook_latency, error_rate=args.webhook_error_rate, seed=args.seed).start()
+    run_id = uuid.uuid4().hex[:8]
+    urls = [drive.add_file(f"bench{run_id}{index:06d}", image) for index, (image, _) in enumerate(documents)]
+    del documents
+
+    os.environ['GOOGLE_DRIVE_DOWNLOAD_URL'] = drive.download_url
+    os.environ.setdefault('GEMINI_API_KEY', 'offline-benchmark')
+    if args.fake_redis:
+        use_fake_redis()
+    install_fakes(vision_client, gemini_model)
+
+    from utils import metrics
+    recorder = StageRecorder()
+    metrics.add_observer(recorder)
+
+    log = sys.stdout if args.verbose else open(os.devnull, 'w')
+    previous_cwd = os.getcwd()
+    # 在工作目錄中執行，celery_tasks 的 "./客戶訂單資料.csv" 與 uploads 都會指向合成資料
+    os.chdir(workdir)
+    try:
+        with redirect_stdout(log), ExitStack() as stack:
+            start = time.perf_counter()
+            if args.path == 'process':
+                from utils.order_processor import OrderProcessor
+                processor = OrderProcessor(order_csv_path=catalog_path, upload_folder=os.path.join(workdir, 'uploads'))
+            else:
+                import celery_tasks
+                from celery.contrib.testing.worker import start_worker
+                celery_tasks.celery_app.conf.update(
+                    broker_url='memory://',
+                    result_backend='cache+memory://',
+                    # 記憶體 broker 預設每秒才輪詢一次佇列，會蓋過實際的處理時間
+                    broker_transport_options={'polling_interval': 0.005},
+                    # prefetch 為 1 時，記憶體 broker 的 worker 要等下一輪 drain（約 2 秒）才取下一個任務
+                    worker_prefetch_multiplier=4,
+                    worker_redirect_stdouts=False,
+                    worker_hijack_root_logger=False
+                )
+                processor = celery_tasks.processor
+                client = importlib.import_module('n8n-ocr-flow').app.test_client()
+            catalog_load_s = time.perf_counter() - start
+            rss_after_load = peak_rss_mb()
+            if args.path == 'celery':
+                # 一個 worker 以執行緒池消費所有階段的佇列，任務仍經過 broker 與 task_routes
+                stack.enter_context(start_worker(
+                    celery_tasks.celery_app,
+                    pool='threads',
+                    concurrency=args.worker_concurrency or args.concurrency,
+                    queues=list(metrics.QUEUES),
+                    perform_ping_check=False,
+                    loglevel='ERROR'
+                ))
+
+            def handle(index):
+                webhook_url = f"{webhooks.url}/webhook-waiting/{run_id}-{index}"
+                started = time.perf_counter()
+                try:
+                    if args.path == 'process':
+                        processor.process(str(uuid.uuid4()), urls[index], f"order-{index}.jpg", 'image/jpeg', webhook_url)
+                        ok = True
+                    else:
+                        response = client.post('/upload', json={
+                            'google_drive_url': urls[index],
+                            'fileName': f"order-{index}.jpg",
+                            'mimeType': 'image/jpeg',
+                            'webhookUrl': webhook_url
+                        })
+                        task_id = (response.get_json() or {}).get('task_id')
+                        progress = None
+                        if response.status_code == 202 and task_id:
+                            for snapshot in processor.progress.listen(task_id, timeout=args.doc_timeout, heartbeat=args.doc_timeout):
+                                progress = snapshot or progress
+                        ok = bool(progress) and progress['state'] == 'SUCCESS'
+                except Exception:
+                    ok = False
+                return ok, time.perf_counter() - started
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+                outcomes = list(executor.map(handle, range(args.docs)))
+            wall_s = time.perf_counter() - start
+    finally:
+        os.chdir(previous_cwd)
+        metrics.remove_observer(recorder)
+        drive.stop()
+        webhooks.stop()
+        if log is not sys.stdout:
+            log.close()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    succeeded = sum(1 for ok, _ in outcomes if ok)
+    docs = max(1, args.docs)
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'path': args.path,
+        'catalog_rows': rows,
+        'docs': args.docs,
+        'concurrency': args.concurrency,
+        'lines_per_doc': args.lines,
+        'image_size': [width, height],
+        'injected': {
+            name: {'latency': getattr(args, f'{name}_latency'), 'error_rate': getattr(args, f'{name}_error_rate')}
+            for name in ('drive', 'vision', 'gemini', 'webhook')
+        },
+        'succeeded': succeeded,
+        'failed': args.docs - succeeded,
+        'wall_s': round(wall_s, 2),
+        'docs_per_sec': round(args.docs / wall_s, 2) if wall_s else None,
+        'latency': percentiles([elapsed for _, elapsed in outcomes]),
+        'stages': {stage: percentiles(samples) for stage, samples in sorted(recorder.samples.items())},
+        'llm_calls_per_doc': round(gemini_model.calls / docs, 3),
+        'llm_prompt_bytes_per_doc': round(gemini_model.prompt_bytes / docs, 1),
+        'vision_requests_per_doc': round(vision_client.calls / docs, 3),
+        'drive_requests': drive.requests,
+        'webhooks_received': len(webhooks.received),
+        'match_cache': processor.fuzzy_matcher.cache_stats(),
+        'catalog_write_s': round(catalog_write_s, 2),
+        'catalog_load_s': round(catalog_load_s, 2),
+        'rss_after_load_mb': rss_after_load,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def print_report(report):
+    print(f"\n== {report['path']} | 品名 {report['catalog_rows']:,} 筆 | {report['docs']} 份文件 | 並行 {report['concurrency']} ==")
+    print(f"成功 {report['succeeded']}，失敗 {report['failed']}，耗時 {report['wall_s']} 秒，{report['docs_per_sec']} docs/sec")
+    print(f"LLM 呼叫 {report['llm_calls_per_doc']} 次/份，提示 {report['llm_prompt_bytes_per_doc']} bytes/份，"
+          f"Vision 請求 {report['vision_requests_per_doc']} 次/份")
+    print(f"品名清單載入 {report['catalog_load_s']} 秒，載入後 RSS {report['rss_after_load_mb']} MB，峰值 RSS {report['peak_rss_mb']} MB")
+    print(f"{'階段':<14}{'次數':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = [('total', report['latency'])] + list(report['stages'].items())
+    for stage, stats in rows:
+        if stats:
+            print(f"{stage:<14}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.catalog_rows.split(',') if size.strip()]
+    if len(sizes) > 1:
+        # 每個大小在獨立進程執行，峰值 RSS 才不會互相影響
+        code = 0
+        for size in sizes:
+            child = list(argv)
+            if '--catalog-rows' in child:
+                position = child.index('--catalog-rows')
+                del child[position:position + 2]
+            child = [arg for arg in child if not arg.startswith('--catalog-rows=')]
+            result = subprocess.run([sys.executable, '-m', 'benchmarks.run_benchmark', *child, '--catalog-rows', str(size)], cwd=REPO_ROOT)
+            code = code or result.returncode
+        return code
+
+    report = run(args, sizes[0])
+    print_report(report)
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report, ensure_ascii=False) + '\n')
+    return 0 if report['succeeded'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
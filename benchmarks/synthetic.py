@@ -0,0 +1,79 @@
+import csv
+import io
+import random
+from PIL import Image, ImageDraw
+
+# 品名由「前綴 + 產地 + 品項 + 規格」組成，索引即可還原，不必把百萬筆品名留在記憶體
+BASES = (
+    '柳丁', '檸檬', '高麗菜', '青江菜', '小白菜', '菠菜', '空心菜', '地瓜葉', '花椰菜', '青花菜',
+    '紅蘿蔔', '白蘿蔔', '馬鈴薯', '洋蔥', '大蒜', '老薑', '青蔥', '香菜', '芹菜', '韭菜',
+    '玉米', '南瓜', '冬瓜', '絲瓜', '苦瓜', '小黃瓜', '茄子', '番茄', '青椒', '甜椒',
+    '香蕉', '鳳梨', '芭樂', '木瓜', '蘋果', '水梨', '葡萄', '西瓜', '哈密瓜', '奇異果',
+)
+PREFIXES = ('', '有機', '特級', '精選', '契作', '冷藏', '大', '小', '嫩', '新鮮')
+ORIGINS = ('', '台灣', '日本', '美國', '紐西蘭', '澳洲', '智利', '雲林', '嘉義', '屏東', '台東', '宜蘭')
+UNITS = ('斤', '包', '箱', 'KG', '台斤', '把', '顆')
+HEADER_LINES = ('訂購單', '日期：2024/05/01', '客戶：大明商行', '電話：02-2345-6789', '品名 數量')
+
+
+def catalog_name(index):
+    """第 index 筆品名（相同索引永遠得到相同品名）"""
+    base = BASES[index % len(BASES)]
+    index //= len(BASES)
+    prefix = PREFIXES[index % len(PREFIXES)]
+    index //= len(PREFIXES)
+    origin = ORIGINS[index % len(ORIGINS)]
+    index //= len(ORIGINS)
+    return f"{prefix}{origin}{base}({index + 1}入)"
+
+
+def write_catalog(path, rows):
+    """寫出與正式品名清單相同格式（Big5 CSV：品號,品名,單位,幣別）的合成清單"""
+    with open(path, 'w', encoding='big5', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['品號', '品名', '單位', '幣別'])
+        for index in range(rows):
+            writer.writerow([f"B{index:07d}", catalog_name(index), 'KG', 'NTD'])
+
+
+def order_line(rng, rows):
+    """一行訂購品項：品名可能省略規格、前綴或打錯一字，模擬手寫與 OCR 的誤差"""
+    index = rng.randrange(rows)
+    name = catalog_name(index)
+    roll = rng.random()
+    if roll < 0.3:
+        name = name.split('(')[0]
+    elif roll < 0.45:
+        name = BASES[index % len(BASES)]
+    elif roll < 0.55:
+        position = rng.randrange(len(name.split('(')[0]))
+        name = name[:position] + rng.choice('的一大小') + name[position + 1:]
+    return f"{name} {rng.randint(1, 20)}{rng.choice(UNITS)}"
+
+
+def order_text(rng, rows, lines):
+    """一份合成訂購單的 OCR 文字：表頭、品項與合計"""
+    items = [order_line(rng, rows) for _ in range(lines)]
+    return '\n'.join(list(HEADER_LINES) + items + [f"合計 {rng.randint(100, 99999)}"])
+
+
+def order_image(rng, width, height, quality=85):
+    """一張內容各不相同的 JPEG（只用來產生真實大小的下載與解碼負載）"""
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle(
+            [x, y, x + rng.randint(20, width // 3), y + rng.randint(4, 30)],
+            fill=tuple(rng.randrange(256) for _ in range(3))
+        )
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def make_documents(count, rows, lines, size, seed):
+    """回傳 [(圖片位元組, OCR 文字), ...]"""
+    rng = random.Random(seed)
+    width, height = size
+    return [(order_image(rng, width, height), order_text(rng, rows, lines)) for _ in range(count)]
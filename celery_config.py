@@ -24,4 +24,16 @@ celery_app.conf.update(
     task_soft_time_limit=600,  # 10分鐘軟超時
     worker_prefetch_multiplier=1,
     result_expires=3600,  # 結果保存1小時
+    # 所有執行緒/greenlet 共用同一個結果後端與其連線池，而不是每個請求各建一個
+    result_backend_thread_safe=True,
+    redis_max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', '50')),
+    # 各階段在獨立佇列執行，每個佇列的 worker 數量可分別調整
+    task_routes={
+        'ocr_service.stage_download': {'queue': 'download'},
+        'ocr_service.stage_ocr': {'queue': 'ocr'},
+        'ocr_service.stage_match': {'queue': 'match'},
+        'ocr_service.stage_deliver': {'queue': 'deliver'},
+        'ocr_service.redeliver_result': {'queue': 'deliver'},
+        'ocr_service.deliver_webhook': {'queue': 'deliver'},
+    },
 )
\ No newline at end of file
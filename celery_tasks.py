@@ -1,30 +1,142 @@
+from celery import chain, group
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown
 from celery_config import celery_app
 from utils.order_processor import OrderProcessor
+from utils.dedup_store import DedupStore
+from utils.progress_store import ProgressStore
+from utils.batch_store import BatchStore
+from utils.result_store import ResultStore
+from utils.alias_store import AliasStore
+from utils.result_processor import ResultProcessor
+from utils.webhook_delivery import WebhookDelivery
+from utils.resilience import UpstreamUnavailable
+from utils import metrics
+import base64
+import gc
+import os
+import random
+import threading
+import traceback
+import uuid
 
-# 全局實例
-processor = OrderProcessor(
-    order_csv_path="./客戶訂單資料.csv",
-    upload_folder="uploads",
-    max_file_size=20*1024*1024
-)
+# 全局實例（輕量，API 進程與 worker 共用）
+dedup_store = DedupStore()
+progress_store = ProgressStore()
+batch_store = BatchStore()
+result_store = ResultStore()
+alias_store = AliasStore()
+webhook_delivery = WebhookDelivery()
+result_processor = ResultProcessor(delivery=webhook_delivery)
 
-@celery_app.task(bind=True, name='ocr_service.process_image')
-def process_google_drive_image(self, google_drive_url, file_name=None, mime_type=None, webhook_url=None):
+# 完整的 OrderProcessor 需要載入品名清單與索引，只有 worker 需要，第一次使用時才建立
+_processor = None
+_processor_lock = threading.Lock()
+
+def get_processor():
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                _processor = OrderProcessor(
+                    order_csv_path="./客戶訂單資料.csv",
+                    upload_folder="uploads",
+                    max_file_size=20*1024*1024,
+                    result_processor=result_processor,
+                    batch_store=batch_store,
+                    result_store=result_store,
+                    alias_store=alias_store
+                )
+    return _processor
+
+def __getattr__(name):
+    # 相容舊的 celery_tasks.processor 用法
+    if name == 'processor':
+        return get_processor()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# chain：下載、OCR、匹配、回調分別在各自的佇列執行；single：單一任務跑完整流程
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'chain')
+
+# 上游（Gemini/Vision）熔斷或配額用盡時，任務重新排入佇列的次數上限
+UPSTREAM_TASK_RETRIES = int(os.getenv('UPSTREAM_TASK_RETRIES', '10'))
+
+# 不超過此大小的檔案以 base64 直接放在 chain 訊息中交給 OCR 階段，不寫入磁碟；
+# 更大的檔案才經共用的 uploads volume 傳遞，避免 broker 訊息過大
+CHAIN_INLINE_MAX_BYTES = int(os.getenv('CHAIN_INLINE_MAX_BYTES', str(2 * 1024 * 1024)))
+
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    """Worker 主進程匯出所有子進程彙總的指標（METRICS_PORT，預設 9100）"""
+    if os.getenv('METRICS_ENABLED', '1') != '1':
+        return
+    metrics.reset_multiproc_dir()
+    metrics.start_worker_exporter()
+
+@worker_init.connect
+def configure_vision_batching(sender=None, **kwargs):
+    """
+    只有執行緒/gevent 池會在同一進程同時跑多份文件，Vision 批次等待視窗才合併得到圖片；
+    prefork 子進程一次只跑一個任務，保持預設 0（不等待）。OCR_BATCH_LINGER_MS 已設定時不覆寫
+    """
+    pool = getattr(sender, 'pool_cls', '')
+    # worker_init 在解析池別名前送出，pool_cls 可能仍是字串（threads/gevent）或已是類別
+    pool_name = pool if isinstance(pool, str) else f"{getattr(pool, '__module__', '')}.{getattr(pool, '__name__', '')}"
+    if any(name in pool_name.lower() for name in ('thread', 'gevent', 'eventlet')):
+        os.environ.setdefault('OCR_BATCH_LINGER_MS', os.getenv('CONCURRENT_POOL_OCR_LINGER_MS', '20'))
+
+@worker_init.connect
+def preload_processor(**kwargs):
+    """
+    Worker 主進程在 fork 子進程前載入品名清單與索引，子進程以 copy-on-write 共用；
+    之後凍結這些物件，避免 GC 掃描時寫入物件標頭而複製記憶體頁
+    """
+    if os.getenv('WORKER_PRELOAD', '1') != '1':
+        return
+    get_processor()
+    gc.collect()
+    gc.freeze()
+
+@worker_process_init.connect
+def warm_up_processor(**kwargs):
+    """子進程各自建立 gRPC 客戶端，第一份文件不必再等連線建立"""
+    if os.getenv('WORKER_PRELOAD', '1') != '1':
+        return
+    try:
+        get_processor().warm_up()
+    except Exception as e:
+        print(f"預先建立上游客戶端失敗，第一次使用時再重試: {e}")
+
+@worker_process_shutdown.connect
+def mark_metrics_process_dead(pid=None, **kwargs):
+    metrics.mark_process_dead(pid or os.getpid())
+
+def _retry_countdown(error):
+    return error.retry_after + random.uniform(0, error.retry_after)
+
+@celery_app.task(bind=True, name='ocr_service.process_image', max_retries=UPSTREAM_TASK_RETRIES)
+def process_google_drive_image(self, google_drive_url, file_name=None, mime_type=None, webhook_url=None, batch_id=None, fresh=False):
     """異步處理Google Drive圖片OCR任務"""
     try:
         
         # 整個流程都交給OrderProcessor處理
-        result = processor.process(
+        result = get_processor().process(
             task_id=self.request.id,
             google_drive_url=google_drive_url,
             file_name=file_name,
             mime_type=mime_type,
-            webhook_url=webhook_url
+            webhook_url=webhook_url,
+            retryable=self.request.retries < self.max_retries,
+            batch_id=batch_id,
+            fresh=fresh
         )
         return result
         
+    except UpstreamUnavailable as e:
+        # 上游恢復前不佔用 worker，稍後以相同 task_id 重新執行
+        countdown = _retry_countdown(e)
+        print(f"{e}，{countdown:.0f} 秒後重試任務")
+        raise self.retry(exc=e, countdown=countdown)
     except Exception as e:
-        import traceback
         print(traceback.format_exc())
         # 更新任務狀態為失敗
         meta = {
@@ -37,4 +149,189 @@ def process_google_drive_image(self, google_drive_url, file_name=None, mime_type
             state='FAILURE',
             meta=meta
         )
-        raise Exception(f"OCR處理錯誤: {str(e)}")
\ No newline at end of file
+        raise Exception(f"OCR處理錯誤: {str(e)}")
+
+def _run_stage(task, job, stage):
+    """執行一個階段；上游不可用時重新排隊，其他錯誤回調失敗並中止 chain"""
+    try:
+        return stage()
+    except UpstreamUnavailable as e:
+        if task.request.retries < task.max_retries:
+            countdown = _retry_countdown(e)
+            print(f"{e}，{countdown:.0f} 秒後重試 {task.name}")
+            raise task.retry(exc=e, countdown=countdown)
+        get_processor().fail(job, e)
+    except Exception as e:
+        print(traceback.format_exc())
+        get_processor().fail(job, e)
+
+@celery_app.task(bind=True, name='ocr_service.stage_download', max_retries=UPSTREAM_TASK_RETRIES, ignore_result=True)
+def stage_download(self, job):
+    """下載階段：小檔案隨訊息傳給 OCR 階段，大檔案經共用的 uploads volume 傳遞，broker 只傳檔名"""
+    def run():
+        updated, download_info = get_processor().download_stage(job)
+        if updated.get('cached'):
+            return updated
+        data = download_info['image_data']
+        if len(data) <= CHAIN_INLINE_MAX_BYTES:
+            updated['inline'] = base64.b64encode(data).decode('ascii')
+        else:
+            updated['blob'] = get_processor().file_manager.put_blob(data)
+        return updated
+    return _run_stage(self, job, run)
+
+@celery_app.task(bind=True, name='ocr_service.stage_ocr', max_retries=UPSTREAM_TASK_RETRIES, ignore_result=True)
+def stage_ocr(self, job):
+    def run():
+        if job.get('cached'):
+            return get_processor().ocr_stage(job, None)
+        if 'inline' in job:
+            data = base64.b64decode(job['inline'])
+        else:
+            data = get_processor().file_manager.read_blob(job['blob'])
+        download_info = get_processor().downloader.describe(data, job['file_id'])
+        updated = get_processor().ocr_stage(job, download_info)
+        # 圖片內容不再往後傳；暫存檔在 OCR 成功後才刪除，重試時仍需要原圖
+        updated.pop('inline', None)
+        if 'blob' in updated:
+            get_processor().file_manager.delete_blob(updated.pop('blob'))
+        return updated
+    return _run_stage(self, job, run)
+
+@celery_app.task(bind=True, name='ocr_service.stage_match', max_retries=UPSTREAM_TASK_RETRIES, ignore_result=True)
+def stage_match(self, job):
+    def run():
+        result = get_processor().match_stage(job)
+        return {'job': job, 'result': result}
+    return _run_stage(self, job, run)
+
+@celery_app.task(bind=True, name='ocr_service.stage_deliver')
+def stage_deliver(self, matched):
+    """回調階段：此任務的 id 即為邏輯 task_id，其結果就是整份文件的結果"""
+    job = matched['job']
+    return _run_stage(self, job, lambda: get_processor().deliver_stage(job, matched['result']))
+
+def pipeline_signature(job):
+    """依 PIPELINE_MODE 建立處理一份文件的 signature，兩種模式都以 job 的 task_id 查詢狀態與結果"""
+    if PIPELINE_MODE == 'single':
+        kwargs = {key: job.get(key) for key in ('google_drive_url', 'file_name', 'mime_type', 'webhook_url', 'batch_id', 'fresh')}
+        return process_google_drive_image.signature(kwargs=kwargs, task_id=job['task_id'])
+    # 最後一個任務（回調階段）使用邏輯 task_id
+    return chain(
+        stage_download.s(job),
+        stage_ocr.s(),
+        stage_match.s(),
+        stage_deliver.s().set(task_id=job['task_id'])
+    )
+
+def submit_job(task_id, google_drive_url, file_name=None, mime_type=None, webhook_url=None, fresh=False):
+    """提交一份文件（fresh：不沿用相同內容先前的結果）"""
+    job = OrderProcessor.new_job(task_id, google_drive_url, file_name, mime_type, webhook_url, fresh=fresh)
+    progress_store.start_stage(task_id, 'download')
+    return pipeline_signature(job).apply_async()
+
+def submit_batch(batch_id, entries, webhook_url=None):
+    """
+    以 group 同時提交多份文件，entries 為 [{'task_id', 'google_drive_url', 'file_name', 'mime_type', 'webhook_url'}]。
+    各成員完成或失敗時記錄於批次紀錄，最後一個完成的成員送出彙總回調
+    （不使用 chord：任一成員失敗會讓 chord 的回呼無法執行）。
+    """
+    jobs = [
+        OrderProcessor.new_job(
+            entry['task_id'], entry['google_drive_url'], entry.get('file_name'),
+            entry.get('mime_type'), entry.get('webhook_url'), batch_id
+        )
+        for entry in entries
+    ]
+    batch_store.create(batch_id, [
+        {'task_id': job['task_id'], 'file_name': job['file_name'], 'google_drive_url': job['google_drive_url']}
+        for job in jobs
+    ], webhook_url)
+    for job in jobs:
+        # 之後以 /upload 重複提交同一個文件時可沿用批次中的任務
+        dedup_store.claim_file(job['file_id'], job['task_id'])
+        progress_store.start_stage(job['task_id'], 'download')
+    return group(pipeline_signature(job) for job in jobs).apply_async()
+
+def task_state(task_id):
+    """
+    回傳 (AsyncResult, 狀態)；chain 中途失敗時最後一個任務仍是 PENDING，需參考進度紀錄。
+    進度紀錄標記已寫入結果庫時回報 SUCCESS；提交時就會建立進度紀錄，
+    只有 Celery 結果與進度紀錄都已過期（result_expires）時才查詢結果庫
+    """
+    task = process_google_drive_image.AsyncResult(task_id)
+    state = task.state
+    if state in ('PENDING', 'STARTED', 'RETRY'):
+        progress = progress_store.get(task_id)
+        if progress:
+            if progress['state'] == 'FAILURE':
+                state = 'FAILURE'
+            elif progress['state'] == 'SUCCESS' and progress['stored']:
+                state = 'SUCCESS'
+        elif state == 'PENDING' and result_store.contains(task_id):
+            state = 'SUCCESS'
+    return task, state
+
+def load_result(task_id, task=None):
+    """讀取已完成任務的完整結果：優先讀結果庫，舊任務或寫入失敗時才是 Celery 後端中的完整結果"""
+    task = task or process_google_drive_image.AsyncResult(task_id)
+    stored = result_store.get(task_id)
+    if stored is None:
+        result = task.result if task.state == 'SUCCESS' else None
+        return None if ResultStore.is_pointer(result) else result
+    pointer = task.result if task.state == 'SUCCESS' else None
+    if ResultStore.is_pointer(pointer) and pointer.get('callback_status') is not None:
+        stored['callback_status'] = pointer['callback_status']
+    return stored
+
+def resubmit(task_id, webhook_url=None):
+    """以結果庫中保存的 Drive 連結重新處理一份文件（例如更新品名清單後），回傳新的 task_id；找不到紀錄時回傳 None"""
+    job = result_store.get_job(task_id)
+    if job is None or not job['google_drive_url']:
+        return None
+    new_task_id = str(uuid.uuid4())
+    # 取代 file_id 對應的任務，之後以 /upload 提交同一個文件時沿用新的結果
+    dedup_store.claim_file(job['file_id'], new_task_id, replace=True)
+    submit_job(new_task_id, job['google_drive_url'], job['file_name'], job['mime_type'],
+               webhook_url if webhook_url is not None else job['webhook_url'], fresh=True)
+    return new_task_id
+
+@celery_app.task(name='ocr_service.deliver_webhook')
+def deliver_webhook(delivery_id):
+    """送出一筆 webhook 投遞，失敗時依退避時間重新排入佇列"""
+    outcome = webhook_delivery.deliver(delivery_id)
+    if outcome['retry_in'] is not None:
+        deliver_webhook.apply_async(args=[delivery_id], countdown=outcome['retry_in'])
+    return outcome
+
+webhook_delivery.dispatch = lambda delivery_id, countdown=0: deliver_webhook.apply_async(args=[delivery_id], countdown=countdown)
+
+@celery_app.task(name='ocr_service.redeliver_result')
+def redeliver_result(task_id, webhook_url):
+    """把既有任務的結果回調給重複提交的 webhook"""
+    _, state = task_state(task_id)
+    if state != 'SUCCESS':
+        return None
+    result = load_result(task_id)
+    if result is None:
+        return None
+    return result_processor.send_webhook(webhook_url, result)
+
+def attach_duplicate(task_id, webhook_url):
+    """重複提交時沿用既有任務；回傳 False 表示既有任務已失敗，需要重新處理"""
+    _, state = task_state(task_id)
+    if state in ('FAILURE', 'REVOKED'):
+        return False
+    if not webhook_url:
+        return True
+    if state == 'SUCCESS':
+        redeliver_result.delay(task_id, webhook_url)
+        return True
+    
+    # 任務仍在處理中，完成時一併回調
+    dedup_store.add_waiting_webhook(task_id, webhook_url)
+    # 登記的同時任務可能剛好完成，補送尚未被取走的 webhook
+    if task_state(task_id)[1] == 'SUCCESS':
+        for waiting_url in dedup_store.pop_waiting_webhooks(task_id):
+            redeliver_result.delay(task_id, waiting_url)
+    return True
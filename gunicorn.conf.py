@@ -0,0 +1,31 @@
+import multiprocessing
+import os
+import shutil
+
+# gevent：每個請求是一個 greenlet，長輪詢與 SSE 不會佔住執行緒，/upload 也不必排在狀態查詢後面
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = os.getenv('WEB_WORKER_CLASS', 'gevent')
+workers = int(os.getenv('WEB_WORKERS', str(min(4, multiprocessing.cpu_count() * 2))))
+# 每條 SSE/長輪詢連線各佔一條 Redis 訂閱連線，訂閱連線池的上限預設與此相同（REDIS_PUBSUB_MAX_CONNECTIONS）
+worker_connections = int(os.getenv('WEB_WORKER_CONNECTIONS', '2000'))
+# SSE 與長輪詢最長約 10 分鐘；gevent worker 的 timeout 只檢查 worker 心跳，不限制單一請求
+timeout = int(os.getenv('WEB_TIMEOUT', '120'))
+graceful_timeout = 30
+# 大於 nginx 的 keepalive_timeout，避免 nginx 重用已被關閉的連線
+keepalive = 75
+accesslog = os.getenv('WEB_ACCESS_LOG') or None
+errorlog = '-'
+
+
+def on_starting(server):
+    # 清除上一次執行的多進程指標（此處不匯入 utils，避免在 fork 前載入重量級模組）
+    directory = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
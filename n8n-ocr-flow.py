@@ -1,12 +1,20 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Blueprint, Flask, Response, request, jsonify, render_template_string
 from flask_cors import CORS
-from celery_tasks import process_google_drive_image
+from celery_tasks import dedup_store, attach_duplicate, progress_store, submit_job, submit_batch, task_state, load_result, resubmit, webhook_delivery, batch_store, result_processor, result_store, alias_store
+from utils.alias_store import REVIEW_SCORE_THRESHOLD
+from utils.google_drive_downloader import GoogleDriveDownloader
+from utils.metrics import render_metrics
 from datetime import datetime
+from functools import wraps
+import hmac
+import json
+import os
 import re
-import requests
+import time
+import uuid
 
-app = Flask(__name__)
-CORS(app)
+# 路由註冊在 blueprint 上，由 create_app 建立應用（gunicorn 經由 wsgi.py 載入）
+bp = Blueprint('ocr', __name__)
 
 # 簡單的 HTML 表單模板
 # 修改 FORM_TEMPLATE 的這部分
@@ -24,6 +32,7 @@ FORM_TEMPLATE = """
         .score-low { background-color: #ffe6e6; }
         .score-medium { background-color: #fff3e0; }
         .score-high { background-color: #e8f5e8; }
+        .skipped { color: #777; font-size: 0.9em; }
     </style>
 </head>
 <body>
@@ -35,7 +44,7 @@ FORM_TEMPLATE = """
         <input type="hidden" name="task_id" value="{{ task_id }}">
         <input type="hidden" name="webhook_url" value="{{ webhook_url }}">
         
-        {% for item in data['items'] if item['match_score'] < 0.7 %}
+        {% for item in data['items'] if item['match_score'] < review_threshold %}
         <div class="item {% if item['match_score'] < 0.6 %}score-low{% elif item['match_score'] < 0.8 %}score-medium{% else %}score-high{% endif %}">
             <h3>項目 {{ loop.index }}</h3>
             <p><strong>原始輸入:</strong> {{ item['original_input'] }}</p>
@@ -57,6 +66,17 @@ FORM_TEMPLATE = """
         </div>
         {% endfor %}
         
+        {% if data.get('skipped_lines') %}
+        <details class="skipped">
+            <summary>未列入品項的行（{{ data['skipped_lines']|length }}）</summary>
+            <ul>
+            {% for line in data['skipped_lines'] %}
+                <li>第 {{ line['page'] }} 頁：{{ line['line'] }}（{{ line['reason'] }}）</li>
+            {% endfor %}
+            </ul>
+        </details>
+        {% endif %}
+        
         <button type="submit">提交修正</button>
     </form>
 
@@ -172,33 +192,65 @@ class ResponseBuilder:
         }), status_code
     
     @staticmethod
-    def task_status_response(task):
-        """構建任務狀態響應"""
-        if task.state == 'PENDING':
+    def task_status_response(task, state=None, progress=None, result=None):
+        """構建任務狀態響應（progress 為分階段處理時各階段的進度，result 為結果庫中的完整結果）"""
+        state = state or task.state
+        if progress and state in ('PENDING', 'STARTED', 'RETRY'):
+            response = {
+                'state': 'PROGRESS',
+                'step': progress['stage'],
+                'progress': progress['progress'],
+                'stages': progress['stages']
+            }
+        elif state == 'FAILURE' and progress and progress.get('error'):
+            response = {
+                'state': 'FAILURE',
+                'error': progress['error'],
+                'stages': progress['stages']
+            }
+        elif state == 'PENDING':
             response = {
                 'state': 'PENDING',
                 'status': '任務正在等待處理...'
             }
-        elif task.state == 'PROGRESS':
+        elif state == 'PROGRESS':
             response = {
                 'state': 'PROGRESS',
                 'step': task.info.get('step', ''),
                 'progress': task.info.get('progress', 0)
             }
-        elif task.state == 'SUCCESS':
+        elif state == 'SUCCESS':
             response = {
                 'state': 'SUCCESS',
-                'result': task.result
+                'result': result if result is not None else task.result
             }
         else:
             # 任務失敗
             response = {
-                'state': task.state,
+                'state': state,
                 'error': str(task.info)
             }
         return jsonify(response), 200
 
-@app.route('/upload', methods=['POST'])
+def admin_required(view):
+    """
+    管理用路由：nginx 不對外轉發，只能從內部網路呼叫；
+    設定 ADMIN_TOKEN 時還需要 X-Admin-Token 標頭或 Authorization: Bearer <token>
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = os.getenv('ADMIN_TOKEN', '')
+        if token:
+            provided = request.headers.get('X-Admin-Token', '')
+            authorization = request.headers.get('Authorization', '')
+            if not provided and authorization.startswith('Bearer '):
+                provided = authorization[len('Bearer '):]
+            if not hmac.compare_digest(provided.encode(), token.encode()):
+                return ResponseBuilder.error_response('需要管理權限', 401)
+        return view(*args, **kwargs)
+    return wrapper
+
+@bp.route('/upload', methods=['POST'])
 def upload_image():
     """接收請求並啟動異步OCR任務"""
     try:
@@ -211,32 +263,202 @@ def upload_image():
         if not google_drive_url:
             return ResponseBuilder.error_response('請提供Google Drive文件URL', 400)
         
-        # 啟動異步任務
-        task = process_google_drive_image.delay(
-            google_drive_url=google_drive_url,
-            file_name=file_name,
-            mime_type=mime_type,
-            webhook_url=webhook_url
-        )
+        # 同一個 Drive 文件重複提交時沿用既有任務
+        file_id = GoogleDriveDownloader.extract_file_id(google_drive_url)
+        task_id = str(uuid.uuid4())
+        force = str(data.get('force', '')).lower() in ('1', 'true')
+        existing_task_id = None if force else dedup_store.claim_file(file_id, task_id)
+        if existing_task_id:
+            if attach_duplicate(existing_task_id, webhook_url):
+                return ResponseBuilder.success_response('重複提交，沿用既有任務', existing_task_id)
+            dedup_store.claim_file(file_id, task_id, replace=True)
+        elif force:
+            dedup_store.claim_file(file_id, task_id, replace=True)
         
-        return ResponseBuilder.success_response('任務已提交，正在處理中', task.id)
+        # 啟動異步任務（分階段處理時，task_id 代表整條 chain）
+        submit_job(task_id, google_drive_url, file_name, mime_type, webhook_url)
+        
+        return ResponseBuilder.success_response('任務已提交，正在處理中', task_id)
         
     except ValueError as e:
         return ResponseBuilder.error_response(str(e), 400)
     except Exception as e:
         return ResponseBuilder.error_response(f'服務器錯誤: {str(e)}', 500)
 
-@app.route('/status/<task_id>', methods=['GET'])
+@bp.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """一次提交多個文件，回傳 batch_id；全部完成時可送出一個彙總 webhook"""
+    try:
+        data = RequestProcessor.parse_request_data(request)
+        files = data.get('files') or data.get('urls') or []
+        if not isinstance(files, list) or not files:
+            return ResponseBuilder.error_response('請提供文件列表 files', 400)
+        max_files = int(os.getenv('BATCH_MAX_FILES', '100'))
+        if len(files) > max_files:
+            return ResponseBuilder.error_response(f'每批最多 {max_files} 個文件', 400)
+        
+        entries = []
+        for index, entry in enumerate(files):
+            # 每個成員可以是 URL 字串，或與 /upload 相同格式的物件
+            if isinstance(entry, str):
+                entry = {'google_drive_url': entry}
+            if not isinstance(entry, dict):
+                return ResponseBuilder.error_response(f'第 {index + 1} 個文件格式錯誤', 400)
+            if 'url' in entry and 'google_drive_url' not in entry:
+                entry = dict(entry, google_drive_url=entry['url'])
+            google_drive_url, file_name, mime_type, member_webhook_url = RequestProcessor.extract_google_drive_data(entry)
+            if not google_drive_url or not GoogleDriveDownloader.extract_file_id(google_drive_url):
+                return ResponseBuilder.error_response(f'第 {index + 1} 個文件缺少有效的Google Drive URL', 400)
+            entries.append({
+                'task_id': str(uuid.uuid4()),
+                'google_drive_url': google_drive_url,
+                'file_name': file_name,
+                'mime_type': mime_type,
+                'webhook_url': member_webhook_url
+            })
+        
+        batch_id = str(uuid.uuid4())
+        submit_batch(batch_id, entries, data.get('webhookUrl'))
+        return jsonify({
+            'success': True,
+            'message': f'批次已提交，共 {len(entries)} 個文件',
+            'batch_id': batch_id,
+            'status_url': f'/batch-status/{batch_id}',
+            'tasks': [
+                {'task_id': entry['task_id'], 'file_name': entry['file_name'], 'status_url': f"/status/{entry['task_id']}"}
+                for entry in entries
+            ]
+        }), 202
+        
+    except ValueError as e:
+        return ResponseBuilder.error_response(str(e), 400)
+    except Exception as e:
+        return ResponseBuilder.error_response(f'服務器錯誤: {str(e)}', 500)
+
+@bp.route('/batch-status/<batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    """查詢批次的整體進度與各成員結果"""
+    try:
+        batch = batch_store.get(batch_id)
+        if batch is None:
+            return ResponseBuilder.error_response('找不到批次', 404)
+        
+        summary = result_processor.build_batch_result(batch)
+        members = summary['data']['members']
+        for member in members:
+            if member['state'] != 'PENDING':
+                member['progress'] = 100
+                continue
+            # 尚未完成的成員以各自的階段進度回報
+            progress = progress_store.get(member['task_id'])
+            if progress:
+                member['state'] = 'FAILURE' if progress['state'] == 'FAILURE' else 'PROGRESS'
+                member['stage'] = progress['stage']
+                member['progress'] = progress['progress']
+                member['error'] = progress.get('error')
+            else:
+                member['progress'] = 0
+        
+        completed = summary['data']['succeeded'] + summary['data']['failed']
+        return jsonify({
+            'batch_id': batch_id,
+            'state': 'SUCCESS' if batch['finished_at'] else 'PROGRESS',
+            'total': batch['total'],
+            'completed': completed,
+            'succeeded': summary['data']['succeeded'],
+            'failed': summary['data']['failed'],
+            'progress': round(sum(member['progress'] for member in members) / len(members)) if members else 100,
+            'members': members
+        }), 200
+        
+    except Exception as e:
+        return ResponseBuilder.error_response(f'查詢批次狀態失敗: {str(e)}', 500)
+
+@bp.route('/status/<task_id>', methods=['GET'])
 def get_task_status(task_id):
     """查詢任務狀態"""
     try:
-        task = process_google_drive_image.AsyncResult(task_id)
-        return ResponseBuilder.task_status_response(task)
+        task, state = task_state(task_id)
+        # ?wait=秒數：長輪詢，直到進度有變化、任務結束或逾時才回應
+        wait = min(float(request.args.get('wait', 0) or 0), 60)
+        if wait > 0 and state not in FINISHED_STATES:
+            snapshot = wait_for_progress(task_id, wait)
+            if snapshot and snapshot['state'] == 'SUCCESS':
+                wait_for_result(task_id)
+            task, state = task_state(task_id)
+        progress = progress_store.get(task_id) if state != 'SUCCESS' else None
+        result = load_result(task_id, task) if state == 'SUCCESS' else None
+        return ResponseBuilder.task_status_response(task, state, progress, result)
         
     except Exception as e:
         return ResponseBuilder.error_response(f'查詢任務狀態失敗: {str(e)}', 500)
 
-@app.route('/health', methods=['GET'])
+FINISHED_STATES = ('SUCCESS', 'FAILURE', 'REVOKED')
+
+def wait_for_progress(task_id, timeout):
+    """等待下一個進度事件，回傳最新進度（逾時回傳 None）"""
+    events = progress_store.listen(task_id, timeout=timeout, heartbeat=timeout)
+    try:
+        current = next(events)
+        if current and current['state'] in FINISHED_STATES:
+            return current
+        return next(events, None)
+    finally:
+        events.close()
+
+def wait_for_result(task_id, timeout=5):
+    """進度在結果寫入後端前一刻就標記完成，稍等結果可以讀取"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        _, state = task_state(task_id)
+        if state in FINISHED_STATES:
+            return state
+        time.sleep(0.1)
+    return None
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@bp.route('/events/<task_id>', methods=['GET'])
+def task_events(task_id):
+    """以 Server-Sent Events 推送任務進度：progress 事件帶各階段狀態，結束時送出 done 或 failed"""
+    timeout = min(int(request.args.get('timeout', 300)), 600)
+    
+    def stream():
+        yield 'retry: 5000\n\n'
+        try:
+            for snapshot in progress_store.listen(task_id, timeout=timeout):
+                if snapshot is None:
+                    # 沒有進度紀錄（例如舊任務）時，只在心跳間隔查詢結果後端
+                    _, state = task_state(task_id)
+                    if state == 'SUCCESS':
+                        yield sse_event('done', {'state': state})
+                        return
+                    if state in FINISHED_STATES:
+                        yield sse_event('failed', {'state': state, 'error': state})
+                        return
+                    yield ': keep-alive\n\n'
+                    continue
+                yield sse_event('progress', snapshot)
+                if snapshot['state'] == 'SUCCESS':
+                    wait_for_result(task_id)
+                    yield sse_event('done', {'state': 'SUCCESS'})
+                    return
+                if snapshot['state'] == 'FAILURE':
+                    yield sse_event('failed', {'state': 'FAILURE', 'error': snapshot['error']})
+                    return
+            yield sse_event('timeout', {'state': 'PENDING'})
+        except Exception as e:
+            # 進度服務不可用，讓頁面退回定時刷新
+            print(f"進度事件串流失敗: {e}")
+            yield sse_event('unavailable', {'error': str(e)})
+    
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@bp.route('/health', methods=['GET'])
 def health_check():
     """健康檢查"""
     return jsonify({
@@ -245,24 +467,30 @@ def health_check():
         'service': 'OCR Image Upload Service with Celery'
     }), 200
 
-@app.route('/correction-form/<task_id>')
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 指標（各階段耗時、LLM 呼叫、快取命中、webhook 投遞與佇列深度）"""
+    body, content_type = render_metrics()
+    return Response(body, mimetype=content_type.split(';')[0], headers={'Content-Type': content_type})
+
+@bp.route('/correction-form/<task_id>')
 def correction_form(task_id):
     """顯示人工修正表單"""
     try:
         # 從 Celery 取得任務結果
-        task = process_google_drive_image.AsyncResult(task_id)
+        task, state = task_state(task_id)
         print(f"DEBUG: Task ID: {task_id}")
-        print(f"DEBUG: Task State: {task.state}")
+        print(f"DEBUG: Task State: {state}")
         
         # 如果任務還沒完成，等待它完成
-        if task.state != 'SUCCESS':
-            if task.state == 'PENDING':
+        if state != 'SUCCESS':
+            if state in ('PENDING', 'STARTED', 'RETRY'):
                 return render_template_string("""
                     <!DOCTYPE html>
                     <html>
                     <head>
                         <title>任務處理中</title>
-                        <meta http-equiv="refresh" content="5">
+                        <noscript><meta http-equiv="refresh" content="5"></noscript>
                         <style>
                             body { font-family: Arial, sans-serif; margin: 40px; text-align: center; }
                             .loader { border: 5px solid #f3f3f3; border-radius: 50%; border-top: 5px solid #3498db; width: 30px; height: 30px; animation: spin 2s linear infinite; margin: 20px auto; }
@@ -273,14 +501,38 @@ def correction_form(task_id):
                         <h1>任務處理中</h1>
                         <div class="loader"></div>
                         <p>任務 {{ task_id }} 正在處理中，請稍候...</p>
-                        <p>頁面將每 5 秒自動刷新</p>
+                        <p id="stage">完成後將自動顯示修正表單</p>
+                        <script>
+                            // 以 SSE 接收進度，任務完成的當下重新載入；不支援時退回定時刷新
+                            const stageNames = { download: '下載', ocr: '文字辨識', match: '品項匹配', deliver: '回傳結果' };
+                            const stageLabel = document.getElementById('stage');
+                            const fallback = () => setTimeout(() => location.reload(), 5000);
+                            if (window.EventSource) {
+                                const events = new EventSource('/events/{{ task_id }}');
+                                events.addEventListener('progress', (e) => {
+                                    const progress = JSON.parse(e.data);
+                                    stageLabel.textContent = `目前階段：${stageNames[progress.stage] || progress.stage}（${progress.progress}%）`;
+                                });
+                                events.addEventListener('done', () => { events.close(); location.reload(); });
+                                events.addEventListener('failed', (e) => {
+                                    events.close();
+                                    stageLabel.textContent = '處理失敗：' + JSON.parse(e.data).error;
+                                });
+                                events.addEventListener('timeout', () => { events.close(); location.reload(); });
+                                events.addEventListener('unavailable', () => { events.close(); fallback(); });
+                                events.onerror = () => { if (events.readyState === EventSource.CLOSED) fallback(); };
+                            } else {
+                                fallback();
+                            }
+                        </script>
                     </body>
                     </html>
                 """, task_id=task_id)
             else:
-                return ResponseBuilder.error_response(f'任務狀態異常: {task.state}', 400)
+                return ResponseBuilder.error_response(f'任務狀態異常: {state}', 400)
         
-        result = task.result
+        # 結果庫保存完整結果，Celery 結果過期後仍可開啟表單
+        result = load_result(task_id, task)
         webhook_url = request.args.get('webhook_url', '')
         
         # 調試輸出
@@ -308,7 +560,8 @@ def correction_form(task_id):
             FORM_TEMPLATE, 
             data=data, 
             task_id=task_id,
-            webhook_url=webhook_url
+            webhook_url=webhook_url,
+            review_threshold=REVIEW_SCORE_THRESHOLD
         )
         
     except Exception as e:
@@ -317,7 +570,7 @@ def correction_form(task_id):
         print(traceback.format_exc())
         return ResponseBuilder.error_response(f'載入表單失敗: {str(e)}', 500)
 
-@app.route('/submit-correction', methods=['POST'])
+@bp.route('/submit-correction', methods=['POST'])
 def submit_correction():
     """處理修正後的數據並回傳給 n8n"""
     try:
@@ -345,31 +598,20 @@ def submit_correction():
             }
         }
         
-        # 發送回 n8n
+        # 人工確認的品號記入別名表，之後相同的寫法直接匹配，不必再呼叫 LLM 或人工修正；
+        # 與原本的結果比對，沒有被人工檢查過的 LLM 猜測不會被記成別名
         try:
-            response = requests.post(
-                webhook_url,
-                json=corrected_result,
-                headers={'Content-Type': 'application/json'},
-                timeout=30
-            )
-            
-            print(f"DEBUG: Response status: {response.status_code}")
-            print(f"DEBUG: Response body: {response.text}")
-            
-            if response.status_code == 200:
-                return jsonify({'success': True, 'message': '修正數據已提交'})
-            elif response.status_code == 409:
-                return jsonify({
-                    'success': True, 
-                    'message': '修正數據已提交（webhook 已被使用過，但修正已成功完成）'
-                })
-            else:
-                return ResponseBuilder.error_response(f'回傳失敗: {response.status_code}, 響應內容: {response.text}', 500)
-                
+            original = load_result(task_id) if task_id else None
+            original_items = ((original or {}).get('data') or {}).get('items') or []
+            recorded = alias_store.record_corrections(corrected_items, original_items, task_id)
+            print(f"DEBUG: Recorded {recorded} aliases")
         except Exception as e:
-            print(f"DEBUG: Request exception: {str(e)}")
-            return ResponseBuilder.error_response(f'發送請求失敗: {str(e)}', 500)
+            print(f"記錄別名失敗: {e}")
+        
+        # 排入回傳佇列後立即返回，由投遞服務送回 n8n 並負責重試
+        delivery_id = webhook_delivery.enqueue(webhook_url, corrected_result, task_id=task_id)
+        print(f"DEBUG: Correction queued: {delivery_id}")
+        return jsonify({'success': True, 'message': '修正數據已提交', 'delivery_id': delivery_id})
         
     except Exception as e:
         import traceback
@@ -377,5 +619,74 @@ def submit_correction():
         print(traceback.format_exc())
         return ResponseBuilder.error_response(f'提交修正失敗: {str(e)}', 500)
 
+@bp.route('/reprocess/<task_id>', methods=['POST'])
+@admin_required
+def reprocess(task_id):
+    """以原本的 Drive 連結重新處理已完成的任務（例如修改品名清單後），回傳新的 task_id"""
+    try:
+        data = request.get_json(silent=True) or {}
+        new_task_id = resubmit(task_id, data.get('webhookUrl'))
+        if new_task_id is None:
+            return ResponseBuilder.error_response('結果庫中找不到此任務', 404)
+        return ResponseBuilder.success_response('已重新提交處理', new_task_id)
+    except Exception as e:
+        return ResponseBuilder.error_response(f'重新處理失敗: {str(e)}', 500)
+
+@bp.route('/results', methods=['GET'])
+@admin_required
+def list_results():
+    """依 Drive file_id 或日期（?file_id=、?date=YYYY-MM-DD）列出結果庫中的任務摘要"""
+    try:
+        limit = min(int(request.args.get('limit', 100)), 1000)
+        results = result_store.find(request.args.get('file_id'), request.args.get('date'), limit)
+        return jsonify({'success': True, 'results': results}), 200
+    except Exception as e:
+        return ResponseBuilder.error_response(f'查詢結果失敗: {str(e)}', 500)
+
+@bp.route('/webhooks/dead', methods=['GET'])
+@admin_required
+def list_dead_webhooks():
+    """列出投遞失敗、已移入死信的 webhook"""
+    try:
+        limit = int(request.args.get('limit', 100))
+        return jsonify({'success': True, 'deliveries': webhook_delivery.dead_letters(limit)}), 200
+    except Exception as e:
+        return ResponseBuilder.error_response(f'讀取死信失敗: {str(e)}', 500)
+
+@bp.route('/webhooks/<delivery_id>', methods=['GET'])
+@admin_required
+def get_webhook_delivery(delivery_id):
+    """查詢單筆 webhook 投遞狀態"""
+    record = webhook_delivery.get(delivery_id)
+    if record is None:
+        return ResponseBuilder.error_response('找不到投遞紀錄', 404)
+    return jsonify({'success': True, 'delivery': record}), 200
+
+@bp.route('/webhooks/replay', methods=['POST'])
+@bp.route('/webhooks/replay/<delivery_id>', methods=['POST'])
+@admin_required
+def replay_webhooks(delivery_id=None):
+    """重送單筆投遞；未指定時重送所有死信"""
+    try:
+        if delivery_id:
+            if not webhook_delivery.replay(delivery_id):
+                return ResponseBuilder.error_response('找不到投遞紀錄', 404)
+            replayed = [delivery_id]
+        else:
+            replayed = webhook_delivery.replay_dead(int(request.args.get('limit', 100)))
+        return jsonify({'success': True, 'replayed': replayed}), 202
+    except Exception as e:
+        return ResponseBuilder.error_response(f'重送失敗: {str(e)}', 500)
+
+def create_app():
+    """建立 Flask 應用"""
+    app = Flask(__name__)
+    CORS(app)
+    app.register_blueprint(bp)
+    return app
+
+app = create_app()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    # 開發用的內建伺服器；正式環境使用 gunicorn + gevent（見 gunicorn.conf.py）
+    app.run(host='0.0.0.0', port=5000, debug=False)
@@ -2,18 +2,39 @@
 Utils package for OCR processing pipeline
 """
 
-from .file_manager import FileManager
-from .fuzzy_matching import OrderFuzzyMatcher
-from .google_drive_downloader import GoogleDriveDownloader
-from .ocr_processor import OcrProcessor
-from .order_processor import OrderProcessor
-from .result_processor import ResultProcessor
+import importlib
+
+# 名稱 -> 子模組；第一次存取時才匯入，import utils.xxx 不會連帶載入 cv2、Vision 等重型依賴
+_EXPORTS = {
+    'FileManager': 'file_manager',
+    'OrderFuzzyMatcher': 'fuzzy_matching',
+    'GoogleDriveDownloader': 'google_drive_downloader',
+    'MatchBackend': 'match_backends',
+    'LocalSimilarityBackend': 'match_backends',
+    'OcrProcessor': 'ocr_processor',
+    'OrderProcessor': 'order_processor',
+    'ResultProcessor': 'result_processor',
+}
 
 __all__ = [
     'FileManager',
     'OrderFuzzyMatcher', 
     'GoogleDriveDownloader',
+    'MatchBackend',
+    'LocalSimilarityBackend',
     'OcrProcessor',
     'OrderProcessor',
     'ResultProcessor'
-]
\ No newline at end of file
+]
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,147 @@
+import os
+import sqlite3
+import threading
+import time
+from .candidate_index import normalize_text
+
+# 修正表單列出 match_score 低於此值的品項，這些品項都經過人工確認
+REVIEW_SCORE_THRESHOLD = 0.7
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS aliases (
+    alias TEXT NOT NULL,
+    product_id TEXT NOT NULL,
+    matched_name TEXT,
+    count INTEGER NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    last_task_id TEXT,
+    PRIMARY KEY (alias, product_id)
+);
+"""
+
+
+_FULLWIDTH_PARENS = str.maketrans('（）', '()')
+
+
+def alias_key(text):
+    """別名鍵：完整品名正規化（保留括號與規格，「柳丁(大)」與「柳丁(小)」是不同的別名）"""
+    return normalize_text(str(text).translate(_FULLWIDTH_PARENS)) if text else ''
+
+
+class AliasStore:
+    """
+    人工修正學到的別名表（uploads 目錄中的 SQLite）：正規化的原始輸入/品名 → 品號，
+    記錄修正次數與時間。匹配時先查此表，命中的品項不必再做索引搜尋或呼叫 LLM
+    """
+
+    def __init__(self, path=None, enabled=None, min_count=None):
+        self.path = path or os.getenv('ALIAS_STORE_PATH', os.path.join('uploads', 'aliases.sqlite3'))
+        if enabled is None:
+            enabled = os.getenv('ALIAS_ENABLED', '1') == '1'
+        self.enabled = enabled
+        # 同一別名至少被修正幾次才採用
+        self.min_count = min_count or int(os.getenv('ALIAS_MIN_COUNT', '1'))
+        # 每個進程一個連線（sqlite 連線不能跨 fork 使用），以鎖序列化同進程內的存取
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def record(self, text, product_id, matched_name=None, task_id=None):
+        """記錄一筆修正；回傳寫入的別名鍵，無法作為別名時回傳 None"""
+        key = alias_key(text)
+        product_id = str(product_id or '').strip()
+        if not self.enabled or not key or not product_id:
+            return None
+        now = time.time()
+        with self._lock:
+            self._connect().execute(
+                """
+                INSERT INTO aliases (alias, product_id, matched_name, count, first_seen, last_seen, last_task_id)
+                VALUES (?, ?, ?, 1, ?, ?, ?)
+                ON CONFLICT (alias, product_id) DO UPDATE SET
+                    count = count + 1,
+                    matched_name = excluded.matched_name,
+                    last_seen = excluded.last_seen,
+                    last_task_id = excluded.last_task_id
+                """,
+                (key, product_id, matched_name, now, now, task_id)
+            )
+        return key
+
+    def record_corrections(self, items, original_items, task_id=None):
+        """
+        記錄修正表單送回的品項：以原本結果中 OCR 擷取的品名（沒有時用原始輸入）對應到人工確認的品號，
+        表單上被改正的品名不作為別名鍵，下一份相同誤讀的單據才查得到。
+        只記錄確實經過人工確認的行：品號與原本的結果不同，或原本的信心度低於 REVIEW_SCORE_THRESHOLD
+        （表單列出、由人工檢查過的品項）；找不到原本結果的行不記錄。回傳記錄的別名數
+        """
+        originals = {}
+        for original in original_items or []:
+            if isinstance(original, dict):
+                originals.setdefault(original.get('original_input'), []).append(original)
+        recorded = 0
+        for item in items or []:
+            if not isinstance(item, dict):
+                continue
+            candidates = originals.get(item.get('original_input'))
+            if not candidates:
+                continue
+            original = candidates.pop(0)
+            product_id = str(item.get('product_id') or '').strip()
+            changed = product_id != str(original.get('product_id') or '').strip()
+            try:
+                reviewed = float(original.get('match_score') or 0) < REVIEW_SCORE_THRESHOLD
+            except (TypeError, ValueError):
+                reviewed = False
+            if not (changed or reviewed):
+                continue
+            text = original.get('item_name') or original.get('original_input')
+            if self.record(text, product_id, item.get('matched_name'), task_id):
+                recorded += 1
+        return recorded
+
+    def lookup_many(self, keys):
+        """以正規化的別名鍵查詢，回傳 {別名鍵: {'product_id', 'matched_name', 'count', 'last_seen'}}"""
+        keys = [key for key in dict.fromkeys(keys) if key]
+        if not self.enabled or not keys:
+            return {}
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            # 同一別名被修正成不同品號時，採用次數最多、其次最近的一筆
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = conn.execute(
+                    f"""
+                    SELECT alias, product_id, matched_name, count, last_seen FROM aliases
+                    WHERE alias IN ({', '.join('?' * len(chunk))}) AND count >= ?
+                    ORDER BY count ASC, last_seen ASC
+                    """,
+                    chunk + [self.min_count]
+                ).fetchall()
+                for alias, product_id, matched_name, count, last_seen in rows:
+                    found[alias] = {
+                        'product_id': product_id,
+                        'matched_name': matched_name,
+                        'count': count,
+                        'last_seen': last_seen
+                    }
+        return found
+
+    def lookup(self, text):
+        key = alias_key(text)
+        return self.lookup_many([key]).get(key)
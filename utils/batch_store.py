@@ -0,0 +1,64 @@
+import json
+import os
+import time
+import zlib
+from .redis_client import get_redis
+
+
+class BatchStore:
+    """批次上傳的紀錄（存於 Redis）：成員清單、各成員的精簡結果，以及全部完成的判定"""
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl or int(os.getenv('BATCH_TTL', str(24 * 3600)))
+
+    def _key(self, batch_id, suffix=''):
+        return f"batch:{batch_id}{suffix}"
+
+    def create(self, batch_id, members, webhook_url=None):
+        """members 為 [{'task_id', 'file_name', 'google_drive_url'}, ...]"""
+        client = get_redis()
+        pipe = client.pipeline()
+        pipe.hset(self._key(batch_id), mapping={
+            'members': json.dumps(members, ensure_ascii=False),
+            'total': len(members),
+            'webhook_url': webhook_url or '',
+            'created_at': time.time()
+        })
+        pipe.sadd(self._key(batch_id, ':pending'), *[member['task_id'] for member in members])
+        for suffix in ('', ':pending'):
+            pipe.expire(self._key(batch_id, suffix), self.ttl)
+        pipe.execute()
+
+    def member_done(self, batch_id, task_id, summary):
+        """記錄成員結果；回傳 True 表示這是最後一個完成的成員（只會有一個呼叫者得到 True）"""
+        client = get_redis()
+        pipe = client.pipeline()
+        pipe.hset(self._key(batch_id, ':results'), task_id, zlib.compress(json.dumps(summary, ensure_ascii=False).encode('utf-8')))
+        pipe.expire(self._key(batch_id, ':results'), self.ttl)
+        pipe.srem(self._key(batch_id, ':pending'), task_id)
+        pipe.scard(self._key(batch_id, ':pending'))
+        _, _, removed, remaining = pipe.execute()
+        if not removed or remaining:
+            return False
+        # 重試的成員可能重複回報，只讓一個呼叫者送出彙總回調
+        return bool(client.hsetnx(self._key(batch_id), 'finished_at', time.time()))
+
+    def get(self, batch_id):
+        """回傳 {'batch_id', 'members', 'total', 'webhook_url', 'created_at', 'finished_at', 'results'}"""
+        client = get_redis()
+        pipe = client.pipeline()
+        pipe.hgetall(self._key(batch_id))
+        pipe.hgetall(self._key(batch_id, ':results'))
+        record, results = pipe.execute()
+        if not record:
+            return None
+        fields = {key.decode(): value.decode() for key, value in record.items()}
+        return {
+            'batch_id': batch_id,
+            'members': json.loads(fields['members']),
+            'total': int(fields['total']),
+            'webhook_url': fields.get('webhook_url') or None,
+            'created_at': float(fields['created_at']),
+            'finished_at': float(fields['finished_at']) if fields.get('finished_at') else None,
+            'results': {key.decode(): json.loads(zlib.decompress(value)) for key, value in results.items()}
+        }
@@ -0,0 +1,164 @@
+import math
+import re
+from collections import defaultdict
+import numpy as np
+
+# 括號內的補充說明，例如「柳丁(進口)」的「(進口)」
+_PAREN_PATTERN = re.compile(r'[（(][^（()）]*[)）]')
+# 品名中的別名分隔符號，例如「柳丁/柳橙」、「茼萵\冬蚵菜」
+_ALIAS_SPLIT_PATTERN = re.compile(r'[/／\\]')
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """正規化文字：去除空白並轉為小寫"""
+    return _WHITESPACE_PATTERN.sub('', str(text)).lower()
+
+
+def extract_chinese_name(text):
+    match = re.match(r'^([\u4e00-\u9fff]+)', text)
+    if match:
+        return match.group(1)
+    return text
+
+
+def expand_name_variants(name):
+    """展開品名的所有變體：原名、去括號名稱及斜線分隔的別名"""
+    variants = []
+    candidates = [name]
+    stripped = _PAREN_PATTERN.sub('', name)
+    candidates.append(stripped)
+    for source in (name, stripped):
+        candidates.extend(_ALIAS_SPLIT_PATTERN.split(source))
+
+    for candidate in candidates:
+        candidate = normalize_text(candidate)
+        if candidate and candidate not in variants:
+            variants.append(candidate)
+    return variants
+
+
+def char_ngrams(text, ngram_sizes=(1, 2)):
+    """產生字元 n-gram 列表"""
+    grams = []
+    for n in ngram_sizes:
+        if len(text) < n:
+            continue
+        for i in range(len(text) - n + 1):
+            grams.append(text[i:i + n])
+    return grams
+
+
+def build_postings(variants, ngram_sizes=(1, 2)):
+    """
+    把 [(品名索引, 正規化變體)] 編譯成 CSR 格式的倒排表陣列：
+    gram_keys（排序後的 n-gram）、gram_offsets、posting_docs/posting_tfs（變體索引與詞頻）、doc_lengths
+    """
+    postings = defaultdict(list)
+    doc_lengths = []
+    for doc_id, (_, variant) in enumerate(variants):
+        grams = char_ngrams(variant, ngram_sizes)
+        doc_lengths.append(len(grams))
+        counts = defaultdict(int)
+        for gram in grams:
+            counts[gram] += 1
+        for gram, tf in counts.items():
+            postings[gram].append((doc_id, tf))
+
+    keys = sorted(postings)
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(postings[key]) for key in keys])
+    docs = np.empty(offsets[-1], dtype=np.int32)
+    tfs = np.empty(offsets[-1], dtype=np.int32)
+    for key_idx, key in enumerate(keys):
+        entries = postings[key]
+        docs[offsets[key_idx]:offsets[key_idx + 1]] = [doc_id for doc_id, _ in entries]
+        tfs[offsets[key_idx]:offsets[key_idx + 1]] = [tf for _, tf in entries]
+    return {
+        'gram_keys': np.array(keys, dtype=str),
+        'gram_offsets': offsets,
+        'posting_docs': docs,
+        'posting_tfs': tfs,
+        'doc_lengths': np.array(doc_lengths, dtype=np.int32),
+    }
+
+
+class NgramIndex:
+    """品名字元 n-gram 倒排索引，以 BM25 評分篩選候選品名（倒排表為 CSR 陣列，可直接 mmap 快照）"""
+
+    def __init__(self, names, ngram_sizes=(1, 2), k1=1.2, b=0.75, variants=None, postings=None, owners=None):
+        self.ngram_sizes = tuple(ngram_sizes)
+        self.k1 = k1
+        self.b = b
+        self.names = list(dict.fromkeys(names))
+        if postings is None:
+            if variants is None:
+                variants = [
+                    (name_idx, variant)
+                    for name_idx, name in enumerate(self.names)
+                    for variant in expand_name_variants(name)
+                ]
+            postings = build_postings(variants, self.ngram_sizes)
+            owners = np.array([name_idx for name_idx, _ in variants], dtype=np.int64)
+        self._gram_keys = postings['gram_keys']
+        self._gram_offsets = postings['gram_offsets']
+        self._posting_docs = postings['posting_docs']
+        self._posting_tfs = postings['posting_tfs']
+        self._doc_lengths = postings['doc_lengths']
+        self._doc_names = owners      # 變體 -> 品名索引
+        doc_count = len(self._doc_lengths)
+        self._doc_count = doc_count
+        self._avg_length = float(self._doc_lengths.mean()) if doc_count else 0
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """直接使用快照中以 mmap 開啟的倒排表，開啟時不需重建索引"""
+        return cls(
+            snapshot.names,
+            ngram_sizes=snapshot.ngram_sizes,
+            postings=snapshot.postings,
+            owners=snapshot.variant_owners
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    def _lookup(self, gram):
+        """回傳 n-gram 的 (變體索引陣列, 詞頻陣列)；不存在時回傳 None"""
+        position = int(np.searchsorted(self._gram_keys, gram))
+        if position >= len(self._gram_keys) or self._gram_keys[position] != gram:
+            return None
+        start, end = self._gram_offsets[position], self._gram_offsets[position + 1]
+        return self._posting_docs[start:end], self._posting_tfs[start:end]
+
+    def search(self, query, top_k=30):
+        """回傳與查詢最相關的前 top_k 個品名及分數"""
+        query_grams = set(char_ngrams(normalize_text(query), self.ngram_sizes))
+        if not query_grams or not self._avg_length:
+            return []
+
+        doc_ids, contributions = [], []
+        for gram in query_grams:
+            found = self._lookup(gram)
+            if found is None:
+                continue
+            docs, tfs = found
+            document_frequency = len(docs)
+            idf = math.log(1 + (self._doc_count - document_frequency + 0.5) / (document_frequency + 0.5))
+            tfs = tfs.astype(np.float64)
+            length_norm = 1 - self.b + self.b * self._doc_lengths[docs] / self._avg_length
+            doc_ids.append(docs)
+            contributions.append(idf * tfs * (self.k1 + 1) / (tfs + self.k1 * length_norm))
+        if not doc_ids:
+            return []
+
+        # 各變體加總所有 n-gram 的分數
+        docs, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+        doc_scores = np.bincount(inverse, weights=np.concatenate(contributions))
+        # 同一品名取其變體中的最高分；分數相同時品名索引小的在前
+        owners = np.asarray(self._doc_names[docs])
+        order = np.lexsort((owners, -doc_scores))
+        _, first = np.unique(owners[order], return_index=True)
+        best = order[np.sort(first)]
+        best = best[np.lexsort((owners[best], -doc_scores[best]))][:top_k]
+        return [(self.names[owners[doc]], float(doc_scores[doc])) for doc in best]
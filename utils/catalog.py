@@ -0,0 +1,274 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+from .candidate_index import build_postings, expand_name_variants
+
+SNAPSHOT_FORMAT = 2
+_ARRAYS = ('names', 'product_ids', 'variants', 'variant_owners', 'codes', 'lengths')
+# n-gram 倒排表（CSR），候選索引直接以 mmap 使用
+_POSTING_ARRAYS = ('gram_keys', 'gram_offsets', 'posting_docs', 'posting_tfs', 'doc_lengths')
+NGRAM_SIZES = (1, 2)
+
+
+def file_sha256(path):
+    """計算檔案的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_catalog_frame(path):
+    """讀取品名清單（CSV 或 Excel），回傳 DataFrame"""
+    import pandas as pd
+
+    if path.lower().endswith(('.xlsx', '.xls')):
+        return pd.read_excel(path, dtype=str)
+    try:
+        return pd.read_csv(path, dtype=str, encoding="big5")
+    except UnicodeDecodeError:
+        import chardet
+        with open(path, "rb") as f:
+            result = chardet.detect(f.read())
+            encoding = result["encoding"]
+        return pd.read_csv(path, dtype=str, encoding=encoding)
+
+
+class CatalogSnapshot:
+    """已編譯的品名清單快照：以 mmap 開啟的陣列與 品名→品號 雜湊索引"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.version = self.meta['sha256']
+        arrays = {
+            name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+            for name in _ARRAYS + _POSTING_ARRAYS
+        }
+        self.ngram_sizes = tuple(self.meta.get('ngram_sizes', NGRAM_SIZES))
+        self.postings = {name: arrays[name] for name in _POSTING_ARRAYS}
+        self.codes = arrays['codes']
+        self.lengths = arrays['lengths']
+        self.variant_owners = arrays['variant_owners']
+        self.names = arrays['names'].tolist()
+        self.variants = arrays['variants'].tolist()
+        self._product_ids = dict(zip(self.names, arrays['product_ids'].tolist()))
+        self._names_by_id = {}
+        for name, product_id in self._product_ids.items():
+            self._names_by_id.setdefault(product_id, name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup_product_id(self, name):
+        """O(1) 查詢品名對應的品號"""
+        return self._product_ids.get(name, "")
+
+    def lookup_name(self, product_id):
+        """O(1) 查詢品號對應的品名"""
+        return self._names_by_id.get(product_id, "")
+
+    def variant_pairs(self):
+        """回傳 (品名索引, 正規化變體) 列表"""
+        return list(zip(self.variant_owners.tolist(), self.variants))
+
+
+def build_snapshot(source_path, directory, sha256, previous=None):
+    """從來源檔編譯快照，未變更品名的變體沿用前一版快照"""
+    frame = read_catalog_frame(source_path)
+    frame = frame.dropna(subset=['品名'])
+    product_ids = frame['品號'].fillna('') if '品號' in frame.columns else None
+
+    # 同名品項以第一筆的品號為準
+    names, ids = [], []
+    seen = set()
+    for row_idx, name in enumerate(frame['品名'].tolist()):
+        if name in seen:
+            continue
+        seen.add(name)
+        names.append(name)
+        ids.append(product_ids.iloc[row_idx] if product_ids is not None else '')
+
+    previous_variants = {}
+    if previous is not None:
+        for owner, variant in previous.variant_pairs():
+            previous_variants.setdefault(previous.names[owner], []).append(variant)
+
+    variants, owners = [], []
+    reused = 0
+    for name_idx, name in enumerate(names):
+        name_variants = previous_variants.get(name)
+        if name_variants is None:
+            name_variants = expand_name_variants(name)
+        else:
+            reused += 1
+        variants.extend(name_variants)
+        owners.extend([name_idx] * len(name_variants))
+
+    max_length = max((len(variant) for variant in variants), default=0)
+    codes = np.zeros((len(variants), max_length), dtype=np.int32)
+    for row, variant in enumerate(variants):
+        codes[row, :len(variant)] = [ord(char) for char in variant]
+
+    arrays = {
+        'names': np.array(names, dtype=str),
+        'product_ids': np.array(ids, dtype=str),
+        'variants': np.array(variants, dtype=str),
+        'variant_owners': np.array(owners, dtype=np.int64),
+        'codes': codes,
+        'lengths': np.array([len(variant) for variant in variants], dtype=np.int32),
+    }
+    arrays.update(build_postings(list(zip(owners, variants)), NGRAM_SIZES))
+    os.makedirs(os.path.dirname(directory) or '.', exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='.building-', dir=os.path.dirname(directory) or '.')
+    try:
+        os.chmod(staging, 0o755)
+        for name, array in arrays.items():
+            np.save(os.path.join(staging, f'{name}.npy'), array)
+        stat = os.stat(source_path)
+        meta = {
+            'format': SNAPSHOT_FORMAT,
+            'source': os.path.abspath(source_path),
+            'sha256': sha256,
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'rows': len(frame),
+            'names': len(names),
+            'reused_variants': reused,
+            'ngram_sizes': list(NGRAM_SIZES),
+            'built_at': time.time(),
+        }
+        with open(os.path.join(staging, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        # 以目錄改名完成原子替換，其他 worker 不會讀到寫到一半的快照
+        try:
+            os.rename(staging, directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+            shutil.rmtree(staging, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    print(f"品名清單快照已建立: {directory}（{len(names)} 個品名，沿用 {reused} 個）")
+    return CatalogSnapshot(directory)
+
+
+class CatalogLoader:
+    """載入品名清單快照，來源檔變更時自動重建並熱替換"""
+
+    def __init__(self, source_path, snapshot_dir=None, check_interval=None):
+        self.source_path = source_path
+        self.snapshot_dir = snapshot_dir or os.getenv(
+            'CATALOG_SNAPSHOT_DIR',
+            os.path.join(os.path.dirname(os.path.abspath(source_path)), '.catalog_snapshots')
+        )
+        self.check_interval = check_interval if check_interval is not None else float(os.getenv('CATALOG_CHECK_INTERVAL', '30'))
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._source_stat = None
+        self._checked_at = 0
+        self.reload()
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def current(self):
+        """回傳目前的快照，超過檢查間隔時先確認來源檔是否變更"""
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            self.reload()
+        return self._snapshot
+
+    def reload(self):
+        """來源檔的 mtime/大小或雜湊改變時重建快照"""
+        with self._lock:
+            self._checked_at = time.monotonic()
+            stat = os.stat(self.source_path)
+            source_stat = (stat.st_mtime, stat.st_size)
+            if self._snapshot is not None and source_stat == self._source_stat:
+                return self._snapshot
+
+            snapshot = self._open_current(source_stat)
+            if snapshot is None:
+                sha256 = file_sha256(self.source_path)
+                if self._snapshot is not None and self._snapshot.version == sha256:
+                    snapshot = self._snapshot
+                else:
+                    directory = self._directory(sha256)
+                    if os.path.isfile(os.path.join(directory, 'meta.json')):
+                        snapshot = CatalogSnapshot(directory)
+                    else:
+                        snapshot = build_snapshot(self.source_path, directory, sha256, previous=self._snapshot)
+                self._write_pointer(snapshot, source_stat)
+
+            self._snapshot = snapshot
+            self._source_stat = source_stat
+            return snapshot
+
+    def _directory(self, sha256):
+        # 目錄名稱含格式版本，格式變更後舊版快照會被重建而不是被誤讀
+        return os.path.join(self.snapshot_dir, f'{sha256[:16]}-v{SNAPSHOT_FORMAT}')
+
+    def _pointer_path(self):
+        source_key = hashlib.sha1(os.path.abspath(self.source_path).encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.snapshot_dir, f'CURRENT-{source_key}.json')
+
+    def _open_current(self, source_stat):
+        """來源檔未變更時直接開啟上次的快照，不必重新計算雜湊"""
+        try:
+            with open(self._pointer_path(), encoding='utf-8') as f:
+                pointer = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (pointer.get('source') != os.path.abspath(self.source_path)
+                or (pointer.get('mtime'), pointer.get('size')) != source_stat):
+            return None
+        if self._snapshot is not None and self._snapshot.version == pointer.get('sha256'):
+            return self._snapshot
+        directory = self._directory(pointer.get('sha256', ''))
+        try:
+            snapshot = CatalogSnapshot(directory)
+        except (OSError, ValueError, KeyError):
+            return None
+        return snapshot if snapshot.meta.get('format') == SNAPSHOT_FORMAT else None
+
+    def _write_pointer(self, snapshot, source_stat):
+        pointer = {
+            'source': os.path.abspath(self.source_path),
+            'sha256': snapshot.version,
+            'mtime': source_stat[0],
+            'size': source_stat[1],
+        }
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.snapshot_dir, suffix='.json')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(pointer, f, ensure_ascii=False)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self._pointer_path())
+        except OSError as e:
+            print(f"寫入品名清單快照指標失敗: {e}")
+        self._prune(keep=snapshot.directory)
+
+    def _prune(self, keep, max_snapshots=3):
+        """只保留最近的幾個快照版本"""
+        try:
+            entries = [
+                os.path.join(self.snapshot_dir, name)
+                for name in os.listdir(self.snapshot_dir)
+                if not name.startswith(('.', 'CURRENT'))
+            ]
+            entries = [path for path in entries if os.path.isdir(path) and path != keep]
+            entries.sort(key=os.path.getmtime, reverse=True)
+            for path in entries[max_snapshots - 1:]:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError as e:
+            print(f"清理舊品名清單快照失敗: {e}")
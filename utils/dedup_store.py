@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+import time
+import zlib
+from io import BytesIO
+from PIL import Image
+from .redis_client import get_redis
+
+# 感知雜湊索引的分段數（每段 8 位元）
+PHASH_BANDS = 8
+
+
+def perceptual_hash(data, hash_size=8):
+    """計算圖片的 dHash（64 位元），重新拍攝的同一張單據雜湊距離很小"""
+    try:
+        with Image.open(BytesIO(data)) as image:
+            # JPEG 可直接以縮小比例解碼，不必解出完整像素
+            image.draft('L', (hash_size * 8, hash_size * 8))
+            small = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+            pixels = list(small.getdata())
+    except Exception:
+        return None
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return f"{bits:016x}"
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+class DedupStore:
+    """以 Drive file_id、內容 SHA-256 與感知雜湊辨識重複提交，避免重跑整條流程"""
+
+    def __init__(self, enabled=None, result_ttl=None, file_ttl=None, max_entries=None, phash_distance=None):
+        if enabled is None:
+            enabled = os.getenv('DEDUP_ENABLED', '1') == '1'
+        self.enabled = enabled
+        # 內容快取需比 Celery 的 result_expires（1 小時）活得更久
+        self.result_ttl = result_ttl or int(os.getenv('DEDUP_RESULT_TTL', str(7 * 24 * 3600)))
+        # file_id 對應的任務只在其結果仍留在 Celery 後端時有效
+        self.file_ttl = file_ttl or int(os.getenv('DEDUP_FILE_TTL', '3600'))
+        self.max_entries = max_entries or int(os.getenv('DEDUP_MAX_ENTRIES', '5000'))
+        # 感知雜湊分段索引保證找得到距離 ≤ 7 的近似重複
+        self.phash_distance = phash_distance if phash_distance is not None else int(os.getenv('DEDUP_PHASH_DISTANCE', '6'))
+
+    def _redis(self):
+        if not self.enabled:
+            return None
+        try:
+            return get_redis()
+        except Exception as e:
+            print(f"去重快取不可用: {e}")
+            return None
+
+    # ---- /upload：以 file_id 去重 ----
+
+    def claim_file(self, file_id, task_id, replace=False):
+        """登記 file_id 對應的任務；已有進行中或已完成的任務時回傳其 task_id"""
+        client = self._redis()
+        if client is None or not file_id:
+            return None
+        key = f"dedup:file:{file_id}"
+        try:
+            if replace:
+                client.set(key, task_id, ex=self.file_ttl)
+                return None
+            if client.set(key, task_id, nx=True, ex=self.file_ttl):
+                return None
+            existing = client.get(key)
+            return existing.decode() if existing else None
+        except Exception as e:
+            print(f"登記 file_id 失敗: {e}")
+            return None
+
+    def release_file(self, file_id, task_id):
+        """任務失敗時釋放 file_id，讓重新提交能建立新任務"""
+        client = self._redis()
+        if client is None or not file_id:
+            return
+        key = f"dedup:file:{file_id}"
+        try:
+            if client.get(key) == task_id.encode():
+                client.delete(key)
+        except Exception as e:
+            print(f"釋放 file_id 失敗: {e}")
+
+    def add_waiting_webhook(self, task_id, webhook_url):
+        """重複提交的 webhook 等待既有任務完成後一併回調"""
+        client = self._redis()
+        if client is None or not webhook_url:
+            return False
+        try:
+            key = f"dedup:webhooks:{task_id}"
+            client.rpush(key, webhook_url)
+            client.expire(key, self.file_ttl)
+            return True
+        except Exception as e:
+            print(f"登記等待中的 webhook 失敗: {e}")
+            return False
+
+    def pop_waiting_webhooks(self, task_id):
+        client = self._redis()
+        if client is None:
+            return []
+        key = f"dedup:webhooks:{task_id}"
+        try:
+            pipe = client.pipeline()
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            urls, _ = pipe.execute()
+        except Exception as e:
+            print(f"讀取等待中的 webhook 失敗: {e}")
+            return []
+        return list(dict.fromkeys(url.decode() for url in urls))
+
+    # ---- process：以內容雜湊去重 ----
+
+    def fingerprint(self, data, file_type=None):
+        """計算內容 SHA-256 與感知雜湊（PDF 只用 SHA-256）"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        phash = perceptual_hash(data) if file_type != 'pdf' else None
+        return sha256, phash
+
+    def find_result(self, sha256):
+        """以內容 SHA-256 精確比對先前的結果；只有位元組完全相同的檔案才沿用"""
+        client = self._redis()
+        if client is None:
+            return None
+        try:
+            raw = client.get(f"dedup:result:{sha256}")
+            return self._decode(raw)
+        except Exception as e:
+            print(f"讀取去重快取失敗: {e}")
+            return None
+
+    @staticmethod
+    def _decode(raw):
+        return json.loads(zlib.decompress(raw)) if raw else None
+
+    @staticmethod
+    def _bands(phash):
+        """把 64 位元感知雜湊切成 8 段；距離 ≤ 7 的兩個雜湊至少有一段完全相同"""
+        return [f"dedup:phash:band:{band}:{phash[band * 2:band * 2 + 2]}" for band in range(PHASH_BANDS)]
+
+    def find_similar(self, phash, sha256=None):
+        """
+        以感知雜湊找出近似重拍的單據，回傳 {'task_id', 'sha256', 'distance'} 或 None。
+        只用來標記與連結兩份單據，不直接沿用其結果；只查詢共用雜湊分段的項目，不掃描全部
+        """
+        client = self._redis()
+        if client is None or not phash or self.phash_distance < 0:
+            return None
+        try:
+            pipe = client.pipeline()
+            for band_key in self._bands(phash):
+                pipe.smembers(band_key)
+            members = set().union(*pipe.execute())
+            best = None
+            for member in members:
+                candidate_phash, candidate_sha = member.decode().split(':', 1)
+                if candidate_sha == sha256:
+                    continue
+                distance = hamming_distance(phash, candidate_phash)
+                if distance <= self.phash_distance and (best is None or distance < best['distance']):
+                    best = {'sha256': candidate_sha, 'distance': distance}
+            if best is None:
+                return None
+            task_id = client.hget("dedup:phash:tasks", best['sha256'])
+        except Exception as e:
+            print(f"讀取感知雜湊索引失敗: {e}")
+            return None
+        best['task_id'] = task_id.decode() if task_id else None
+        print(f"找到近似重複的單據 {best['task_id']}（距離 {best['distance']}）")
+        return best
+
+    def store_result(self, sha256, phash, result):
+        """保存結果，超過數量上限或過期時淘汰最舊的項目"""
+        client = self._redis()
+        if client is None:
+            return
+        now = time.time()
+        member = f"{phash or '-'}:{sha256}"
+        try:
+            pipe = client.pipeline()
+            pipe.set(f"dedup:result:{sha256}", zlib.compress(json.dumps(result, ensure_ascii=False).encode('utf-8')), ex=self.result_ttl)
+            pipe.zadd("dedup:phash", {member: now})
+            pipe.hset("dedup:phash:tasks", sha256, result.get('task_id') or '')
+            if phash:
+                for band_key in self._bands(phash):
+                    pipe.sadd(band_key, member)
+                    pipe.expire(band_key, self.result_ttl)
+            pipe.zrangebyscore("dedup:phash", 0, now - self.result_ttl)
+            pipe.zcard("dedup:phash")
+            *_, expired, size = pipe.execute()
+
+            overflow = size - len(expired) - self.max_entries
+            evicted = list(expired)
+            if overflow > 0:
+                evicted += client.zrange("dedup:phash", len(expired), len(expired) + overflow - 1)
+            if evicted:
+                pipe = client.pipeline()
+                for evicted_member in evicted:
+                    evicted_phash, evicted_sha = evicted_member.decode().split(':', 1)
+                    pipe.delete(f"dedup:result:{evicted_sha}")
+                    pipe.hdel("dedup:phash:tasks", evicted_sha)
+                    if evicted_phash != '-':
+                        for band_key in self._bands(evicted_phash):
+                            pipe.srem(band_key, evicted_member)
+                pipe.zrem("dedup:phash", *evicted)
+                pipe.execute()
+        except Exception as e:
+            print(f"寫入去重快取失敗: {e}")
@@ -0,0 +1,236 @@
+import ast
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeVisionClient:
+    """離線用的 Vision 客戶端，可設定延遲與錯誤率，並記錄請求次數以觀察批次效果"""
+
+    def __init__(self, texts=None, default_text="", latency=0.05, per_image_latency=0.005, error_rate=0.0, seed=None):
+        # texts 可為 {圖片 SHA-256: 文字} 或 callable(content) -> 文字
+        self.texts = texts or {}
+        self.default_text = default_text
+        self.latency = latency
+        self.per_image_latency = per_image_latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.images = 0
+
+    def text_for(self, content):
+        if callable(self.texts):
+            return self.texts(content)
+        return self.texts.get(hashlib.sha256(content).hexdigest(), self.default_text)
+
+    def _response(self, content):
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+        if failed:
+            return SimpleNamespace(
+                error=SimpleNamespace(message='fake vision error'),
+                text_annotations=[],
+                full_text_annotation=SimpleNamespace(text='')
+            )
+        text = self.text_for(content)
+        return SimpleNamespace(
+            error=SimpleNamespace(message=''),
+            text_annotations=[SimpleNamespace(description=text)] if text else [],
+            full_text_annotation=SimpleNamespace(text=text)
+        )
+
+    @staticmethod
+    def _content(request):
+        if isinstance(request, dict):
+            return request['image']['content']
+        return request.image.content
+
+    def batch_annotate_images(self, requests=None, **kwargs):
+        requests = list(requests or [])
+        with self._lock:
+            self.calls += 1
+            self.images += len(requests)
+        time.sleep(self.latency + self.per_image_latency * len(requests))
+        return SimpleNamespace(responses=[self._response(self._content(request)) for request in requests])
+
+    def text_detection(self, image=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.images += 1
+        time.sleep(self.latency + self.per_image_latency)
+        return self._response(image.content)
+
+    document_text_detection = text_detection
+
+
+class FakeUpstreamError(Exception):
+    """假上游的暫時性錯誤（code 503，會被視為可重試）"""
+
+    code = 503
+
+
+class FakeGenerativeModel:
+    """離線用的 Gemini 模型：從提示中的候選清單選出第一個品名，可設定延遲與錯誤率，並記錄呼叫次數與提示大小"""
+
+    def __init__(self, model_name='fake', latency=0.3, per_kb_latency=0.01, error_rate=0.0, score=0.8, seed=None):
+        self.model_name = model_name
+        self.latency = latency
+        self.per_kb_latency = per_kb_latency
+        self.error_rate = error_rate
+        self.score = score
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.prompt_bytes = 0
+
+    def _answer(self, prompt):
+        # 批次提示：「查詢清單：」後為 JSON 陣列；單筆提示：「品名清單：」後為 Python 串列
+        if '查詢清單：' in prompt:
+            entries = json.loads(prompt.split('查詢清單：', 1)[1])
+            return json.dumps([
+                {'id': entry['id'], 'matched_name': entry['candidates'][0], 'score': self.score}
+                for entry in entries if entry.get('candidates')
+            ], ensure_ascii=False)
+        candidates = ast.literal_eval(prompt.split('品名清單：', 1)[1].strip())
+        if not candidates:
+            return '{}'
+        return json.dumps({'matched_name': candidates[0], 'score': self.score}, ensure_ascii=False)
+
+    def generate_content(self, prompt, **kwargs):
+        size = len(prompt.encode('utf-8'))
+        with self._lock:
+            self.calls += 1
+            self.prompt_bytes += size
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        time.sleep(self.latency + self.per_kb_latency * size / 1024)
+        if failed:
+            raise FakeUpstreamError('503 fake gemini unavailable')
+        return SimpleNamespace(text=self._answer(prompt))
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b'', content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.owner.handle_get(self)
+
+    def do_POST(self):
+        self.server.owner.handle_post(self)
+
+
+class FakeHttpServer:
+    """在背景執行緒啟動的本機 HTTP 服務，可設定延遲與錯誤率（錯誤時回 error_status）"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=503, host='127.0.0.1', port=0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self._server = ThreadingHTTPServer((host, port), _FakeHandler)
+        self._server.daemon_threads = True
+        self._server.owner = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _begin(self, handler):
+        """計數並模擬延遲；回傳 False 表示本次注入錯誤且已回應"""
+        with self._lock:
+            self.requests += 1
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        time.sleep(self.latency)
+        if failed:
+            handler._reply(self.error_status, b'{"error": "injected"}')
+            return False
+        return True
+
+    def handle_get(self, handler):
+        handler._reply(404)
+
+    def handle_post(self, handler):
+        handler._reply(404)
+
+
+class FakeDriveServer(FakeHttpServer):
+    """模擬 Google Drive 的 /uc?export=download&id= 下載端點（設定 GOOGLE_DRIVE_DOWNLOAD_URL 為 download_url）"""
+
+    def __init__(self, files=None, **kwargs):
+        super().__init__(**kwargs)
+        self.files = dict(files or {})
+
+    @property
+    def download_url(self):
+        return f"{self.url}/uc"
+
+    def add_file(self, file_id, data):
+        self.files[file_id] = data
+        return f"https://drive.google.com/file/d/{file_id}/view"
+
+    def handle_get(self, handler):
+        if not self._begin(handler):
+            return
+        parsed = urlparse(handler.path)
+        file_id = parse_qs(parsed.query).get('id', [''])[0]
+        data = self.files.get(file_id)
+        if parsed.path != '/uc' or data is None:
+            handler._reply(404, b'not found', 'text/html')
+            return
+        handler._reply(200, data, 'application/octet-stream')
+
+
+class FakeWebhookReceiver(FakeHttpServer):
+    """模擬 n8n 的 resume webhook：接受任何路徑的 POST，記錄收到的內容大小與路徑"""
+
+    def __init__(self, error_status=500, **kwargs):
+        super().__init__(error_status=error_status, **kwargs)
+        self.received = []
+
+    def handle_post(self, handler):
+        body = handler.rfile.read(int(handler.headers.get('Content-Length') or 0))
+        if not self._begin(handler):
+            return
+        with self._lock:
+            self.received.append({'path': handler.path, 'bytes': len(body), 'at': time.time()})
+        handler._reply(200, b'{"ok": true}')
@@ -1,21 +1,104 @@
 import os
+import time
 import uuid
 
 class FileManager:
-    def __init__(self, upload_folder='uploads'):
+    def __init__(self, upload_folder='uploads', spool_enabled=None, max_spool_bytes=None, spool_ttl=None):
         self.upload_folder = upload_folder
+        self.spool_folder = os.path.join(upload_folder, 'spool')
+        # 分階段處理時，階段之間以共用 volume 上的檔案傳遞圖片，broker 只傳檔名
+        self.blob_folder = os.path.join(upload_folder, 'blobs')
+        self.blob_ttl = int(os.getenv('OCR_BLOB_TTL', '3600'))
+        # 預設不落地；開啟後圖片會保留在 spool 目錄供除錯/存檔，並依 TTL 與容量上限清理
+        if spool_enabled is None:
+            spool_enabled = os.getenv('OCR_SPOOL_ENABLED', '0') == '1'
+        self.spool_enabled = spool_enabled
+        self.max_spool_bytes = max_spool_bytes or int(os.getenv('OCR_SPOOL_MAX_BYTES', str(500 * 1024 * 1024)))
+        self.spool_ttl = spool_ttl or int(os.getenv('OCR_SPOOL_TTL', str(24 * 3600)))
+        self.sweep_interval = 60
+        self._last_sweep = {}
         os.makedirs(self.upload_folder, exist_ok=True)
     
-    def save_image(self, image_data, file_extension):
+    def generate_filename(self, file_extension):
+        """產生唯一檔名"""
+        return f"{str(uuid.uuid4())}.{file_extension}"
+    
+    def save_image(self, image_data, file_extension, unique_filename=None, folder=None):
         """保存圖片到臨時文件並返回路徑"""
-        unique_filename = f"{str(uuid.uuid4())}.{file_extension}"
-        file_path = os.path.join(self.upload_folder, unique_filename)
+        unique_filename = unique_filename or self.generate_filename(file_extension)
+        file_path = os.path.join(folder or self.upload_folder, unique_filename)
         
         with open(file_path, 'wb') as f:
             f.write(image_data)
             
         return file_path, unique_filename
     
+    def spool(self, image_data, file_extension, unique_filename=None):
+        """開啟落地模式時保存圖片，並順便清理過期或超量的檔案"""
+        if not self.spool_enabled:
+            return None
+        os.makedirs(self.spool_folder, exist_ok=True)
+        self.sweep()
+        file_path, _ = self.save_image(image_data, file_extension, unique_filename, folder=self.spool_folder)
+        return file_path
+    
+    def sweep(self, force=False):
+        """刪除超過 TTL 的檔案，總容量超過上限時從最舊的開始刪除"""
+        return self._sweep(self.spool_folder, self.spool_ttl, self.max_spool_bytes, force)
+    
+    def _sweep(self, folder, ttl, max_bytes=None, force=False):
+        now = time.time()
+        if not force and now - self._last_sweep.get(folder, 0) < self.sweep_interval:
+            return 0
+        self._last_sweep[folder] = now
+        
+        if not os.path.isdir(folder):
+            return 0
+        entries = []
+        for name in os.listdir(folder):
+            file_path = os.path.join(folder, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            if os.path.isfile(file_path):
+                entries.append((stat.st_mtime, stat.st_size, file_path))
+        
+        removed = 0
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, file_path in sorted(entries):
+            if now - mtime <= ttl and (max_bytes is None or total <= max_bytes):
+                break
+            if self.cleanup(file_path):
+                removed += 1
+                total -= size
+        return removed
+    
+    def put_blob(self, data):
+        """保存階段之間傳遞的內容，回傳檔名作為參照"""
+        os.makedirs(self.blob_folder, exist_ok=True)
+        # 中途失敗的任務不會刪除自己的檔案，依 TTL 清理
+        self._sweep(self.blob_folder, self.blob_ttl)
+        blob_id = uuid.uuid4().hex
+        temp_path = os.path.join(self.blob_folder, f".{blob_id}.tmp")
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, os.path.join(self.blob_folder, blob_id))
+        return blob_id
+    
+    def read_blob(self, blob_id):
+        with open(self._blob_path(blob_id), 'rb') as f:
+            return f.read()
+    
+    def delete_blob(self, blob_id):
+        return self.cleanup(self._blob_path(blob_id))
+    
+    def _blob_path(self, blob_id):
+        # 參照來自 broker 上的訊息，只接受 put_blob 產生的檔名
+        if not blob_id or os.path.basename(blob_id) != blob_id or blob_id.startswith('.'):
+            raise ValueError(f'無效的暫存檔參照: {blob_id}')
+        return os.path.join(self.blob_folder, blob_id)
+    
     def cleanup(self, file_path):
         """清理臨時文件"""
         try:
@@ -0,0 +1,74 @@
+from io import BytesIO
+from PIL import Image
+
+HEIC_BRANDS = {b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1'}
+
+
+def sniff_file_type(data):
+    """依檔頭 magic bytes 判斷檔案格式，不需解碼"""
+    head = bytes(data[:16])
+    if head.startswith(b'%PDF-'):
+        return 'pdf'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    if head[4:8] == b'ftyp' and head[8:12] in HEIC_BRANDS:
+        return 'heic'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:2] == b'BM':
+        return 'bmp'
+    return None
+
+
+def read_image_header(data):
+    """只解析檔頭取得 (寬, 高, 格式)，不解碼像素"""
+    try:
+        # PIL 的 Image.open 只讀取檔頭，直到 load() 才會解碼
+        with Image.open(BytesIO(data)) as image:
+            return image.width, image.height, image.format
+    except Exception:
+        return None, None, None
+
+
+def convert_heic_to_jpeg(data, quality=90):
+    """Vision 不支援 HEIC，轉成 JPEG（需要 pillow-heif）"""
+    try:
+        from pillow_heif import register_heif_opener
+    except ImportError:
+        raise ValueError('不支援 HEIC 格式，請安裝 pillow-heif 或改用 JPEG/PNG')
+    register_heif_opener()
+    with Image.open(BytesIO(data)) as image:
+        buffer = BytesIO()
+        image.convert('RGB').save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+class LazyImage:
+    """保存圖片位元組與檔頭資訊，需要像素時才解碼"""
+
+    def __init__(self, data, width=None, height=None, format=None):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.format = format
+        self._image = None
+
+    @classmethod
+    def from_bytes(cls, data):
+        width, height, format = read_image_header(data)
+        return cls(data, width, height, format)
+
+    @property
+    def image(self):
+        """第一次存取時才完整解碼"""
+        if self._image is None:
+            image = Image.open(BytesIO(self.data))
+            image.load()
+            self._image = image
+        return self._image
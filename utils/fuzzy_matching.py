@@ -1,64 +1,381 @@
 import os
 from dotenv import load_dotenv
-import pandas as pd
-import re
-import google.generativeai as genai
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import json
+from .candidate_index import NgramIndex, extract_chinese_name, normalize_text
+from .alias_store import AliasStore, alias_key
+from .catalog import CatalogLoader
+from .match_cache import MatchCache
+from .match_backends import MatchBackend, create_backend
+from .resilience import UpstreamUnavailable, estimate_tokens, get_upstream
+from .metrics import LLM_CALLS, LLM_PROMPT_BYTES, MATCH_ALIAS, MATCH_SECONDS, span
 
 load_dotenv()  # 讀取 .env
 
-def extract_chinese_name(text):
-    match = re.match(r'^([\u4e00-\u9fff]+)', text)
-    if match:
-        return match.group(1)
-    return text
+# 同一個品名清單版本的快照、候選索引與本地後端；熱替換時整組以單一屬性指派替換，
+# 匹配執行緒在每次呼叫開始時取用一組，不會讀到新舊混雜的狀態
+CatalogState = namedtuple("CatalogState", ["snapshot", "index", "backend"])
+
+NO_CANDIDATES_ERROR = "品名清單中沒有相似的品名"
+
 class OrderFuzzyMatcher:
-    def __init__(self, path, model="gemini-2.0-flash"):
+    def __init__(self, path, model="gemini-2.0-flash", candidate_k=None, backend=None, aliases=None):
         self.path = path
-        self.items = self._load_items()
-        self.item_names = self.items['品名'].tolist()
-        gemini_api_key = os.environ.get("GEMINI_API_KEY")
-        genai.configure(api_key=gemini_api_key)
+        self.candidate_k = candidate_k or int(os.environ.get("MATCH_CANDIDATE_K", "30"))
+        # 本地匹配後端：分數與差距都夠高時直接採用，否則才交給 LLM
+        self._backend_name = backend or os.environ.get("MATCH_BACKEND", "local")
+        self.local_threshold = float(os.environ.get("MATCH_LOCAL_THRESHOLD", "0.85"))
+        self.local_margin = float(os.environ.get("MATCH_LOCAL_MARGIN", "0.1"))
+        self.batch_size = int(os.environ.get("MATCH_BATCH_SIZE", "25"))
+        self.batch_retries = int(os.environ.get("MATCH_BATCH_RETRIES", "1"))
+        # 多行匹配模式：batch 合併成批次請求、concurrent 逐行並行、sequential 逐行依序
+        self.match_mode = os.environ.get("MATCH_MODE", "batch")
+        self.concurrency = int(os.environ.get("MATCH_CONCURRENCY", "8"))
+        # 人工修正學到的別名表，在索引、本地後端與 LLM 之前查詢
+        self.aliases = aliases if aliases is not None else AliasStore()
+        self.alias_score = float(os.environ.get("ALIAS_MATCH_SCORE", "0.95"))
+        # 確認次數不足的別名仍採用，但分數低於修正表單的門檻，讓人工再檢查一次
+        self.alias_confirmed_count = int(os.environ.get("ALIAS_CONFIRMED_COUNT", "2"))
+        self.alias_unconfirmed_score = float(os.environ.get("ALIAS_UNCONFIRMED_SCORE", "0.65"))
+        self.cache = None
+        self._swap_lock = threading.Lock()
+        # 品名清單以編譯後的快照載入，來源檔變更時熱替換
+        self.catalog = CatalogLoader(self.path)
+        self._apply_snapshot(self.catalog.snapshot)
         self.model = model
+        self._generative_model = None
+        self._model_pid = None
+        # 所有 worker 共用 Gemini 的限流、重試與熔斷
+        self.upstream = get_upstream("gemini")
+
+    def _apply_snapshot(self, snapshot):
+        """依快照建立索引與後端，整組替換後再切換快取命名空間"""
+        # n-gram 索引直接使用快照中的倒排表，每次查詢只把前 K 個候選品名送進 LLM
+        index = NgramIndex.from_snapshot(snapshot)
+        if isinstance(self._backend_name, MatchBackend):
+            backend = self._backend_name
+        else:
+            backend = create_backend(self._backend_name, snapshot)
+        self._state = CatalogState(snapshot, index, backend)
+        # 快取以品名清單檔的雜湊區分版本，修改 CSV 後舊的快取自動失效
+        if self.cache is None:
+            self.cache = MatchCache(namespace=snapshot.version[:16])
+        else:
+            self.cache.reset(namespace=snapshot.version[:16])
+
+    @property
+    def snapshot(self):
+        return self._state.snapshot
+
+    @property
+    def index(self):
+        return self._state.index
+
+    @property
+    def backend(self):
+        return self._state.backend
+
+    @property
+    def item_names(self):
+        return self._state.snapshot.names
+
+    @property
+    def catalog_hash(self):
+        return self._state.snapshot.version
 
-    def _load_items(self):
+    def refresh_catalog(self):
+        """來源檔變更時熱替換快照，不需重啟 worker"""
+        snapshot = self.catalog.current()
+        if snapshot is not self.snapshot:
+            with self._swap_lock:
+                if snapshot is not self.snapshot:
+                    print(f"品名清單已更新，切換至版本 {snapshot.version[:16]}")
+                    self._apply_snapshot(snapshot)
+
+    def lookup_product_id(self, matched_name):
+        """以雜湊索引查詢品名對應的品號"""
+        return self.snapshot.lookup_product_id(matched_name)
+
+    def get_candidates(self, query, ranked=None, state=None):
+        """從索引中篩選出前 K 個候選品名，並併入本地後端的高分結果"""
+        state = state or self._state
+        candidates = [match['matched_name'] for match in ranked or []]
+        candidates.extend(name for name, _ in state.index.search(query, top_k=self.candidate_k))
+        return list(dict.fromkeys(candidates))[:self.candidate_k]
+
+    def _match_local(self, query, state=None):
+        """以本地後端評分，回傳 (可直接採用的結果或 None, 排序結果)"""
+        backend = (state or self._state).backend
+        if backend is None:
+            return None, []
+        ranked = backend.rank(query, top_k=5)
+        if not ranked:
+            return None, ranked
+        best = ranked[0]
+        runner_up = ranked[1]['score'] if len(ranked) > 1 else 0.0
+        if best['score'] >= self.local_threshold and best['score'] - runner_up >= self.local_margin:
+            return {'matched_name': best['matched_name'], 'score': best['score'], 'source': backend.name}, ranked
+        return None, ranked
+
+    def cache_key(self, query):
+        """快取鍵：取出中文品名後正規化"""
+        return normalize_text(extract_chinese_name(query))
+
+    def _match_aliases(self, queries, state=None):
+        """
+        以完整品名查詢別名表，回傳與 queries 順序一致的列表（未命中為 None）；
+        品號已不在目前品名清單中的別名不採用
+        """
+        snapshot = (state or self._state).snapshot
+        keys = [alias_key(query) for query in queries]
         try:
-            items = pd.read_csv(self.path, dtype=str, encoding="big5")
-        except UnicodeDecodeError:
-            import chardet
-            with open(self.path, "rb") as f:
-                result = chardet.detect(f.read())
-                encoding = result["encoding"]
-            items = pd.read_csv(self.path, dtype=str, encoding=encoding)
-        return items
+            found = self.aliases.lookup_many(keys)
+        except Exception as e:
+            print(f"別名表不可用: {e}")
+            return [None] * len(queries)
+        resolved = {}
+        for key in dict.fromkeys(keys):
+            alias = found.get(key)
+            matched_name = snapshot.lookup_name(alias['product_id']) if alias else ""
+            if matched_name:
+                resolved[key] = {
+                    "matched_name": matched_name,
+                    "product_id": alias['product_id'],
+                    "score": self.alias_score if alias['count'] >= self.alias_confirmed_count else self.alias_unconfirmed_score,
+                    "source": "alias"
+                }
+        hits = len(resolved)
+        MATCH_ALIAS.labels("hit").inc(hits)
+        MATCH_ALIAS.labels("miss").inc(len(set(keys)) - hits)
+        return [resolved.get(key) for key in keys]
+
+    def cache_stats(self):
+        """回傳匹配快取的命中統計"""
+        return self.cache.stats()
 
     def fuzzy_match_items(self, query, top_k=1):
-        query = extract_chinese_name(query)
+        with MATCH_SECONDS.labels("single").time():
+            self.refresh_catalog()
+            state = self._state
+            alias_match = self._match_aliases([query], state)[0]
+            if alias_match:
+                return alias_match
+            return self._match_one(extract_chinese_name(query), state)
+
+    def _match_one(self, query, state=None):
+        state = state or self._state
+        local_match, ranked = self._match_local(query, state)
+        if local_match:
+            return local_match
+        return self.cache.get_or_compute(self.cache_key(query), lambda: self._match_single(query, ranked, state))
+
+    def _match_single(self, query, ranked=None, state=None):
+        candidates = self.get_candidates(query, ranked, state)
+        if not candidates:
+            # 與任何品名都沒有共同字元，不需要呼叫 LLM；帶 error 讓這一行留給人工修正
+            return {"error": NO_CANDIDATES_ERROR}
         prompt = (
             f"請根據語意，從下列商品品名清單中找出最接近「{query}」的品名，"
             "只回傳一個最接近的結果，格式為：\n"
             "{\"matched_name\": 品名, \"score\": 分數}\n"
-            f"品名清單：{self.item_names}"
+            f"品名清單：{candidates}"
         )
-        model = genai.GenerativeModel(self.model)
-        response = model.generate_content(prompt)
+        response = self._call_llm("single", prompt)
         content = response.text
         print("LLM 回傳內容：", content)
-        start = content.find('{')
-        end = content.rfind('}')
-        if start != -1 and end != -1:
-            json_str = content[start:end+1]
-            try:
-                result = json.loads(json_str)
-            except Exception:
-                result = {}
+        match = _parse_json(content, '{', '}')
+        if not isinstance(match, dict) or not match.get("matched_name"):
+            return {"error": "LLM 回傳內容無法解析"}
+        return match
+
+    def match_many(self, queries, mode=None):
+        """依 MATCH_MODE 匹配多個品項，回傳與 queries 順序一致的結果列表"""
+        mode = mode or self.match_mode
+        with MATCH_SECONDS.labels(mode).time():
+            return self._match_many(queries, mode)
+
+    def _match_many(self, queries, mode):
+        if mode == "concurrent":
+            return self.fuzzy_match_items_concurrent(queries)
+        if mode == "sequential":
+            return self.fuzzy_match_items_concurrent(queries, max_in_flight=1)
+        if mode != "batch":
+            raise ValueError(f"不支援的匹配模式: {mode}")
+        try:
+            return self.fuzzy_match_items_batch(queries)
+        except UpstreamUnavailable:
+            raise
+        except Exception as e:
+            print(f"批次匹配失敗: {e}")
+            return [{"error": str(e)} for _ in queries]
+
+    def fuzzy_match_items_concurrent(self, queries, max_in_flight=None):
+        """
+        逐行並行匹配，同時進行的查詢數不超過 max_in_flight。
+        單行失敗只會讓該行的結果帶有 error，不影響其他行。
+        """
+        self.refresh_catalog()
+        state = self._state
+        max_in_flight = max(1, max_in_flight or self.concurrency)
+        aliased = self._match_aliases(queries, state)
+        keys = [self.cache_key(query) for query in queries]
+        resolved = {}
+        unique_keys = list(dict.fromkeys(key for key, alias in zip(keys, aliased) if not alias))
+        if max_in_flight == 1 or len(unique_keys) <= 1:
+            for key in unique_keys:
+                resolved[key] = self._match_isolated(key, state)
         else:
-            result = {}
-        return result
+            with ThreadPoolExecutor(max_workers=min(max_in_flight, len(unique_keys)), thread_name_prefix="match") as executor:
+                results = executor.map(lambda key: self._match_isolated(key, state), unique_keys)
+                for key, result in zip(unique_keys, results):
+                    resolved[key] = result
+        return [dict(alias or resolved.get(key) or {}) for key, alias in zip(keys, aliased)]
+
+    def _match_isolated(self, key, state=None):
+        try:
+            return self._match_one(key, state)
+        except UpstreamUnavailable:
+            # 上游不可用時整個任務稍後重試，而不是把每一行都標成失敗
+            raise
+        except Exception as e:
+            print(f"匹配「{key}」失敗: {e}")
+            return {"error": str(e)}
+
+    def fuzzy_match_items_batch(self, queries, chunk_size=None, max_retries=None):
+        """以單次 LLM 請求批次匹配多個品項，回傳與 queries 順序一致的結果列表"""
+        self.refresh_catalog()
+        state = self._state
+        # 別名表以完整品名比對；其餘相同品名只查一次，結果再對應回所有行
+        aliased = self._match_aliases(queries, state)
+        keys = [self.cache_key(query) for query in queries]
+        resolved = {}
+        rankings = {}
+        pending = list(dict.fromkeys(key for key, alias in zip(keys, aliased) if not alias))
+        for key in pending:
+            local_match, rankings[key] = self._match_local(key, state)
+            if local_match:
+                resolved[key] = local_match
+
+        missing = [key for key in pending if key not in resolved]
+        if missing:
+            resolved.update(self.cache.get_or_compute_many(
+                missing,
+                lambda names: self._match_batch(names, chunk_size, max_retries, rankings, state)
+            ))
+        return [dict(alias or resolved.get(key) or {}) for key, alias in zip(keys, aliased)]
+
+    def _match_batch(self, names, chunk_size=None, max_retries=None, rankings=None, state=None):
+        """批次呼叫 LLM 匹配快取未命中的品名，回傳 {品名: 匹配結果}"""
+        chunk_size = chunk_size or self.batch_size
+        max_retries = self.batch_retries if max_retries is None else max_retries
+        rankings = rankings or {}
+        results = {}
+        pending = []
+        for name in names:
+            candidates = self.get_candidates(name, rankings.get(name), state)
+            if candidates:
+                pending.append((name, candidates))
+            else:
+                results[name] = {"error": NO_CANDIDATES_ERROR}
+
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            for _ in range(max_retries + 1):
+                answered = self._match_chunk(chunk)
+                for entry_id, (name, _) in enumerate(chunk):
+                    if entry_id in answered:
+                        results[name] = answered[entry_id]
+                # 只重送模型漏掉或請求失敗的項目
+                chunk = [
+                    entry for entry_id, entry in enumerate(chunk)
+                    if not answered.get(entry_id, {}).get("matched_name")
+                ]
+                if not chunk:
+                    break
+            # 重試後仍沒有結果的項目標記錯誤（不寫入快取），留給人工修正而不是從品項中消失
+            for name, _ in chunk:
+                results.setdefault(name, {"error": "LLM 未回傳此品項的匹配結果"})
+        return results
+
+    def _match_chunk(self, chunk):
+        """送出一個批次請求，回傳 {項目編號: 匹配結果}；請求失敗時每個項目都帶有 error"""
+        entries = [
+            {"id": entry_id, "query": name, "candidates": candidates}
+            for entry_id, (name, candidates) in enumerate(chunk)
+        ]
+        prompt = (
+            "請根據語意，為下列每個查詢從其 candidates 品名清單中找出最接近的品名，"
+            "每個查詢只回傳一個最接近的結果。只回傳 JSON 陣列，每個元素格式為：\n"
+            "{\"id\": 編號, \"matched_name\": 品名, \"score\": 分數}\n"
+            f"查詢清單：{json.dumps(entries, ensure_ascii=False)}"
+        )
+        try:
+            response = self._call_llm(
+                "batch",
+                prompt,
+                generation_config={"response_mime_type": "application/json"}
+            )
+            content = response.text
+        except UpstreamUnavailable:
+            raise
+        except Exception as e:
+            print(f"LLM 批次匹配失敗: {e}")
+            return {entry_id: {"error": str(e)} for entry_id in range(len(chunk))}
+        print("LLM 批次回傳內容：", content)
+
+        answered = {}
+        for result in _parse_json(content, '[', ']') or []:
+            if not isinstance(result, dict) or not result.get("matched_name"):
+                continue
+            try:
+                entry_id = int(result.get("id"))
+            except (TypeError, ValueError):
+                continue
+            if 0 <= entry_id < len(chunk):
+                answered[entry_id] = {
+                    "matched_name": result["matched_name"],
+                    "score": result.get("score")
+                }
+        return answered
+
+    def _call_llm(self, kind, prompt, **kwargs):
+        """經由上游包裝呼叫 Gemini，並記錄耗時、呼叫次數與提示大小"""
+        LLM_PROMPT_BYTES.labels(kind).inc(len(prompt.encode("utf-8")))
+        try:
+            with span("gemini"):
+                response = self.upstream.call(self._get_model().generate_content, prompt, cost=estimate_tokens(prompt), **kwargs)
+        except Exception:
+            LLM_CALLS.labels(kind, "error").inc()
+            raise
+        LLM_CALLS.labels(kind, "ok").inc()
+        return response
+
+    def _get_model(self):
+        """重複使用同一個 GenerativeModel 實例；第一次使用才載入 SDK，fork 後的子進程重新建立"""
+        if self._generative_model is None or self._model_pid != os.getpid():
+            import google.generativeai as genai
+            genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+            self._generative_model = genai.GenerativeModel(self.model)
+            self._model_pid = os.getpid()
+        return self._generative_model
+
+
+def _parse_json(content, open_char, close_char):
+    """從 LLM 回傳內容中擷取 JSON 物件或陣列"""
+    start = content.find(open_char)
+    end = content.rfind(close_char)
+    if start == -1 or end == -1:
+        return None
+    try:
+        return json.loads(content[start:end+1])
+    except Exception:
+        return None
 
 # 使用範例
 if __name__ == "__main__":
     matcher = OrderFuzzyMatcher("./客戶訂單資料.csv")
-    print(matcher.items.head())
+    print(matcher.item_names[:5])
     result = matcher.fuzzy_match_items("東坡肉12x1242瑰")
     print(result)
\ No newline at end of file
@@ -1,14 +1,48 @@
+import os
+from io import BytesIO
 import re
 import requests
-from io import BytesIO
-from PIL import Image
-from pdf2image import convert_from_bytes  # 確保已安裝 pdf2image 和 poppler
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .file_sniffer import sniff_file_type, convert_heic_to_jpeg, LazyImage
+from .pdf_renderer import PdfRenderer
+from .metrics import span
+
+DRIVE_DOWNLOAD_URL = "https://drive.google.com/uc"
+CHUNK_SIZE = 64 * 1024
+# 確認頁只是一份小 HTML，讀取上限避免誤把大檔案當成 HTML 讀完
+CONFIRM_PAGE_LIMIT = 512 * 1024
+
+# 每個 worker 進程共用一個 Session（fork 後重新建立）
+_sessions = {}
+
+
+def get_session():
+    """取得當前進程共用、保持連線的 requests.Session"""
+    pid = os.getpid()
+    session = _sessions.get(pid)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=int(os.getenv('DRIVE_POOL_SIZE', '10')),
+            max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=['GET'])
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _sessions[pid] = session
+    return session
+
 
 class GoogleDriveDownloader:
-    def __init__(self, max_file_size=20 * 1024 * 1024):
+    def __init__(self, max_file_size=20 * 1024 * 1024, session=None, pdf_renderer=None):
         self.max_file_size = max_file_size
+        self.session = session
+        self.pdf_renderer = pdf_renderer or PdfRenderer()
+        self.download_url = os.getenv('GOOGLE_DRIVE_DOWNLOAD_URL', DRIVE_DOWNLOAD_URL)
     
-    def extract_file_id(self, url):
+    @staticmethod
+    def extract_file_id(url):
         """從Google Drive URL中提取文件ID"""
         patterns = [
             r'/file/d/([a-zA-Z0-9-_]+)',
@@ -22,67 +56,128 @@ class GoogleDriveDownloader:
         return None
     
     def download(self, google_drive_url):
-        """下載Google Drive文件，如果是PDF則轉換為圖片，返回圖片數據和格式"""
+        """下載Google Drive文件，返回文件數據、格式與頁數（PDF 頁面由 iter_pages 轉換）"""
         file_id = self.extract_file_id(google_drive_url)
         if not file_id:
             raise ValueError('無效的Google Drive URL')
         
-        # 構建下載URL
-        download_url = f"https://drive.google.com/uc?export=download&id={file_id}"
-        
-        # 下載文件
-        response = requests.get(download_url, stream=True, timeout=30)
-        response.raise_for_status()
-        
-        # 檢查文件大小
-        file_data = response.content
-        if len(file_data) > self.max_file_size:
-            raise ValueError(f'文件大小超過{self.max_file_size/1024/1024}MB限制')
-        
-        # 判斷文件類型
-        try:
-            image = Image.open(BytesIO(file_data))
-            image.verify()
-            image = Image.open(BytesIO(file_data))
-            file_extension = image.format.lower() if image.format else 'png'
-            image_data = file_data  # 保存原始圖片數據
-            file_type = "image"
-        except Exception:
-            file_type = "pdf"
-
-        if file_type == "image":
-            image = Image.open(BytesIO(file_data))
-            image.verify()
-            image = Image.open(BytesIO(file_data))
-            file_extension = image.format.lower() if image.format else 'png'
-            image_data = file_data
-        elif file_type == "pdf":
-            try:
-                images = convert_from_bytes(file_data)
-                if not images:
-                    raise ValueError('PDF轉換為圖片失敗')
-                
-                # 使用第一頁作為圖片
-                image = images[0]
-                file_extension = 'png'
-                
-                # 將圖片保存到內存中
-                image_buffer = BytesIO()
-                image.save(image_buffer, format='PNG')
-                image_data = image_buffer.getvalue()
-                
-            except Exception as e:
-                raise ValueError(f'文件不是有效的圖片或PDF格式: {e}')
+        # 串流下載文件，超過大小限制立即中止
+        with span('drive_fetch'):
+            file_data = self.fetch(file_id)
+        return self.describe(file_data, file_id)
+
+    def describe(self, file_data, file_id=None):
+        """由文件內容建立下載資訊（分階段處理時，OCR 階段以此還原下載階段的結果）"""
+        with span('decode'):
+            return self._describe(file_data, file_id)
+
+    def _describe(self, file_data, file_id):
+        # 以檔頭判斷文件類型，不需先嘗試解碼
+        file_type = sniff_file_type(file_data)
+        if file_type is None:
+            raise ValueError('文件不是有效的圖片或PDF格式')
+
+        if file_type == "pdf":
+            # PDF 只讀取頁數，頁面留到 iter_pages 時才逐批轉換
+            page_count = self.pdf_renderer.page_count(file_data)
+            image = LazyImage(file_data, format='PDF')
+            file_extension = 'pdf'
         else:
-            raise ValueError(f'文件不是有效的圖片或PDF格式')
+            if file_type == "heic":
+                file_data = convert_heic_to_jpeg(file_data)
+                file_type = "jpeg"
+            # 只讀取檔頭的尺寸與格式，像素留到真正需要時才解碼
+            image = LazyImage.from_bytes(file_data)
+            file_extension = file_type
+            page_count = 1
             
         return {
             'file_id': file_id,
-            'image_data': image_data,
+            'file_type': file_type,
+            'image_data': file_data,
             'image': image,
             'file_extension': file_extension,
-            'file_size': len(image_data),
+            'file_size': len(file_data),
+            'page_count': page_count,
             'width': image.width,
             'height': image.height,
-            'format': image.format
-        }
\ No newline at end of file
+            'format': image.format or file_type.upper()
+        }
+
+    def iter_pages(self, download_info):
+        """依序產生 (頁碼, LazyImage)；PDF 逐批轉換，圖片只有一頁"""
+        if download_info.get('file_type') == 'pdf':
+            yield from self.pdf_renderer.iter_pages(download_info['image_data'], download_info.get('page_count'))
+        else:
+            yield 1, download_info['image']
+
+    def fetch(self, file_id):
+        """串流下載 Drive 文件內容，必要時處理大檔案的確認頁"""
+        session = self.session or get_session()
+        response = session.get(
+            self.download_url,
+            params={'export': 'download', 'id': file_id},
+            stream=True,
+            timeout=(10, 30)
+        )
+        try:
+            response.raise_for_status()
+            # 大檔案會先回傳病毒掃描警告頁，取得確認參數後才是真正的檔案
+            if self._is_confirm_page(response):
+                url, params = self._confirm_request(response, file_id)
+                response.close()
+                response = session.get(url, params=params, stream=True, timeout=(10, 30))
+                response.raise_for_status()
+                if self._is_confirm_page(response):
+                    raise ValueError('無法從 Google Drive 下載文件，請確認檔案已公開分享')
+            return self._read_limited(response)
+        finally:
+            response.close()
+
+    def _is_confirm_page(self, response):
+        content_type = response.headers.get('Content-Type', '')
+        disposition = response.headers.get('Content-Disposition', '')
+        return content_type.startswith('text/html') and 'attachment' not in disposition
+
+    def _confirm_request(self, response, file_id):
+        """從確認頁解析下載表單或 confirm token"""
+        html = self._read_limited(
+            response,
+            limit=CONFIRM_PAGE_LIMIT,
+            error=f'Google Drive 確認頁超過 {CONFIRM_PAGE_LIMIT // 1024}KB，無法解析下載連結'
+        ).decode('utf-8', errors='ignore')
+
+        form = re.search(r'<form[^>]+id="download-form"[^>]+action="([^"]+)"(.*?)</form>', html, re.S)
+        if form:
+            params = dict(re.findall(r'<input[^>]+name="([^"]+)"[^>]+value="([^"]*)"', form.group(2)))
+            return form.group(1).replace('&amp;', '&'), params
+
+        token = None
+        for name, value in response.cookies.items():
+            if name.startswith('download_warning'):
+                token = value
+                break
+        if token is None:
+            match = re.search(r'confirm=([0-9A-Za-z_-]+)', html)
+            token = match.group(1) if match else None
+        if token is None:
+            raise ValueError('無法從 Google Drive 下載文件，請確認檔案已公開分享')
+        return self.download_url, {'export': 'download', 'id': file_id, 'confirm': token}
+
+    def _read_limited(self, response, limit=None, error=None):
+        """分塊讀取回應內容，超過上限立即中止"""
+        limit = limit or self.max_file_size
+        error = error or f'文件大小超過{self.max_file_size/1024/1024}MB限制'
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            raise ValueError(error)
+
+        # 直接寫入同一個緩衝區，getvalue 不複製內容；先收集分塊再 join 會讓峰值記憶體加倍
+        buffer = BytesIO()
+        total = 0
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            total += len(chunk)
+            if total > limit:
+                raise ValueError(error)
+            buffer.write(chunk)
+        return buffer.getvalue()
@@ -0,0 +1,139 @@
+import os
+import time
+import numpy as np
+
+# cv2 匯入需要數百毫秒，只在真的啟用預處理時才載入
+cv2 = None
+
+
+def _load_cv2():
+    global cv2
+    if cv2 is None:
+        import cv2 as module
+        cv2 = module
+    return cv2
+
+
+def _flag(name, default):
+    return os.getenv(name, default) == '1'
+
+
+class ImagePreprocessor:
+    """送 Vision 前的快速預處理：縮小解析度、裁切單據區域、依大小重新編碼，每一步都可開關並記錄耗時"""
+
+    def __init__(self, enabled=None, downscale=None, crop=None, reencode=None, max_side=None, target_bytes=None):
+        self.enabled = _flag('OCR_PREPROCESS', '0') if enabled is None else enabled
+        self.downscale = _flag('OCR_PREPROCESS_DOWNSCALE', '1') if downscale is None else downscale
+        self.crop = _flag('OCR_PREPROCESS_CROP', '1') if crop is None else crop
+        self.reencode = _flag('OCR_PREPROCESS_REENCODE', '1') if reencode is None else reencode
+        # Vision 文字偵測在長邊約 2000px 以上已無明顯增益
+        self.max_side = max_side or int(os.getenv('OCR_MAX_SIDE', '2048'))
+        self.target_bytes = target_bytes or int(os.getenv('OCR_TARGET_BYTES', str(1536 * 1024)))
+
+    def _decode(self, data, width=None, height=None):
+        """解碼時直接以 1/2、1/4、1/8 縮小，避免解出完整的 12MP 像素"""
+        flag = cv2.IMREAD_COLOR
+        if self.downscale and width and height:
+            longest = max(width, height)
+            for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                if longest / factor >= self.max_side:
+                    flag = reduced
+                    break
+        return cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+
+    def _crop_document(self, image):
+        """以輪廓偵測找出最大的單據/表格區域並裁切"""
+        height, width = image.shape[:2]
+        scale = 512 / max(height, width)
+        small = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        edges = cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), 50, 150)
+        edges = cv2.dilate(edges, np.ones((5, 5), np.uint8), iterations=2)
+        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if not contours:
+            return image
+        x, y, w, h = cv2.boundingRect(max(contours, key=cv2.contourArea))
+        # 區域太小多半是誤判，寧可不裁切
+        if w * h < 0.2 * small.shape[0] * small.shape[1]:
+            return image
+        margin = 8
+        x0 = max(0, int((x - margin) / scale))
+        y0 = max(0, int((y - margin) / scale))
+        x1 = min(width, int((x + w + margin) / scale))
+        y1 = min(height, int((y + h + margin) / scale))
+        return image[y0:y1, x0:x1]
+
+    def _resize(self, image):
+        height, width = image.shape[:2]
+        longest = max(height, width)
+        if longest <= self.max_side:
+            return image
+        scale = self.max_side / longest
+        return cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+    def _encode(self, image, source_format):
+        """PNG 來源先試 PNG，否則以 JPEG 逐步降低品質直到低於目標大小"""
+        if source_format == 'PNG':
+            ok, buffer = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, 6])
+            if ok and buffer.nbytes <= self.target_bytes:
+                return buffer.tobytes(), 'PNG'
+        for quality in (90, 80, 70, 60):
+            ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if ok and buffer.nbytes <= self.target_bytes:
+                break
+        return buffer.tobytes(), 'JPEG'
+
+    def process(self, data, width=None, height=None, source_format=None):
+        """回傳 (處理後的圖片位元組, 報告)；關閉時原樣回傳"""
+        report = {'enabled': self.enabled, 'input_bytes': len(data), 'timings_ms': {}}
+        if not self.enabled:
+            report['output_bytes'] = len(data)
+            return data, report
+
+        _load_cv2()
+        timings = report['timings_ms']
+        start = time.perf_counter()
+        image = self._decode(data, width, height)
+        timings['decode'] = round((time.perf_counter() - start) * 1000, 2)
+        if image is None:
+            report['error'] = '無法解碼圖片'
+            report['output_bytes'] = len(data)
+            return data, report
+        report['decoded_size'] = [image.shape[1], image.shape[0]]
+
+        if self.crop:
+            start = time.perf_counter()
+            image = self._crop_document(image)
+            timings['crop'] = round((time.perf_counter() - start) * 1000, 2)
+        if self.downscale:
+            start = time.perf_counter()
+            image = self._resize(image)
+            timings['downscale'] = round((time.perf_counter() - start) * 1000, 2)
+        report['output_size'] = [image.shape[1], image.shape[0]]
+
+        output, output_format = data, source_format
+        if self.reencode or self.crop or self.downscale:
+            start = time.perf_counter()
+            output, output_format = self._encode(image, source_format)
+            timings['encode'] = round((time.perf_counter() - start) * 1000, 2)
+            # 沒有變小就沿用原圖
+            if len(output) >= len(data) and report['output_size'] == [width, height]:
+                output, output_format = data, source_format
+        report['output_bytes'] = len(output)
+        report['output_format'] = output_format
+        report['total_ms'] = round(sum(timings.values()), 2)
+        return output, report
+
+
+# 基準測試：python -m utils.image_preprocessor <圖片路徑>
+if __name__ == "__main__":
+    import sys
+    from .file_sniffer import read_image_header
+
+    with open(sys.argv[1], "rb") as f:
+        sample = f.read()
+    sample_width, sample_height, sample_format = read_image_header(sample)
+    preprocessor = ImagePreprocessor(enabled=True)
+    for _ in range(3):
+        _, result = preprocessor.process(sample, sample_width, sample_height, sample_format)
+        print(result)
@@ -0,0 +1,111 @@
+import re
+
+# 常見數量模式：數字+單位，或純數字
+QUANTITY_PATTERNS = [
+    re.compile(r'(\d+(?:\.\d+)?)\s*(?:斤|公斤|kg|包|盒|袋|瓶|罐|個|顆|片|條|支|根|張|份|組|套|束|把)'),
+    re.compile(r'(\d+(?:\.\d+)?)$'),  # 純數字在結尾
+    re.compile(r'(\d+(?:\.\d+)?)\s*(?:x|X|\*)'),  # 數字+乘號
+]
+
+CJK_PATTERN = re.compile(r'[一-鿿]')
+DIGIT_PATTERN = re.compile(r'\d')
+
+# (原因, 規則)：符合任一規則的行不送去匹配
+SKIP_RULES = [
+    ('表頭', re.compile(r'訂購單|訂貨單|出貨單|估價單|^(?:品名|品項|數量|單位|單價|備註|編號|No\.?)(?:\s|$|[:：])')),
+    ('日期', re.compile(r'\d{2,4}\s*[/\-.年]\s*\d{1,2}\s*[/\-.月]\s*\d{1,2}|民國\s*\d+\s*年|^日期')),
+    ('電話', re.compile(r'電話|手機|傳真|TEL|Tel|FAX|Fax|(?:\+?886[-\s]?|\b0)\d{1,2}[-\s]?\d{3,4}[-\s]?\d{3,4}\b')),
+    ('合計', re.compile(r'合計|總計|小計|總額|總金額|共計|金額|Total|TOTAL')),
+    ('簽名', re.compile(r'簽名|簽收|簽章|經手人|審核|核准')),
+    ('客戶資料', re.compile(r'^(?:客戶|客戶名稱|店名|收貨人|聯絡人|地址|統一編號|統編|送貨地址)\s*[:：]?')),
+]
+
+# 換行的品名：前一行以這些符號結尾，或下一行以這些符號開頭
+WRAP_TAIL = ('/', '／', '-', '、', '(', '（')
+WRAP_HEAD = (')', '）', '/', '／')
+
+
+def extract_item_and_quantity(item_text):
+    """從項目文字中提取商品名稱和數量"""
+    # 移除多餘空白
+    item_text = item_text.strip()
+    if not item_text:
+        return "", 1
+
+    quantity = 1
+    item_name = item_text
+
+    for pattern in QUANTITY_PATTERNS:
+        match = pattern.search(item_text)
+        if match:
+            quantity = float(match.group(1))
+            # 移除數量部分，保留商品名稱
+            item_name = pattern.sub('', item_text).strip()
+            break
+
+    return item_name, quantity
+
+
+def skip_reason(line):
+    """回傳此行不屬於品項的原因，屬於品項時回傳 None"""
+    if not line:
+        return '空白'
+    if not CJK_PATTERN.search(line):
+        if re.search(r'[A-Za-z]', line):
+            return '無中文'
+        return '純數字' if DIGIT_PATTERN.search(line) else '純符號'
+    for reason, pattern in SKIP_RULES:
+        if pattern.search(line):
+            return reason
+    return None
+
+
+class LineClassifier:
+    """匹配前的行分類：過濾表頭、日期、電話、合計、簽名等非品項行，並合併換行的品名"""
+
+    def classify(self, lines):
+        """回傳 (品項列表, 略過列表)；品項為 {'line', 'item_name', 'quantity'}，略過為 {'line', 'reason'}"""
+        items = []
+        skipped = []
+        pending = None        # 括號未閉合或以連接符號結尾、等待下一行接續的品名
+        mergeable = False     # 上一個品項沒有數量，可接上以 ')' 或 '/' 開頭的下一行
+
+        for raw_line in lines:
+            line = raw_line.strip()
+            # 接續上一行品名的短行（例如單獨的「)」或「／」）沒有中文，須在略過規則之前先合併
+            continuation = line.startswith(WRAP_HEAD) and (pending or mergeable)
+            reason = None if continuation else skip_reason(line)
+            if reason:
+                if pending:
+                    items.append(self._item(pending))
+                    pending = None
+                mergeable = False
+                if line:
+                    skipped.append({'line': line, 'reason': reason})
+                continue
+
+            if pending:
+                line = pending + line
+                pending = None
+            elif mergeable and line.startswith(WRAP_HEAD):
+                line = items.pop()['line'] + line
+
+            if not DIGIT_PATTERN.search(line) and self._looks_wrapped(line):
+                pending = line
+                mergeable = False
+                continue
+            items.append(self._item(line))
+            mergeable = not DIGIT_PATTERN.search(line)
+
+        if pending:
+            items.append(self._item(pending))
+        return items, skipped
+
+    def _item(self, line):
+        item_name, quantity = extract_item_and_quantity(line)
+        return {'line': line, 'item_name': item_name, 'quantity': quantity}
+
+    def _looks_wrapped(self, line):
+        """括號未閉合或以連接符號結尾的行，可能在下一行接續"""
+        unclosed = line.count('(') + line.count('（') > line.count(')') + line.count('）')
+        return unclosed or line.endswith(WRAP_TAIL)
@@ -0,0 +1,116 @@
+import os
+import numpy as np
+from .candidate_index import expand_name_variants, normalize_text
+
+
+class MatchBackend:
+    """品名匹配後端介面"""
+
+    name = 'base'
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """由品名清單快照建立後端"""
+        return cls(snapshot.names)
+
+    def rank(self, query, top_k=5):
+        """回傳依分數排序的 [{'matched_name': 品名, 'score': 0~1 分數}]"""
+        raise NotImplementedError
+
+
+class LocalSimilarityBackend(MatchBackend):
+    """以 NumPy 向量化計算編輯距離與字元重疊，對整份品名清單評分的離線匹配引擎"""
+
+    name = 'local'
+
+    def __init__(self, names, edit_weight=None, encoded=None):
+        self.names = list(dict.fromkeys(names))
+        self.edit_weight = edit_weight if edit_weight is not None else float(os.getenv('MATCH_LOCAL_EDIT_WEIGHT', '0.6'))
+
+        if encoded is None:
+            encoded = self._encode(self.names)
+        # 每個品名的所有變體預先編碼成 Unicode code point 陣列，0 為補齊值
+        self._codes, self._lengths, self._owners = encoded
+        self._columns = np.arange(self._codes.shape[1] + 1, dtype=np.int32)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """直接使用快照中以 mmap 開啟的編碼陣列，不必重新編碼"""
+        return cls(snapshot.names, encoded=(snapshot.codes, snapshot.lengths, snapshot.variant_owners))
+
+    @staticmethod
+    def _encode(names):
+        variants, owners = [], []
+        for name_idx, name in enumerate(names):
+            for variant in expand_name_variants(name):
+                variants.append(variant)
+                owners.append(name_idx)
+        max_length = max((len(variant) for variant in variants), default=0)
+        codes = np.zeros((len(variants), max_length), dtype=np.int32)
+        for row, variant in enumerate(variants):
+            codes[row, :len(variant)] = [ord(char) for char in variant]
+        lengths = np.array([len(variant) for variant in variants], dtype=np.int32)
+        return codes, lengths, np.array(owners, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _edit_distances(self, query_codes):
+        """對所有變體同時計算 Levenshtein 距離"""
+        rows = len(self._codes)
+        previous = np.broadcast_to(self._columns, (rows, len(self._columns))).copy()
+        for i, code in enumerate(query_codes, start=1):
+            cost = (self._codes != code).astype(np.int32)
+            current = np.empty_like(previous)
+            current[:, 0] = i
+            # 先處理取代與刪除，再以累積最小值一次處理插入
+            current[:, 1:] = np.minimum(previous[:, 1:] + 1, previous[:, :-1] + cost)
+            current = np.minimum.accumulate(current - self._columns, axis=1) + self._columns
+            previous = current
+        return previous[np.arange(rows), self._lengths]
+
+    def score_all(self, query):
+        """回傳每個品名的相似度分數（0~1）"""
+        query = normalize_text(query)
+        scores = np.zeros(len(self.names), dtype=np.float64)
+        if not query or not len(self._codes):
+            return scores
+        query_codes = np.array([ord(char) for char in query], dtype=np.int32)
+
+        distances = self._edit_distances(query_codes)
+        longest = np.maximum(self._lengths, len(query_codes))
+        edit_similarity = 1.0 - distances / longest
+
+        overlap = np.isin(self._codes, query_codes).sum(axis=1)
+        overlap_similarity = np.minimum(2.0 * overlap / (self._lengths + len(query_codes)), 1.0)
+
+        variant_scores = self.edit_weight * edit_similarity + (1 - self.edit_weight) * overlap_similarity
+        # 同一品名取其變體中的最高分
+        np.maximum.at(scores, self._owners, variant_scores)
+        return scores
+
+    def rank(self, query, top_k=5):
+        scores = self.score_all(query)
+        if not len(scores):
+            return []
+        top_k = min(top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [
+            {'matched_name': self.names[i], 'score': round(float(scores[i]), 4)}
+            for i in top if scores[i] > 0
+        ]
+
+
+BACKENDS = {
+    LocalSimilarityBackend.name: LocalSimilarityBackend,
+}
+
+
+def create_backend(name, snapshot):
+    """依名稱由品名清單快照建立匹配後端，'llm' 或空值表示只使用 LLM"""
+    if not name or name == 'llm':
+        return None
+    if name not in BACKENDS:
+        raise ValueError(f'未知的匹配後端: {name}')
+    return BACKENDS[name].from_snapshot(snapshot)
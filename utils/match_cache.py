@@ -0,0 +1,233 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from .redis_client import get_redis
+from .metrics import MATCH_CACHE
+
+
+class MatchCache:
+    """兩層匹配快取：進程內 LRU + 所有 worker 共用的 Redis，並合併同時發生的相同查詢"""
+
+    def __init__(self, namespace, max_entries=None, ttl=None, use_redis=None, lock_timeout=30):
+        self.namespace = namespace
+        self.max_entries = max_entries or int(os.getenv('MATCH_CACHE_SIZE', '10000'))
+        self.ttl = ttl or int(os.getenv('MATCH_CACHE_TTL', str(7 * 24 * 3600)))
+        if use_redis is None:
+            use_redis = os.getenv('MATCH_CACHE_REDIS', '1') == '1'
+        self.use_redis = use_redis
+        self.lock_timeout = lock_timeout
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._counters = {'local_hits': 0, 'redis_hits': 0, 'misses': 0, 'coalesced': 0}
+
+    def reset(self, namespace):
+        """切換命名空間（品名清單版本）並清空進程內快取"""
+        with self._lock:
+            self.namespace = namespace
+            self._local.clear()
+
+    def _key(self, query):
+        return f"match:{self.namespace}:{query}"
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+        MATCH_CACHE.labels(name).inc()
+
+    def stats(self):
+        """回傳命中/未命中統計"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['local_size'] = len(self._local)
+        lookups = stats['local_hits'] + stats['redis_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['local_hits'] + stats['redis_hits']) / lookups if lookups else 0.0
+        return stats
+
+    def _redis(self):
+        if not self.use_redis:
+            return None
+        try:
+            return get_redis()
+        except Exception as e:
+            print(f"Redis 快取不可用: {e}")
+            return None
+
+    def _get_local(self, key):
+        with self._lock:
+            value = self._local.get(key)
+            if value is not None:
+                self._local.move_to_end(key)
+            return value
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._local[key] = value
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def _get_remote(self, key):
+        client = self._redis()
+        if client is None:
+            return None
+        try:
+            raw = client.get(key)
+        except Exception as e:
+            print(f"讀取 Redis 快取失敗: {e}")
+            return None
+        return json.loads(raw) if raw else None
+
+    def get(self, query, count=True):
+        """查詢快取，依序檢查 LRU 與 Redis"""
+        key = self._key(query)
+        value = self._get_local(key)
+        if value is not None:
+            if count:
+                self._count('local_hits')
+            return dict(value)
+        value = self._get_remote(key)
+        if value is not None:
+            self._set_local(key, value)
+            if count:
+                self._count('redis_hits')
+            return dict(value)
+        if count:
+            self._count('misses')
+        return None
+
+    def set(self, query, value):
+        """寫入兩層快取"""
+        key = self._key(query)
+        self._set_local(key, dict(value))
+        client = self._redis()
+        if client is None:
+            return
+        try:
+            client.set(key, json.dumps(value, ensure_ascii=False), ex=self.ttl)
+        except Exception as e:
+            print(f"寫入 Redis 快取失敗: {e}")
+
+    def get_or_compute(self, query, compute):
+        """單一查詢版本的 get_or_compute_many"""
+        results = self.get_or_compute_many([query], lambda queries: {queries[0]: compute()})
+        return results.get(query, {})
+
+    def get_or_compute_many(self, queries, compute_many):
+        """
+        批次查詢快取，未命中的部分交給 compute_many(queries) -> {query: result} 計算。
+        其他執行緒或 worker 正在計算的相同查詢會等待其結果，而不重複呼叫上游。
+        """
+        results = {}
+        owned, waiting = [], []
+        for query in dict.fromkeys(queries):
+            value = self.get(query)
+            if value is not None:
+                results[query] = value
+                continue
+            role, event, token = self._claim(query)
+            if role == 'owner':
+                owned.append((query, event, token))
+            else:
+                waiting.append((query, role, event))
+
+        try:
+            if owned:
+                computed = compute_many([query for query, _, _ in owned]) or {}
+                for query, _, _ in owned:
+                    value = computed.get(query)
+                    if value:
+                        results[query] = value
+                        # 只快取成功的匹配，失敗的結果下次重試
+                        if value.get('matched_name'):
+                            self.set(query, value)
+        finally:
+            for query, event, token in owned:
+                self._finish(query, event, token)
+
+        leftovers = []
+        for query, role, event in waiting:
+            value = self._wait(query, role, event)
+            if value is not None:
+                self._count('coalesced')
+                results[query] = value
+            else:
+                leftovers.append(query)
+        if leftovers:
+            # 持有者失敗或逾時，自行計算
+            computed = compute_many(leftovers) or {}
+            for query in leftovers:
+                value = computed.get(query)
+                if value:
+                    results[query] = value
+                    if value.get('matched_name'):
+                        self.set(query, value)
+        return results
+
+    def _claim(self, query):
+        """取得查詢的計算權，回傳 (角色, 事件, Redis 鎖 token)"""
+        key = self._key(query)
+        with self._lock:
+            event = self._inflight.get(key)
+            if event is not None:
+                return 'local_wait', event, None
+            event = threading.Event()
+            self._inflight[key] = event
+
+        client = self._redis()
+        if client is None:
+            return 'owner', event, None
+        token = uuid.uuid4().hex
+        try:
+            if client.set(f"{key}:lock", token, nx=True, ex=self.lock_timeout):
+                return 'owner', event, token
+        except Exception as e:
+            print(f"取得 Redis 快取鎖失敗: {e}")
+            return 'owner', event, None
+        return 'remote_wait', event, None
+
+    def _finish(self, query, event, token=None):
+        key = self._key(query)
+        with self._lock:
+            self._inflight.pop(key, None)
+        event.set()
+        if token is None:
+            return
+        client = self._redis()
+        if client is None:
+            return
+        try:
+            if client.get(f"{key}:lock") == token.encode():
+                client.delete(f"{key}:lock")
+        except Exception as e:
+            print(f"釋放 Redis 快取鎖失敗: {e}")
+
+    def _wait(self, query, role, event):
+        """等待其他執行緒或 worker 完成相同查詢"""
+        if role == 'local_wait':
+            event.wait(self.lock_timeout)
+            return self.get(query, count=False)
+
+        key = self._key(query)
+        deadline = time.monotonic() + self.lock_timeout
+        value = None
+        try:
+            client = self._redis()
+            while client is not None and time.monotonic() < deadline:
+                value = self._get_remote(key)
+                if value is not None:
+                    self._set_local(key, value)
+                    break
+                if not client.exists(f"{key}:lock"):
+                    break
+                time.sleep(0.05)
+            if value is None:
+                value = self._get_remote(key)
+        except Exception as e:
+            print(f"等待 Redis 快取失敗: {e}")
+        finally:
+            self._finish(query, event)
+        return dict(value) if value is not None else None
@@ -0,0 +1,142 @@
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest,
+    multiprocess, start_http_server
+)
+from prometheus_client.core import GaugeMetricFamily
+from .redis_client import get_redis
+
+# 設定 PROMETHEUS_MULTIPROC_DIR 時（Celery prefork、gunicorn 多進程），各進程的數值寫入該目錄再彙總
+MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+# 從數毫秒（快取、本地匹配）到數十秒（大型 PDF、LLM 重試）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_SECONDS = Histogram(
+    'ocr_stage_seconds', '各處理階段與上游呼叫的耗時',
+    ['stage'], buckets=LATENCY_BUCKETS
+)
+MATCH_SECONDS = Histogram(
+    'ocr_match_seconds', '品項匹配呼叫的耗時（整份文件或單一品項）',
+    ['mode'], buckets=LATENCY_BUCKETS
+)
+LLM_CALLS = Counter('ocr_llm_calls_total', 'Gemini 呼叫次數', ['kind', 'outcome'])
+LLM_PROMPT_BYTES = Counter('ocr_llm_prompt_bytes_total', '送往 Gemini 的提示位元組數', ['kind'])
+MATCH_CACHE = Counter('ocr_match_cache_total', '匹配快取查詢結果', ['result'])
+MATCH_ALIAS = Counter('ocr_match_alias_total', '人工修正別名表查詢結果', ['result'])
+VISION_REQUESTS = Counter('ocr_vision_requests_total', 'Vision batch_annotate_images 請求數')
+VISION_IMAGES = Counter('ocr_vision_images_total', '送往 Vision 的圖片數')
+WEBHOOK_ATTEMPTS = Counter('ocr_webhook_attempts_total', 'Webhook 投遞次數', ['outcome'])
+UPSTREAM_RETRIES = Counter('ocr_upstream_retries_total', '上游暫時性錯誤的重試次數', ['upstream'])
+CIRCUIT_OPENED = Counter('ocr_circuit_opened_total', '熔斷器開路次數', ['upstream'])
+
+# 各階段的 Celery 佇列（含預設佇列）
+QUEUES = ('download', 'ocr', 'match', 'deliver', 'celery')
+# Redis broker 以「佇列名稱 + \x06\x16 + 優先級」存放不同優先級的訊息
+PRIORITY_SEPARATOR = '\x06\x16'
+PRIORITY_STEPS = (3, 6, 9)
+
+# 額外接收每段耗時的回呼（例如基準測試需要精確的百分位數，而非直方圖的區間）
+_observers = []
+
+
+def add_observer(callback):
+    """註冊 callback(stage, seconds)，每段 span 結束時呼叫"""
+    _observers.append(callback)
+
+
+def remove_observer(callback):
+    if callback in _observers:
+        _observers.remove(callback)
+
+
+@contextmanager
+def span(stage):
+    """記錄一段處理的耗時"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        for callback in _observers:
+            callback(stage, elapsed)
+
+
+class QueueDepthCollector:
+    """匯出各 Celery 佇列等待中的訊息數，供依佇列深度自動擴展 worker"""
+
+    def __init__(self, queues=QUEUES, url=None):
+        self.queues = queues
+        # 未指定時使用 REDIS_URL（即 Celery 的 broker）
+        self.url = url
+
+    def collect(self):
+        gauge = GaugeMetricFamily('ocr_queue_depth', 'Celery 佇列中等待處理的訊息數', labels=['queue'])
+        try:
+            client = get_redis(self.url)
+            pipe = client.pipeline()
+            for queue in self.queues:
+                pipe.llen(queue)
+                for priority in PRIORITY_STEPS:
+                    pipe.llen(f"{queue}{PRIORITY_SEPARATOR}{priority}")
+            lengths = pipe.execute()
+        except Exception as e:
+            print(f"讀取佇列深度失敗: {e}")
+            return
+        step = len(PRIORITY_STEPS) + 1
+        for index, queue in enumerate(self.queues):
+            gauge.add_metric([queue], sum(lengths[index * step:(index + 1) * step]))
+        yield gauge
+
+
+_registry = None
+
+
+def get_registry():
+    """匯出用的 registry：多進程模式時彙總目錄中所有進程的數值，並加上佇列深度"""
+    global _registry
+    if _registry is None:
+        if MULTIPROC_DIR:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        if os.getenv('METRICS_QUEUE_DEPTH', '1') == '1':
+            registry.register(QueueDepthCollector())
+        _registry = registry
+    return _registry
+
+
+def render_metrics():
+    """回傳 (內容, Content-Type)，供 Flask 的 /metrics 使用"""
+    return generate_latest(get_registry()), CONTENT_TYPE_LATEST
+
+
+def reset_multiproc_dir():
+    """Worker 主進程啟動時清除上一次執行留下的數值檔"""
+    if not MULTIPROC_DIR:
+        return
+    shutil.rmtree(MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+
+def start_worker_exporter(port=None):
+    """在 Celery worker 主進程開啟 /metrics HTTP 端口（彙總所有子進程）"""
+    port = port or int(os.getenv('METRICS_PORT', '9100'))
+    try:
+        start_http_server(port, registry=get_registry())
+        print(f"Prometheus 指標已於端口 {port} 匯出")
+    except OSError as e:
+        print(f"無法開啟指標端口 {port}: {e}")
+
+
+def mark_process_dead(pid):
+    """子進程結束時移除其即時數值（多進程模式）"""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
@@ -1,29 +1,75 @@
-from google.cloud import vision
-import cv2
-import numpy as np
+import os
+from .vision_batcher import VisionBatcher
+from .image_preprocessor import ImagePreprocessor
+from .file_sniffer import LazyImage
+from .resilience import UpstreamUnavailable, get_upstream
 
 class OcrProcessor:
-    def __init__(self):
-        self.client = vision.ImageAnnotatorClient()
+    def __init__(self, client=None, feature=None):
+        # 未指定 client 時延後到第一次使用才建立，且每個進程各自建立
+        self._client = client
+        self._injected = client is not None
+        self._pid = os.getpid()
+        self._batcher = None
+        # text_detection 適合照片；document_text_detection 適合密集的表格文字
+        self.feature = feature or os.getenv('OCR_FEATURE', 'text_detection')
+        self.preprocessor = ImagePreprocessor()
+
+    def _check_fork(self):
+        """gRPC 通道與批次器的背景執行緒都不能跨 fork 使用，子進程重新建立"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._batcher = None
+            if not self._injected:
+                self._client = None
+
+    @property
+    def client(self):
+        self._check_fork()
+        if self._client is None:
+            from google.cloud import vision
+            self._client = vision.ImageAnnotatorClient()
+        return self._client
+
+    @property
+    def batcher(self):
+        self._check_fork()
+        if self._batcher is None:
+            self._batcher = VisionBatcher(self.client, self.feature, upstream=get_upstream('vision'))
+        return self._batcher
+    
+    def preprocess_image(self, page):
+        """送出前縮小、裁切並重新編碼頁面（OCR_PREPROCESS=1 時啟用），回傳 (新頁面, 報告)"""
+        data, report = self.preprocessor.process(page.data, page.width, page.height, page.format)
+        if data is page.data:
+            return page, report
+        width, height = report['output_size']
+        return LazyImage(data, width, height, report['output_format']), report
     
-    def preprocess_image(self, image):
-        """圖片預處理以提高OCR準確率"""
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        denoised = cv2.fastNlMeansDenoising(gray)
-        _, binary = cv2.threshold(denoised, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        return binary
+    def _read_content(self, image_source):
+        """取得圖片位元組：記憶體緩衝區直接使用，路徑則從磁碟讀取"""
+        if isinstance(image_source, bytes):
+            return image_source
+        if isinstance(image_source, (bytearray, memoryview)):
+            return bytes(image_source)
+        with open(image_source, "rb") as image_file:
+            return image_file.read()
+    
+    def extract_text(self, image_source):
+        """使用 Google Cloud Vision OCR 從圖片中提取文字（接受 bytes/memoryview 或檔案路徑）"""
+        try:
+            # 經由批次器送出，與同時進行的其他請求合併成一次 batch_annotate_images
+            return self.batcher.annotate(self._read_content(image_source))
+        except UpstreamUnavailable:
+            raise
+        except Exception as e:
+            raise Exception(f"OCR識別失敗: {str(e)}")
     
-    def extract_text(self, image_path):
-        """使用 Google Cloud Vision OCR 從圖片中提取文字"""
+    def extract_texts(self, image_sources):
+        """以批次請求辨識多張圖片（例如 PDF 的多頁），回傳對應的文字列表"""
         try:
-            with open(image_path, "rb") as image_file:
-                content = image_file.read()
-            image = vision.Image(content=content)
-            response = self.client.text_detection(image=image)
-            texts = response.text_annotations
-            if texts:
-                return texts[0].description.strip()
-            else:
-                return ""
+            return self.batcher.annotate_many([self._read_content(source) for source in image_sources])
+        except UpstreamUnavailable:
+            raise
         except Exception as e:
-            raise Exception(f"OCR識別失敗: {str(e)}")
\ No newline at end of file
+            raise Exception(f"OCR識別失敗: {str(e)}")
@@ -3,97 +3,246 @@ from .file_manager import FileManager
 from .ocr_processor import OcrProcessor
 from .fuzzy_matching import OrderFuzzyMatcher
 from .result_processor import ResultProcessor
-import re
+from .dedup_store import DedupStore
+from .line_classifier import LineClassifier, extract_item_and_quantity
+from .resilience import UpstreamUnavailable
+from .progress_store import ProgressStore
+from .batch_store import BatchStore
+from .result_store import ResultStore
+from .metrics import span
 
 class OrderProcessor:
-    def __init__(self, order_csv_path="./客戶訂單資料.csv", upload_folder="uploads", max_file_size=20*1024*1024):
+    def __init__(self, order_csv_path="./客戶訂單資料.csv", upload_folder="uploads", max_file_size=20*1024*1024,
+                 result_processor=None, batch_store=None, result_store=None, alias_store=None):
         self.downloader = GoogleDriveDownloader(max_file_size=max_file_size)
         self.file_manager = FileManager(upload_folder=upload_folder)
         self.ocr_processor = OcrProcessor()
-        self.fuzzy_matcher = OrderFuzzyMatcher(order_csv_path)
-        self.result_processor = ResultProcessor()
+        self.fuzzy_matcher = OrderFuzzyMatcher(order_csv_path, aliases=alias_store)
+        self.result_processor = result_processor or ResultProcessor()
+        self.dedup_store = DedupStore()
+        self.line_classifier = LineClassifier()
+        self.progress = ProgressStore()
+        self.batch_store = batch_store or BatchStore()
+        self.result_store = result_store or ResultStore()
+
+    def warm_up(self):
+        """在目前進程建立 Vision 與 Gemini 的客戶端（gRPC 通道不能在 fork 前建立）"""
+        self.ocr_processor.batcher
+        self.fuzzy_matcher._get_model()
     
     def extract_item_and_quantity(self, item_text):
         """從項目文字中提取商品名稱和數量"""
-        # 移除多餘空白
-        item_text = item_text.strip()
-        if not item_text:
-            return "", 1
-        
-        # 常見數量模式：數字+單位，或純數字
-        quantity_patterns = [
-            r'(\d+(?:\.\d+)?)\s*(?:斤|公斤|kg|包|盒|袋|瓶|罐|個|顆|片|條|支|根|張|份|組|套|束|把)',
-            r'(\d+(?:\.\d+)?)$',  # 純數字在結尾
-            r'(\d+(?:\.\d+)?)\s*(?:x|X|\*)',  # 數字+乘號
-        ]
-        
-        quantity = 1
-        item_name = item_text
-        
-        for pattern in quantity_patterns:
-            match = re.search(pattern, item_text)
-            if match:
-                quantity = float(match.group(1))
-                # 移除數量部分，保留商品名稱
-                item_name = re.sub(pattern, '', item_text).strip()
-                break
+        return extract_item_and_quantity(item_text)
+
+    def _iter_page_batches(self, download_info):
+        """把頁面分組，每組不超過一次 Vision 批次請求的張數"""
+        batch = []
+        for page_number, page in self.downloader.iter_pages(download_info):
+            if download_info['width'] is None:
+                download_info['width'], download_info['height'] = page.width, page.height
+            if self.ocr_processor.preprocessor.enabled:
+                with span('preprocess'):
+                    page, report = self.ocr_processor.preprocess_image(page)
+                report['page'] = page_number
+                download_info.setdefault('preprocess', []).append(report)
+            batch.append((page_number, page))
+            if len(batch) >= self.ocr_processor.batcher.max_batch:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def ocr_pages(self, download_info):
+        """逐頁OCR識別，回傳 [(頁碼, 文字), ...]"""
+        # 直接使用記憶體中的圖片，PDF 逐批轉換頁面，多頁合併成一次 Vision 請求
+        pages = []
+        for page_batch in self._iter_page_batches(download_info):
+            if len(page_batch) == 1:
+                # 單頁走等待視窗，可與同進程其他任務的圖片合併請求
+                texts = [self.ocr_processor.extract_text(page_batch[0][1].data)]
+            else:
+                texts = self.ocr_processor.extract_texts([page.data for _, page in page_batch])
+            for (page_number, _), page_text in zip(page_batch, texts):
+                pages.append((page_number, page_text))
+        return pages
+
+    def match_pages(self, pages):
+        """行分類與品項匹配，回傳 (擷取文字, 品項列表, 頁數, 略過的行)"""
+        line_items, skipped_lines = self.classify_pages(pages)
+        extracted_text = '\n'.join(page_text for _, page_text in pages)
+        return extracted_text, self.match_lines(line_items), len(pages), skipped_lines
+
+    def classify_pages(self, pages):
+        """行分類，回傳 (待匹配的行 [(頁碼, 原始行, 品名, 數量)], 略過的行)"""
+        line_items = []
+        skipped_lines = []
+        for page_number, page_text in pages:
+            # 提取行項目：表頭、日期、電話、合計等非品項行不送去匹配
+            classified, skipped = self.line_classifier.classify(page_text.split('\n') if page_text else [])
+            for line in skipped:
+                line['page'] = page_number
+                skipped_lines.append(line)
+            for line in classified:
+                print("Processing item:", line['line'])
+                if not line['item_name']:
+                    # 取不出品名的行不送去匹配，但仍列入略過清單，修正時可以看到
+                    skipped_lines.append({'line': line['line'], 'reason': 'empty_name', 'page': page_number})
+                    continue
+                line_items.append((page_number, line['line'], line['item_name'], line['quantity']))
+        return line_items, skipped_lines
+
+    def match_lines(self, line_items):
+        """品項匹配，回傳品項列表"""
+        # 整份文件的品項依 MATCH_MODE 批次或並行匹配，結果依順序對應回各行
+        all_matches = self.fuzzy_matcher.match_many(
+            [item_name for _, _, item_name, _ in line_items]
+        )
+        items = []
         
-        return item_name, quantity
+        for (page_number, item, item_name, quantity), matches in zip(line_items, all_matches):
+            print("Processing matches:", matches)
+            
+            if isinstance(matches, dict) and matches.get("matched_name"):
+                best_match = matches
+                # 別名表的結果已帶品號，其他結果用 matched_name 查出對應品號
+                product_id = best_match.get("product_id") or self.fuzzy_matcher.lookup_product_id(best_match["matched_name"])
+                
+                items.append({
+                    "product_id": product_id,
+                    "matched_name": best_match["matched_name"],
+                    "original_input": item,
+                    "item_name": item_name,  # 處理後的商品名稱
+                    "quantity": quantity,     # 提取的數量
+                    "match_score": float(best_match["score"]) if best_match.get("score") is not None else 0,
+                    "page": page_number
+                })
+            else:
+                # 單行匹配失敗或沒有結果都不中斷整份文件，也不會讓這一行消失，留給人工修正
+                error = matches.get("error") if isinstance(matches, dict) else None
+                items.append({
+                    "product_id": "",
+                    "matched_name": "",
+                    "original_input": item,
+                    "item_name": item_name,
+                    "quantity": quantity,
+                    "match_score": 0,
+                    "page": page_number,
+                    "error": error or "沒有匹配結果"
+                })
+        return items
 
-    def process(self, task_id, google_drive_url, file_name=None, mime_type=None, webhook_url=None):
-        """處理完整的OCR工作流"""
-        try:
+    def analyze(self, download_info):
+        """OCR 與品項匹配，回傳 (擷取文字, 品項列表, 頁數, 略過的行)"""
+        return self.match_pages(self.ocr_pages(download_info))
+
+    @staticmethod
+    def new_job(task_id, google_drive_url, file_name=None, mime_type=None, webhook_url=None, batch_id=None, fresh=False):
+        """建立在各階段之間傳遞的工作內容（只含可 JSON 序列化的小型欄位）"""
+        job = {
+            'task_id': task_id,
+            'google_drive_url': google_drive_url,
+            'file_name': file_name,
+            'mime_type': mime_type,
+            'webhook_url': webhook_url,
+            'file_id': GoogleDriveDownloader.extract_file_id(google_drive_url)
+        }
+        if batch_id:
+            job['batch_id'] = batch_id
+        if fresh:
+            # 重新處理：不沿用相同內容先前的辨識結果
+            job['fresh'] = True
+        return job
+
+    def download_stage(self, job):
+        """下載、落地與內容去重，回傳 (job, download_info)"""
+        with self.progress.track(job['task_id'], 'download'), span('download'):
             # 1. 下載圖片
-            download_info = self.downloader.download(google_drive_url)
+            download_info = self.downloader.download(job['google_drive_url'])
             
-            # 2. 保存圖片
-            file_path, unique_filename = self.file_manager.save_image(
-                download_info['image_data'], 
-                download_info['file_extension']
+            # 2. 預設不寫入磁碟，只有開啟落地模式時才保存圖片
+            unique_filename = self.file_manager.generate_filename(download_info['file_extension'])
+            self.file_manager.spool(
+                download_info['image_data'],
+                download_info['file_extension'],
+                unique_filename
             )
             
-            # 3. OCR識別
-            extracted_text = self.ocr_processor.extract_text(file_path)
-            
-            # 4. 提取行項目並模糊匹配
-            extracted_items = extracted_text.split('\n') if extracted_text else []
-            items = []
-            
-            for item in extracted_items:
-                print("Processing item:", item)
-                
-                # 提取商品名稱和數量
-                item_name, quantity = self.extract_item_and_quantity(item)
-                
-                if not item_name:  # 跳過空的項目
-                    continue
-                    
-                matches = self.fuzzy_matcher.fuzzy_match_items(item_name)
-                print("Processing matches:", matches)
-                
-                if isinstance(matches, dict) and matches.get("matched_name"):
-                    best_match = matches
-                    # 用 matched_name 找出對應 row
-                    product_row = self.fuzzy_matcher.items[self.fuzzy_matcher.items['品名'] == best_match["matched_name"]]
-                    product_id = product_row['品號'].values[0] if not product_row.empty and '品號' in product_row.columns else ""
-                    
-                    items.append({
-                        "product_id": product_id,
-                        "matched_name": best_match["matched_name"],
-                        "original_input": item,
-                        "item_name": item_name,  # 處理後的商品名稱
-                        "quantity": quantity,     # 提取的數量
-                        "match_score": float(best_match["score"]) if best_match.get("score") is not None else 0
-                    })
+            # 3. 內容完全相同的單據直接沿用先前的辨識結果；近似重拍的單據仍重新 OCR，只做標記
+            sha256, phash = self.dedup_store.fingerprint(download_info['image_data'], download_info['file_type'])
+            cached = None if job.get('fresh') else self.dedup_store.find_result(sha256)
+            if cached and cached.get('catalog') != self.fuzzy_matcher.catalog_hash:
+                # 品名清單已更新，舊的匹配結果不再適用
+                cached = None
+            similar = None if cached else self.dedup_store.find_similar(phash, sha256)
             
-            # 5. 構建結果
-            image_info = {
+            job.update({
                 'unique_filename': unique_filename,
-                'file_id': download_info['file_id'],
                 'file_size': download_info['file_size'],
-                'width': download_info['width'],
-                'height': download_info['height'],
-                'format': download_info['format']
+                'file_type': download_info['file_type'],
+                'page_count': download_info['page_count'],
+                'image': {key: download_info[key] for key in ('width', 'height', 'format')},
+                'sha256': sha256,
+                'phash': phash
+            })
+            if cached:
+                print(f"重複的單據，沿用任務 {cached['task_id']} 的結果")
+                job['cached'] = cached
+            elif similar:
+                job['near_duplicate_of'] = similar
+        return job, download_info
+
+    def ocr_stage(self, job, download_info):
+        """OCR 識別，各頁文字存入 job['pages']"""
+        if job.get('cached'):
+            self.progress.finish_stage(job['task_id'], 'ocr', status='skipped')
+            return job
+        with self.progress.track(job['task_id'], 'ocr'), span('ocr'):
+            # 4. OCR識別
+            job['pages'] = self.ocr_pages(download_info)
+            job['image'] = {key: download_info[key] for key in ('width', 'height', 'format')}
+            if download_info.get('preprocess'):
+                job['preprocess'] = download_info['preprocess']
+        return job
+
+    def match_stage(self, job):
+        """品項匹配並構建結果"""
+        with self.progress.track(job['task_id'], 'match'), span('match'):
+            cached = job.get('cached')
+            if cached:
+                extracted_text, items = cached['text'], cached['items']
+                skipped_lines = cached.get('skipped_lines', [])
+                job['image'] = cached['image']
+                page_count = cached['page_count']
+            else:
+                # 5. 模糊匹配
+                line_items, skipped_lines = self.classify_pages(job['pages'])
+                extracted_text = '\n'.join(page_text for _, page_text in job['pages'])
+                page_count = len(job['pages'])
+                cached = self._reuse_near_duplicate(job, extracted_text)
+                if cached:
+                    items = cached['items']
+                else:
+                    items = self.match_lines(line_items)
+                    if self._is_complete(items, line_items):
+                        self.dedup_store.store_result(job['sha256'], job['phash'], {
+                            'task_id': job['task_id'],
+                            'text': extracted_text,
+                            'items': items,
+                            'skipped_lines': skipped_lines,
+                            'page_count': page_count,
+                            'catalog': self.fuzzy_matcher.catalog_hash,
+                            'image': job['image']
+                        })
+            
+            # 6. 構建結果
+            image_info = {
+                'unique_filename': job['unique_filename'],
+                'file_id': job['file_id'],
+                'file_size': job['file_size'],
+                'width': job['image']['width'],
+                'height': job['image']['height'],
+                'format': job['image']['format'],
+                'page_count': page_count
             }
             
             extraction_info = {
@@ -101,34 +250,122 @@ class OrderProcessor:
             }
             
             result = self.result_processor.build_result(
-                task_id=task_id,
+                task_id=job['task_id'],
                 image_info=image_info,
                 extraction_info=extraction_info,
                 items=items,
-                google_drive_url=google_drive_url,
-                file_name=file_name,
-                mime_type=mime_type
+                google_drive_url=job['google_drive_url'],
+                file_name=job['file_name'],
+                mime_type=job['mime_type']
             )
-            
-            # 6. 清理臨時文件
-            self.file_manager.cleanup(file_path)
-            
-            # 7. Webhook回調
-            if webhook_url:
-                callback_status = self.result_processor.send_webhook(webhook_url, result)
+            result['data']['content_sha256'] = job['sha256']
+            result['data']['skipped_lines'] = skipped_lines
+            if job.get('preprocess'):
+                result['data']['preprocess'] = job['preprocess']
+            if cached:
+                result['data']['deduplicated_from'] = cached['task_id']
+            if job.get('near_duplicate_of'):
+                result['data']['near_duplicate_of'] = {
+                    key: job['near_duplicate_of'][key] for key in ('task_id', 'distance')
+                }
+        return result
+
+    def _reuse_near_duplicate(self, job, extracted_text):
+        """近似重拍的單據重新 OCR 後文字完全相同時，才沿用其匹配結果"""
+        similar = job.get('near_duplicate_of')
+        if not similar or job.get('fresh'):
+            return None
+        previous = self.dedup_store.find_result(similar['sha256'])
+        if (not previous or previous.get('catalog') != self.fuzzy_matcher.catalog_hash
+                or previous.get('text') != extracted_text):
+            return None
+        print(f"近似重複的單據重新辨識後文字相同，沿用任務 {previous['task_id']} 的匹配結果")
+        return previous
+
+    @staticmethod
+    def _is_complete(items, line_items):
+        """每一行都匹配成功且沒有錯誤時才寫入去重快取，LLM 失敗產生的部分結果不會被沿用"""
+        return len(items) == len(line_items) and not any(item.get('error') for item in items)
+
+    def deliver_stage(self, job, result):
+        """Webhook回調（包含重複提交時登記的 webhook）"""
+        task_id = job['task_id']
+        with self.progress.track(task_id, 'deliver'), span('deliver'):
+            # 完整結果先寫入結果庫（收到回調後開啟修正表單時即可讀取），Celery 結果後端只保存指標
+            stored = self._store_result(job, result)
+            if stored:
+                self.progress.mark_stored(task_id)
+            callback_status = None
+            if job.get('webhook_url'):
+                callback_status = self.result_processor.send_webhook(job['webhook_url'], result)
                 result['callback_status'] = callback_status
-            
+            for waiting_url in self.dedup_store.pop_waiting_webhooks(task_id):
+                self.result_processor.send_webhook(waiting_url, result)
+            self._finish_batch_member(job, {
+                'state': 'SUCCESS',
+                'file_name': job.get('file_name'),
+                'page_count': result['data']['page_count'],
+                'items': result['data']['items']
+            })
+        if not stored:
             return result
-            
+        pointer = self.result_store.pointer(result)
+        pointer['callback_status'] = callback_status
+        return pointer
+
+    def _store_result(self, job, result):
+        """寫入結果庫；失敗時退回把完整結果放在 Celery 結果後端"""
+        try:
+            return self.result_store.put(result, job) is not None
+        except Exception as e:
+            print(f"寫入結果庫失敗: {e}")
+            return False
+
+    def fail(self, job, error):
+        """任務失敗：釋放 file_id、回調錯誤並拋出例外"""
+        task_id = job['task_id']
+        self.progress.fail(task_id, str(error))
+        if job.get('blob'):
+            self.file_manager.delete_blob(job['blob'])
+        # 失敗的任務不應擋住之後的重新提交
+        self.dedup_store.release_file(job.get('file_id'), task_id)
+        # 錯誤處理和回調
+        error_payload = {
+            'success': False,
+            'error': str(error),
+            'task_id': task_id
+        }
+        for url in [job.get('webhook_url')] + self.dedup_store.pop_waiting_webhooks(task_id):
+            if url:
+                self.result_processor.send_webhook(url, error_payload)
+        self._finish_batch_member(job, {'state': 'FAILURE', 'file_name': job.get('file_name'), 'error': str(error)})
+        raise Exception(f"處理失敗: {str(error)}")
+
+    def _finish_batch_member(self, job, summary):
+        """批次成員完成時記錄結果，最後一個完成的成員送出彙總回調"""
+        batch_id = job.get('batch_id')
+        if not batch_id:
+            return
+        try:
+            if not self.batch_store.member_done(batch_id, job['task_id'], summary):
+                return
+            batch = self.batch_store.get(batch_id)
+        except Exception as e:
+            print(f"更新批次 {batch_id} 失敗: {e}")
+            return
+        if batch and batch['webhook_url']:
+            self.result_processor.send_webhook(batch['webhook_url'], self.result_processor.build_batch_result(batch))
+
+    def process(self, task_id, google_drive_url, file_name=None, mime_type=None, webhook_url=None, retryable=False, batch_id=None, fresh=False):
+        """在單一任務中依序執行所有階段（retryable 時上游不可用的錯誤直接拋出，由任務稍後重試）"""
+        job = self.new_job(task_id, google_drive_url, file_name, mime_type, webhook_url, batch_id, fresh)
+        try:
+            job, download_info = self.download_stage(job)
+            job = self.ocr_stage(job, download_info)
+            result = self.match_stage(job)
+            return self.deliver_stage(job, result)
         except Exception as e:
-            # 錯誤處理和回調
-            if webhook_url:
-                self.result_processor.send_webhook(
-                    webhook_url,
-                    {
-                        'success': False,
-                        'error': str(e),
-                        'task_id': task_id
-                    }
-                )
-            raise Exception(f"處理失敗: {str(e)}")
\ No newline at end of file
+            if retryable and isinstance(e, UpstreamUnavailable):
+                # 保留 file_id 登記與等待中的 webhook，重試成功後一併回調
+                raise
+            self.fail(job, e)
@@ -0,0 +1,48 @@
+import os
+from io import BytesIO
+from .file_sniffer import LazyImage
+from .metrics import span
+
+
+class PdfRenderer:
+    """逐批將 PDF 頁面轉成 PNG，同時在記憶體中的頁面數量受 thread_count 限制"""
+
+    def __init__(self, dpi=None, thread_count=None, max_pages=None):
+        self.dpi = dpi or int(os.getenv('PDF_RENDER_DPI', '200'))
+        self.thread_count = thread_count or int(os.getenv('PDF_RENDER_THREADS', '2'))
+        self.max_pages = max_pages or int(os.getenv('PDF_MAX_PAGES', '50'))
+
+    def page_count(self, pdf_data):
+        """讀取 PDF 頁數"""
+        from pdf2image import pdfinfo_from_bytes  # 確保已安裝 pdf2image 和 poppler
+        try:
+            return int(pdfinfo_from_bytes(pdf_data)['Pages'])
+        except Exception as e:
+            raise ValueError(f'文件不是有效的圖片或PDF格式: {e}')
+
+    def iter_pages(self, pdf_data, page_count=None):
+        """依序產生 (頁碼, LazyImage)，每次只平行轉換 thread_count 頁"""
+        from pdf2image import convert_from_bytes
+        page_count = page_count or self.page_count(pdf_data)
+        if page_count > self.max_pages:
+            print(f"PDF 共 {page_count} 頁，只處理前 {self.max_pages} 頁")
+            page_count = self.max_pages
+
+        for first_page in range(1, page_count + 1, self.thread_count):
+            last_page = min(first_page + self.thread_count - 1, page_count)
+            with span('pdf_render'):
+                images = convert_from_bytes(
+                    pdf_data,
+                    dpi=self.dpi,
+                    first_page=first_page,
+                    last_page=last_page,
+                    thread_count=self.thread_count
+                )
+            if not images:
+                raise ValueError('PDF轉換為圖片失敗')
+            for offset, image in enumerate(images):
+                buffer = BytesIO()
+                image.save(buffer, format='PNG')
+                page = LazyImage(buffer.getvalue(), image.width, image.height, 'PNG')
+                image.close()
+                yield first_page + offset, page
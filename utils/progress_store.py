@@ -0,0 +1,119 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from .redis_client import get_pubsub_redis, get_redis
+
+# 流水線的階段與完成後的進度百分比
+STAGES = ('download', 'ocr', 'match', 'deliver')
+STAGE_PROGRESS = {'download': 20, 'ocr': 60, 'match': 90, 'deliver': 100}
+FINISHED_STATES = ('SUCCESS', 'FAILURE')
+
+
+class ProgressStore:
+    """
+    以邏輯 task_id 記錄各階段進度（存於 Redis），供 /status 在串接的階段任務間回報同一個任務；
+    每次更新同時以 pub/sub 發布事件，讓 SSE 與長輪詢不必反覆查詢。
+    """
+
+    def __init__(self, ttl=None):
+        # 與 Celery 的 result_expires 相同
+        self.ttl = ttl or int(os.getenv('PROGRESS_TTL', '3600'))
+
+    def _key(self, task_id):
+        return f"progress:{task_id}"
+
+    def _channel(self, task_id):
+        return f"progress-events:{task_id}"
+
+    def _write(self, task_id, fields):
+        try:
+            client = get_redis()
+            pipe = client.pipeline()
+            pipe.hset(self._key(task_id), mapping={key: str(value) for key, value in fields.items()})
+            pipe.expire(self._key(task_id), self.ttl)
+            pipe.publish(self._channel(task_id), json.dumps(fields, ensure_ascii=False, default=str))
+            pipe.execute()
+        except Exception as e:
+            print(f"寫入任務進度失敗: {e}")
+
+    def start_stage(self, task_id, stage):
+        self._write(task_id, {'state': 'PROGRESS', 'stage': stage, f'stage:{stage}': 'started', 'updated_at': time.time()})
+
+    def finish_stage(self, task_id, stage, elapsed_ms=None, status='done'):
+        fields = {'stage': stage, f'stage:{stage}': status, 'progress': STAGE_PROGRESS[stage], 'updated_at': time.time()}
+        if elapsed_ms is not None:
+            fields[f'stage:{stage}:ms'] = round(elapsed_ms, 1)
+        if stage == STAGES[-1]:
+            fields['state'] = 'SUCCESS'
+        self._write(task_id, fields)
+
+    def mark_stored(self, task_id):
+        """完整結果已寫入結果庫；/status 據此判斷完成，不必每次查詢 SQLite"""
+        self._write(task_id, {'stored': 1, 'updated_at': time.time()})
+
+    def fail(self, task_id, error):
+        self._write(task_id, {'state': 'FAILURE', 'error': error, 'updated_at': time.time()})
+
+    @contextmanager
+    def track(self, task_id, stage):
+        """記錄一個階段的開始、完成與耗時"""
+        self.start_stage(task_id, stage)
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self._write(task_id, {f'stage:{stage}': 'error', 'updated_at': time.time()})
+            raise
+        self.finish_stage(task_id, stage, (time.perf_counter() - start) * 1000)
+
+    def get(self, task_id):
+        """回傳 {'state', 'stage', 'progress', 'error', 'stored', 'stages'}；沒有紀錄時回傳 None"""
+        try:
+            raw = get_redis().hgetall(self._key(task_id))
+        except Exception as e:
+            print(f"讀取任務進度失敗: {e}")
+            return None
+        if not raw:
+            return None
+        fields = {key.decode(): value.decode() for key, value in raw.items()}
+        stages = {}
+        for stage in STAGES:
+            if f'stage:{stage}' in fields:
+                stages[stage] = {'status': fields[f'stage:{stage}']}
+                if f'stage:{stage}:ms' in fields:
+                    stages[stage]['elapsed_ms'] = float(fields[f'stage:{stage}:ms'])
+        return {
+            'state': fields.get('state', 'PROGRESS'),
+            'stage': fields.get('stage', ''),
+            'progress': int(fields.get('progress', 0)),
+            'error': fields.get('error'),
+            'stored': fields.get('stored') == '1',
+            'stages': stages
+        }
+
+    def listen(self, task_id, timeout=300, heartbeat=15):
+        """
+        訂閱進度事件：先產生目前的進度，之後每次更新產生最新進度，閒置 heartbeat 秒產生 None；
+        完成、失敗或超過 timeout 秒即停止。
+        """
+        # 訂閱連線在整個等待期間都被佔用，使用獨立的連線池
+        pubsub = get_pubsub_redis().pubsub(ignore_subscribe_messages=True)
+        # 先訂閱再讀取目前進度，避免漏掉兩者之間發布的事件
+        pubsub.subscribe(self._channel(task_id))
+        try:
+            snapshot = self.get(task_id)
+            yield snapshot
+            deadline = time.monotonic() + timeout
+            idle_since = time.monotonic()
+            while not (snapshot and snapshot['state'] in FINISHED_STATES) and time.monotonic() < deadline:
+                if pubsub.get_message(timeout=1.0) is None:
+                    if time.monotonic() - idle_since >= heartbeat:
+                        idle_since = time.monotonic()
+                        yield None
+                    continue
+                snapshot = self.get(task_id)
+                idle_since = time.monotonic()
+                yield snapshot
+        finally:
+            pubsub.close()
@@ -0,0 +1,40 @@
+import os
+import redis
+
+# 每個進程各自的連線池（fork 後的子進程不可沿用父進程的連線）
+_clients = {}
+
+
+def _get_client(kind, url, max_connections):
+    url = url or os.getenv('REDIS_URL', 'redis://redis:6379/0')
+    key = (os.getpid(), kind, url)
+    client = _clients.get(key)
+    if client is None:
+        # 連線數用盡時等待歸還（最多 REDIS_POOL_TIMEOUT 秒），而不是立即拋出錯誤；
+        # gevent 下大量同時的請求因此共用固定數量的連線
+        pool = redis.BlockingConnectionPool.from_url(
+            url,
+            max_connections=max_connections,
+            timeout=float(os.getenv('REDIS_POOL_TIMEOUT', '5')),
+            socket_timeout=5,
+            socket_connect_timeout=2,
+            health_check_interval=30
+        )
+        client = redis.Redis(connection_pool=pool)
+        _clients[key] = client
+    return client
+
+
+def get_redis(url=None):
+    """取得當前進程共用連線池的 Redis 客戶端（短指令用，連線用完即歸還）"""
+    return _get_client('commands', url, int(os.getenv('REDIS_MAX_CONNECTIONS', '50')))
+
+
+def get_pubsub_redis(url=None):
+    """
+    訂閱專用的連線池：SSE 與 /status?wait= 在整個等待期間各佔用一條連線，
+    與短指令分開，長連線再多也不會讓一般查詢等不到連線。
+    上限預設與 gunicorn 每個 worker 的 worker_connections 相同
+    """
+    max_connections = os.getenv('REDIS_PUBSUB_MAX_CONNECTIONS') or os.getenv('WEB_WORKER_CONNECTIONS', '2000')
+    return _get_client('pubsub', url, int(max_connections))
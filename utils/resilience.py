@@ -0,0 +1,256 @@
+import os
+import random
+import re
+import threading
+import time
+from .redis_client import get_redis
+from .metrics import CIRCUIT_OPENED, UPSTREAM_RETRIES
+
+
+class UpstreamUnavailable(Exception):
+    """上游（Gemini/Vision）暫時不可用：熔斷中或配額等待過久，任務應稍後重新排入佇列"""
+
+    def __init__(self, upstream, message, retry_after=30):
+        super().__init__(f"{upstream} 暫時不可用: {message}")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+# 多個令牌桶一次檢查：全部足夠才同時扣除，否則回傳需要等待的毫秒數
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local state = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local rate = tonumber(ARGV[i * 3])
+    local cost = math.min(tonumber(ARGV[i * 3 + 1]), capacity)
+    local data = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or capacity
+    local ts = tonumber(data[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    if tokens < cost then
+        wait = math.max(wait, math.ceil((cost - tokens) / rate))
+    end
+    state[i] = {tokens, cost, math.ceil(capacity / rate)}
+end
+for i, key in ipairs(KEYS) do
+    local tokens = state[i][1]
+    if wait == 0 then
+        tokens = tokens - state[i][2]
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, state[i][3] + 1000)
+end
+return wait
+"""
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RETRYABLE_MESSAGE = re.compile(r'\b(?:429|500|502|503|504)\b|quota|rate limit|resource (?:has been )?exhausted|unavailable|deadline exceeded', re.IGNORECASE)
+
+
+def is_retryable(error):
+    """429 與 5xx、連線逾時等暫時性錯誤才值得重試"""
+    if isinstance(error, UpstreamUnavailable):
+        return False
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # google.api_core 的例外以 code 表示 HTTP 狀態碼；requests 的例外附帶 response
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+    return bool(RETRYABLE_MESSAGE.search(str(error)))
+
+
+class RateLimiter:
+    """所有 worker 共用的令牌桶（存於 Redis），依每分鐘請求數與每分鐘用量（tokens/圖片數）限流"""
+
+    def __init__(self, name, rpm=0, tpm=0, max_wait=None):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        # 等待超過 max_wait 就放棄，讓任務重新排隊而不是佔住 worker
+        self.max_wait = max_wait if max_wait is not None else float(os.getenv('RATE_LIMIT_MAX_WAIT', '30'))
+        self._script = None
+
+    @property
+    def enabled(self):
+        return self.rpm > 0 or self.tpm > 0
+
+    def _buckets(self, cost):
+        buckets = []
+        if self.rpm > 0:
+            buckets.append((f"ratelimit:{self.name}:requests", self.rpm, 1))
+        if self.tpm > 0:
+            buckets.append((f"ratelimit:{self.name}:tokens", self.tpm, max(1, int(cost))))
+        return buckets
+
+    def _try_acquire(self, cost):
+        """嘗試取得額度，回傳需要等待的秒數（0 表示已取得）"""
+        client = get_redis()
+        if self._script is None or self._script.registered_client is not client:
+            self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+        buckets = self._buckets(cost)
+        args = [int(time.time() * 1000)]
+        for _, limit, amount in buckets:
+            args.extend([limit, limit / 60000, amount])
+        return self._script(keys=[key for key, _, _ in buckets], args=args) / 1000
+
+    def acquire(self, cost=1):
+        """阻塞直到取得額度；預估等待超過 max_wait 時拋出 UpstreamUnavailable"""
+        if not self.enabled:
+            return
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            try:
+                wait = self._try_acquire(cost)
+            except Exception as e:
+                # Redis 不可用時不限流，由重試與熔斷保護上游
+                print(f"限流器不可用（{self.name}）: {e}")
+                return
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise UpstreamUnavailable(self.name, '超出配額', retry_after=max(1, int(wait)))
+            time.sleep(wait + random.uniform(0, 0.05))
+
+
+class CircuitBreaker:
+    """
+    所有 worker 共用的熔斷器：視窗內連續失敗達門檻即開路，期間直接失敗；
+    冷卻後只放行一個探測請求，成功才恢復。
+    """
+
+    def __init__(self, name, failure_threshold=None, reset_timeout=None, window=None):
+        self.name = name
+        self.failure_threshold = failure_threshold or int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+        self.reset_timeout = reset_timeout or int(os.getenv('CIRCUIT_RESET_TIMEOUT', '30'))
+        self.window = window or int(os.getenv('CIRCUIT_WINDOW', '60'))
+        self._prefix = f"circuit:{name}"
+
+    def _redis(self):
+        try:
+            return get_redis()
+        except Exception as e:
+            print(f"熔斷器不可用（{self.name}）: {e}")
+            return None
+
+    def before_call(self):
+        """開路中直接拋出 UpstreamUnavailable"""
+        client = self._redis()
+        if client is None:
+            return
+        try:
+            ttl = client.ttl(f"{self._prefix}:open")
+            if ttl and ttl > 0:
+                raise UpstreamUnavailable(self.name, '熔斷中', retry_after=ttl)
+            # 半開：冷卻結束後只讓一個請求探測上游
+            if client.exists(f"{self._prefix}:tripped"):
+                if not client.set(f"{self._prefix}:probe", 1, nx=True, ex=self.reset_timeout):
+                    raise UpstreamUnavailable(self.name, '等待探測結果', retry_after=self.reset_timeout)
+        except UpstreamUnavailable:
+            raise
+        except Exception as e:
+            print(f"讀取熔斷狀態失敗（{self.name}）: {e}")
+
+    def record_success(self):
+        client = self._redis()
+        if client is None:
+            return
+        try:
+            client.delete(f"{self._prefix}:failures", f"{self._prefix}:tripped", f"{self._prefix}:probe")
+        except Exception as e:
+            print(f"更新熔斷狀態失敗（{self.name}）: {e}")
+
+    def record_failure(self):
+        client = self._redis()
+        if client is None:
+            return
+        try:
+            if client.exists(f"{self._prefix}:tripped"):
+                # 探測失敗，重新開路
+                self._trip(client)
+                return
+            pipe = client.pipeline()
+            pipe.incr(f"{self._prefix}:failures")
+            pipe.expire(f"{self._prefix}:failures", self.window)
+            failures, _ = pipe.execute()
+            if failures >= self.failure_threshold:
+                self._trip(client)
+        except Exception as e:
+            print(f"更新熔斷狀態失敗（{self.name}）: {e}")
+
+    def _trip(self, client):
+        print(f"{self.name} 連續失敗，熔斷 {self.reset_timeout} 秒")
+        CIRCUIT_OPENED.labels(self.name).inc()
+        pipe = client.pipeline()
+        pipe.set(f"{self._prefix}:open", 1, ex=self.reset_timeout)
+        pipe.set(f"{self._prefix}:tripped", 1, ex=self.reset_timeout + self.window)
+        pipe.delete(f"{self._prefix}:failures", f"{self._prefix}:probe")
+        pipe.execute()
+
+
+class Upstream:
+    """包裝對上游的呼叫：先過熔斷器與限流器，429/5xx 以抖動的指數退避重試"""
+
+    def __init__(self, name, limiter=None, breaker=None, max_retries=None, base_delay=None, max_delay=None):
+        prefix = name.upper()
+        self.name = name
+        self.limiter = limiter or RateLimiter(
+            name,
+            rpm=int(os.getenv(f'{prefix}_RPM', '0')),
+            tpm=int(os.getenv(f'{prefix}_TPM', '0'))
+        )
+        self.breaker = breaker or CircuitBreaker(name)
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv(f'{prefix}_MAX_RETRIES', '3'))
+        self.base_delay = base_delay or float(os.getenv('RETRY_BASE_DELAY', '0.5'))
+        self.max_delay = max_delay or float(os.getenv('RETRY_MAX_DELAY', '20'))
+
+    def backoff(self, attempt):
+        """Full jitter：在 0 到指數上限之間隨機等待，避免所有 worker 同時重試"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def call(self, func, *args, cost=1, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.breaker.before_call()
+            self.limiter.acquire(cost)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    # 重試用盡仍是暫時性錯誤，交給任務稍後重新排隊
+                    raise UpstreamUnavailable(self.name, str(e), retry_after=self.breaker.reset_timeout) from e
+                delay = self.backoff(attempt)
+                UPSTREAM_RETRIES.labels(self.name).inc()
+                print(f"{self.name} 呼叫失敗（第 {attempt + 1} 次），{delay:.2f} 秒後重試: {e}")
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+
+_upstreams = {}
+_upstreams_lock = threading.Lock()
+
+
+def get_upstream(name):
+    """取得共用的上游包裝（設定來自 <NAME>_RPM、<NAME>_TPM、<NAME>_MAX_RETRIES）"""
+    upstream = _upstreams.get(name)
+    if upstream is None:
+        with _upstreams_lock:
+            upstream = _upstreams.get(name)
+            if upstream is None:
+                upstream = _upstreams[name] = Upstream(name)
+    return upstream
+
+
+def estimate_tokens(text):
+    """粗估提示的 token 數：中文約一字一 token，寧可高估"""
+    return max(1, len(text))
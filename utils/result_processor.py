@@ -1,9 +1,9 @@
-import requests
 from datetime import datetime
+from .webhook_delivery import WebhookDelivery
 
 class ResultProcessor:
-    def __init__(self):
-        pass
+    def __init__(self, delivery=None):
+        self.delivery = delivery or WebhookDelivery()
     
     def build_result(self, task_id, image_info, extraction_info, items, google_drive_url=None, file_name=None, mime_type=None):
         """構建結果字典"""
@@ -24,37 +24,60 @@ class ResultProcessor:
                     'height': image_info.get('height'),
                     'format': image_info.get('format')
                 },
+                'page_count': image_info.get('page_count', 1),
                 'extracted_text': extraction_info.get('text'),
                 'text_length': len(extraction_info.get('text', '')),
                 'items': items
             }
         }
     
+    def build_batch_result(self, batch):
+        """構建批次的彙總結果（依提交順序列出各成員）"""
+        members = []
+        for member in batch['members']:
+            summary = batch['results'].get(member['task_id'])
+            members.append({
+                'task_id': member['task_id'],
+                'file_name': member.get('file_name'),
+                'google_drive_url': member.get('google_drive_url'),
+                'state': summary['state'] if summary else 'PENDING',
+                'page_count': summary.get('page_count') if summary else None,
+                'items': summary.get('items', []) if summary else [],
+                'error': summary.get('error') if summary else None
+            })
+        succeeded = sum(1 for member in members if member['state'] == 'SUCCESS')
+        failed = sum(1 for member in members if member['state'] == 'FAILURE')
+        return {
+            'success': failed == 0,
+            'message': f'批次處理完成：成功 {succeeded} 筆，失敗 {failed} 筆',
+            'batch_id': batch['batch_id'],
+            'data': {
+                'total': batch['total'],
+                'succeeded': succeeded,
+                'failed': failed,
+                'finished_at': datetime.fromtimestamp(batch['finished_at']).isoformat() if batch.get('finished_at') else None,
+                'members': members
+            }
+        }
+    
     def send_webhook(self, webhook_url, data):
-        """發送webhook回調"""
+        """排入webhook回調佇列後立即返回，由投遞服務負責送出與重試"""
         if not webhook_url:
             return None
             
         try:
-            print(f"Sending callback to: {webhook_url}")
-            response = requests.post(
-                webhook_url,
-                json=data,
-                headers={'Content-Type': 'application/json'},
-                timeout=30
-            )
-            result = {
-                'sent': True,
-                'status_code': response.status_code,
+            delivery_id = self.delivery.enqueue(webhook_url, data, task_id=data.get('task_id') or data.get('batch_id'))
+            print(f"Callback queued: {delivery_id} -> {webhook_url}")
+            return {
+                'queued': True,
+                'delivery_id': delivery_id,
                 'url': webhook_url
             }
-            print(f"Callback sent successfully: {response.status_code}")
-            return result
         except Exception as e:
             error_result = {
-                'sent': False,
+                'queued': False,
                 'error': str(e),
                 'url': webhook_url
             }
-            print(f"Callback failed: {str(e)}")
-            return error_result
\ No newline at end of file
+            print(f"Callback enqueue failed: {str(e)}")
+            return error_result
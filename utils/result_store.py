@@ -0,0 +1,222 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+try:
+    import msgpack
+    import zstandard
+except ImportError:
+    msgpack = zstandard = None
+
+
+def _encode_msgpack_zstd(result, level):
+    return zstandard.ZstdCompressor(level=level).compress(msgpack.packb(result, use_bin_type=True))
+
+
+def _decode_msgpack_zstd(payload):
+    return msgpack.unpackb(zstandard.ZstdDecompressor().decompress(payload), raw=False)
+
+
+def _encode_json_zlib(result, level):
+    return zlib.compress(json.dumps(result, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), min(level, 9))
+
+
+def _decode_json_zlib(payload):
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+# 每筆紀錄保存自己的編碼方式，切換編碼或缺少套件時舊紀錄仍可讀取
+CODECS = {
+    'msgpack+zstd': (_encode_msgpack_zstd, _decode_msgpack_zstd),
+    'json+zlib': (_encode_json_zlib, _decode_json_zlib),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    task_id TEXT PRIMARY KEY,
+    file_id TEXT,
+    day TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    file_name TEXT,
+    google_drive_url TEXT,
+    mime_type TEXT,
+    webhook_url TEXT,
+    item_count INTEGER,
+    page_count INTEGER,
+    codec TEXT NOT NULL,
+    raw_size INTEGER,
+    payload BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_file_id ON results (file_id, created_at);
+CREATE INDEX IF NOT EXISTS results_day ON results (day, created_at);
+"""
+
+SUMMARY_COLUMNS = ('task_id', 'file_id', 'day', 'created_at', 'file_name', 'google_drive_url',
+                   'mime_type', 'item_count', 'page_count', 'codec', 'raw_size')
+
+
+class ResultStore:
+    """
+    完整處理結果的持久保存（uploads 目錄中的 SQLite，壓縮後的二進位紀錄），
+    以 task_id、Drive file_id 與日期查詢。Celery 結果後端只保存指標，
+    結果在 result_expires 之後仍可供修正表單與重新處理使用
+    """
+
+    def __init__(self, path=None, enabled=None, codec=None, level=None, retention_days=None):
+        self.path = path or os.getenv('RESULT_STORE_PATH', os.path.join('uploads', 'results.sqlite3'))
+        if enabled is None:
+            enabled = os.getenv('RESULT_STORE_ENABLED', '1') == '1'
+        self.enabled = enabled
+        codec = codec or os.getenv('RESULT_STORE_CODEC', 'msgpack+zstd')
+        if codec not in CODECS:
+            raise ValueError(f'不支援的結果編碼: {codec}')
+        if codec == 'msgpack+zstd' and msgpack is None:
+            print("未安裝 msgpack/zstandard，結果改以 json+zlib 保存")
+            codec = 'json+zlib'
+        self.codec = codec
+        self.level = level or int(os.getenv('RESULT_STORE_LEVEL', '6'))
+        self.retention_days = retention_days if retention_days is not None else int(os.getenv('RESULT_STORE_RETENTION_DAYS', '90'))
+        # 每個進程一個連線（sqlite 連線不能跨 fork 使用），以鎖序列化同進程內的存取
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            # WAL：多個 worker 寫入時，API 的讀取不必等待
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def put(self, result, job=None):
+        """保存一份完整結果，回傳寫入的位元組數；未啟用時回傳 None"""
+        if not self.enabled:
+            return None
+        job = job or {}
+        data = result.get('data') or {}
+        encode, _ = CODECS[self.codec]
+        payload = encode(result, self.level)
+        now = time.time()
+        row = (
+            result['task_id'],
+            job.get('file_id') or data.get('file_id'),
+            time.strftime('%Y-%m-%d', time.localtime(now)),
+            now,
+            job.get('file_name') or data.get('original_filename'),
+            job.get('google_drive_url') or data.get('google_drive_url'),
+            job.get('mime_type') or data.get('mime_type'),
+            job.get('webhook_url'),
+            len(data.get('items') or []),
+            data.get('page_count'),
+            self.codec,
+            len(json.dumps(result, ensure_ascii=False).encode('utf-8')),
+            payload
+        )
+        with self._lock:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row
+            )
+        self._maybe_purge(now)
+        return len(payload)
+
+    def get(self, task_id):
+        """回傳完整結果；沒有紀錄時回傳 None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT codec, payload FROM results WHERE task_id = ?', (task_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        _, decode = CODECS[row[0]]
+        return decode(row[1])
+
+    def contains(self, task_id):
+        if not self.enabled:
+            return False
+        with self._lock:
+            return self._connect().execute(
+                'SELECT 1 FROM results WHERE task_id = ?', (task_id,)
+            ).fetchone() is not None
+
+    def get_job(self, task_id):
+        """回傳重新處理所需的提交內容 {'google_drive_url', 'file_name', 'mime_type', 'webhook_url', 'file_id'}"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT google_drive_url, file_name, mime_type, webhook_url, file_id FROM results WHERE task_id = ?',
+                (task_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('google_drive_url', 'file_name', 'mime_type', 'webhook_url', 'file_id'), row))
+
+    def find(self, file_id=None, day=None, limit=100):
+        """依 Drive file_id 及/或日期（YYYY-MM-DD）列出結果摘要，新的在前"""
+        if not self.enabled:
+            return []
+        clauses, params = [], []
+        if file_id:
+            clauses.append('file_id = ?')
+            params.append(file_id)
+        if day:
+            clauses.append('day = ?')
+            params.append(day)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT {', '.join(SUMMARY_COLUMNS)} FROM results {where} ORDER BY created_at DESC LIMIT ?",
+                params + [limit]
+            ).fetchall()
+        return [dict(zip(SUMMARY_COLUMNS, row)) for row in rows]
+
+    def pointer(self, result):
+        """存放在 Celery 結果後端的精簡指標（完整內容由 get 讀取）"""
+        data = result.get('data') or {}
+        return {
+            'success': result.get('success', True),
+            'task_id': result['task_id'],
+            'result_store': True,
+            'item_count': len(data.get('items') or []),
+            'page_count': data.get('page_count')
+        }
+
+    @staticmethod
+    def is_pointer(result):
+        return isinstance(result, dict) and result.get('result_store') is True
+
+    def purge(self, older_than_days=None):
+        """刪除超過保存天數的結果，回傳刪除筆數"""
+        days = self.retention_days if older_than_days is None else older_than_days
+        if not self.enabled or days <= 0:
+            return 0
+        with self._lock:
+            cursor = self._connect().execute(
+                'DELETE FROM results WHERE created_at < ?', (time.time() - days * 24 * 3600,)
+            )
+        return cursor.rowcount
+
+    def _maybe_purge(self, now):
+        # 每個進程每小時最多清理一次
+        if now - self._last_purge < 3600:
+            return
+        self._last_purge = now
+        try:
+            removed = self.purge()
+            if removed:
+                print(f"已清除 {removed} 筆超過 {self.retention_days} 天的結果")
+        except sqlite3.Error as e:
+            print(f"清除過期結果失敗: {e}")
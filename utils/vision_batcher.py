@@ -0,0 +1,176 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from .metrics import VISION_IMAGES, VISION_REQUESTS, span
+
+# Vision 同步 batch_annotate_images 每次最多 16 張圖片，請求大小上限約 40MB（base64 後）
+MAX_IMAGES_PER_REQUEST = 16
+MAX_REQUEST_BYTES = 30 * 1024 * 1024
+
+FEATURES = {
+    'text_detection': 'TEXT_DETECTION',
+    'document_text_detection': 'DOCUMENT_TEXT_DETECTION',
+}
+
+
+def feature_type(feature):
+    """轉換成 Vision 的 Feature.Type；未安裝 google-cloud-vision 時使用字串（供假客戶端）"""
+    if feature not in FEATURES:
+        raise ValueError(f'不支援的 OCR 功能: {feature}')
+    try:
+        from google.cloud import vision
+        return vision.Feature.Type[FEATURES[feature]]
+    except ImportError:
+        return FEATURES[feature]
+
+
+def response_text(response, feature):
+    """從單張圖片的回應取出文字"""
+    if response.error.message:
+        raise Exception(response.error.message)
+    if feature == 'document_text_detection':
+        return response.full_text_annotation.text.strip()
+    texts = response.text_annotations
+    return texts[0].description.strip() if texts else ""
+
+
+class VisionBatcher:
+    """將多張圖片合併成 batch_annotate_images 請求，並把結果分送回各呼叫者"""
+
+    def __init__(self, client, feature='text_detection', max_batch=None, linger_ms=None, max_request_bytes=MAX_REQUEST_BYTES, upstream=None):
+        self.client = client
+        # 限流、重試與熔斷（未指定時直接呼叫）
+        self.upstream = upstream
+        self.feature = feature
+        self._feature_type = feature_type(feature)
+        self.max_batch = min(max_batch or int(os.getenv('OCR_BATCH_SIZE', str(MAX_IMAGES_PER_REQUEST))), MAX_IMAGES_PER_REQUEST)
+        # 等待視窗只有在同一進程同時處理多張圖片（執行緒/gevent 池）時才有用；prefork 下只會增加延遲，預設關閉
+        self.linger = (linger_ms if linger_ms is not None else float(os.getenv('OCR_BATCH_LINGER_MS', '0'))) / 1000
+        # 等待批次結果的上限，背景執行緒出錯時呼叫者不會永遠卡住
+        self.result_timeout = float(os.getenv('OCR_BATCH_RESULT_TIMEOUT', '180'))
+        self.max_request_bytes = max_request_bytes
+        self.stats = {'requests': 0, 'images': 0}
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_pid = None
+        self._lock = threading.Lock()
+
+    def _build_request(self, content):
+        return {'image': {'content': content}, 'features': [{'type_': self._feature_type}]}
+
+    def _chunks(self, contents):
+        """依張數與位元組上限切分請求"""
+        chunk, size = [], 0
+        for content in contents:
+            if chunk and (len(chunk) >= self.max_batch or size + len(content) > self.max_request_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(content)
+            size += len(content)
+        if chunk:
+            yield chunk
+
+    def _execute(self, contents):
+        """送出一個批次請求，回傳與 contents 對應的回應列表"""
+        requests = [self._build_request(content) for content in contents]
+        with span('vision'):
+            if self.upstream is None:
+                response = self.client.batch_annotate_images(requests=requests)
+            else:
+                # Vision 配額以圖片數計算
+                response = self.upstream.call(self.client.batch_annotate_images, requests=requests, cost=len(contents))
+        VISION_REQUESTS.inc()
+        VISION_IMAGES.inc(len(contents))
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['images'] += len(contents)
+        return list(response.responses)
+
+    @staticmethod
+    def _count_error(sent, received):
+        return Exception(f'Vision 回應數量不符：送出 {sent} 張圖片，只收到 {received} 個回應')
+
+    def annotate_many(self, contents):
+        """同步辨識多張圖片（例如同一份 PDF 的多頁），回傳文字列表"""
+        texts = []
+        for chunk in self._chunks(contents):
+            responses = self._execute(chunk)
+            if len(responses) != len(chunk):
+                raise self._count_error(len(chunk), len(responses))
+            for response in responses:
+                texts.append(response_text(response, self.feature))
+        return texts
+
+    def submit(self, content):
+        """送入等待視窗，與其他同時送入的圖片合併成同一個請求"""
+        future = Future()
+        if self.linger <= 0:
+            try:
+                future.set_result(self.annotate_many([content])[0])
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self._ensure_worker()
+        self._queue.put((content, future))
+        return future
+
+    def annotate(self, content):
+        """辨識單張圖片"""
+        try:
+            return self.submit(content).result(timeout=self.result_timeout)
+        except FutureTimeoutError:
+            raise Exception(f'等待 Vision 批次結果超過 {self.result_timeout:.0f} 秒')
+
+    def _ensure_worker(self):
+        # fork 後的子進程需要自己的背景執行緒與佇列
+        pid = os.getpid()
+        if self._worker is not None and self._worker_pid == pid and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is not None and self._worker_pid == pid and self._worker.is_alive():
+                return
+            if self._worker_pid != pid:
+                self._queue = queue.Queue()
+            self._worker = threading.Thread(target=self._run, name='vision-batcher', daemon=True)
+            self._worker_pid = pid
+            self._worker.start()
+
+    def _collect(self):
+        """阻塞取得第一張圖片，再於等待視窗內收集更多圖片"""
+        batch = [self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if size + len(item[0]) > self.max_request_bytes:
+                self._queue.put(item)
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                responses = self._execute([content for content, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), response in zip(batch, responses):
+                try:
+                    future.set_result(response_text(response, self.feature))
+                except Exception as e:
+                    future.set_exception(e)
+            # 回應比圖片少時，沒有對應回應的呼叫者直接失敗，而不是永遠等待
+            for _, future in batch[len(responses):]:
+                future.set_exception(self._count_error(len(batch), len(responses)))
@@ -0,0 +1,211 @@
+import gzip
+import json
+import os
+import random
+import time
+import uuid
+import zlib
+import requests
+from requests.adapters import HTTPAdapter
+from .redis_client import get_redis
+from .metrics import WEBHOOK_ATTEMPTS, span
+
+# 2xx 以外視為成功的狀態碼：n8n 的 webhook 已被使用過時回 409，內容其實已送達
+DELIVERED_STATUS = {409}
+# 4xx 中值得重試的狀態碼，其他 4xx 直接進入死信
+RETRYABLE_CLIENT_STATUS = {408, 425, 429}
+
+# 每個進程共用一個 Session（fork 後重新建立）
+_sessions = {}
+
+
+def get_session():
+    """取得當前進程共用、保持連線的 Session（重試由投遞紀錄控制，不在連線層重試）"""
+    pid = os.getpid()
+    session = _sessions.get(pid)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=int(os.getenv('WEBHOOK_POOL_SIZE', '20')), max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _sessions[pid] = session
+    return session
+
+
+def compact_payload(payload):
+    """精簡版內容：省略 extracted_text 等大型欄位"""
+    payload = dict(payload)
+    if isinstance(payload.get('data'), dict):
+        payload['data'] = {key: value for key, value in payload['data'].items() if key not in ('extracted_text', 'preprocess')}
+    return payload
+
+
+class WebhookDelivery:
+    """
+    對外 webhook 的投遞服務：內容先寫入 Redis 的投遞紀錄再排入佇列，
+    由 deliver 以共用連線池送出，失敗時以指數退避重試，超過次數移入死信列表供重送。
+    """
+
+    def __init__(self, dispatch=None, max_attempts=None, timeout=None, compact=None, use_gzip=None):
+        # dispatch(delivery_id, countdown) 把投遞排入佇列；未設定時在呼叫端直接送出
+        self.dispatch = dispatch
+        self.max_attempts = max_attempts or int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '8'))
+        self.timeout = timeout or float(os.getenv('WEBHOOK_TIMEOUT', '30'))
+        self.compact = os.getenv('WEBHOOK_COMPACT', '0') == '1' if compact is None else compact
+        self.use_gzip = os.getenv('WEBHOOK_GZIP', '0') == '1' if use_gzip is None else use_gzip
+        self.backoff_base = float(os.getenv('WEBHOOK_BACKOFF_BASE', '2'))
+        self.backoff_max = float(os.getenv('WEBHOOK_BACKOFF_MAX', '600'))
+        self.record_ttl = int(os.getenv('WEBHOOK_RECORD_TTL', str(7 * 24 * 3600)))
+        self.dead_max = int(os.getenv('WEBHOOK_DEAD_MAX', '1000'))
+
+    def _key(self, delivery_id):
+        return f"webhook:delivery:{delivery_id}"
+
+    def enqueue(self, url, payload, task_id=None, compact=None, use_gzip=None):
+        """保存投遞紀錄並排入佇列，立即回傳 delivery_id"""
+        compact = self.compact if compact is None else compact
+        use_gzip = self.use_gzip if use_gzip is None else use_gzip
+        if compact:
+            payload = compact_payload(payload)
+        delivery_id = uuid.uuid4().hex
+        record = {
+            'url': url,
+            'payload': zlib.compress(json.dumps(payload, ensure_ascii=False).encode('utf-8')),
+            'task_id': task_id or '',
+            'gzip': int(bool(use_gzip)),
+            'status': 'pending',
+            'attempts': 0,
+            'created_at': time.time()
+        }
+        client = get_redis()
+        pipe = client.pipeline()
+        pipe.hset(self._key(delivery_id), mapping=record)
+        pipe.expire(self._key(delivery_id), self.record_ttl)
+        pipe.execute()
+        self._dispatch(delivery_id)
+        return delivery_id
+
+    def _dispatch(self, delivery_id, countdown=0):
+        if self.dispatch is None:
+            outcome = self.deliver(delivery_id)
+            if outcome.get('retry_in') is not None:
+                print(f"Webhook 投遞失敗，未設定佇列，不再自動重試: {delivery_id}")
+            return
+        self.dispatch(delivery_id, countdown)
+
+    def get(self, delivery_id, include_payload=False):
+        """讀取投遞紀錄"""
+        raw = get_redis().hgetall(self._key(delivery_id))
+        if not raw:
+            return None
+        fields = {key.decode(): value for key, value in raw.items()}
+        record = {
+            'delivery_id': delivery_id,
+            'url': fields['url'].decode(),
+            'task_id': fields.get('task_id', b'').decode() or None,
+            'gzip': fields.get('gzip') == b'1',
+            'status': fields['status'].decode(),
+            'attempts': int(fields.get('attempts', 0)),
+            'created_at': float(fields['created_at']),
+            'last_status_code': int(fields['last_status_code']) if fields.get('last_status_code') else None,
+            'last_error': fields['last_error'].decode() if fields.get('last_error') else None
+        }
+        if include_payload:
+            record['payload'] = json.loads(zlib.decompress(fields['payload']))
+        return record
+
+    def backoff(self, attempts):
+        """第 n 次失敗後的等待秒數（含抖動）"""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.5)
+
+    def deliver(self, delivery_id):
+        """
+        送出一次，回傳 {'delivered', 'status_code', 'retry_in'}；
+        retry_in 不為 None 時呼叫端應在該秒數後再次投遞。
+        """
+        client = get_redis()
+        key = self._key(delivery_id)
+        raw = client.hmget(key, 'url', 'payload', 'gzip', 'status')
+        if raw[0] is None:
+            print(f"找不到 webhook 投遞紀錄: {delivery_id}")
+            return {'delivered': False, 'status_code': None, 'retry_in': None}
+        url, payload, use_gzip, status = raw[0].decode(), raw[1], raw[2] == b'1', raw[3].decode()
+        if status == 'delivered':
+            return {'delivered': True, 'status_code': None, 'retry_in': None}
+
+        body = zlib.decompress(payload)
+        headers = {'Content-Type': 'application/json'}
+        if use_gzip:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        attempts = client.hincrby(key, 'attempts', 1)
+        status_code = None
+        try:
+            print(f"Sending callback to: {url}")
+            with span('webhook'):
+                response = get_session().post(url, data=body, headers=headers, timeout=(5, self.timeout))
+            status_code = response.status_code
+            response.close()
+            if 200 <= status_code < 300 or status_code in DELIVERED_STATUS:
+                client.hset(key, mapping={'status': 'delivered', 'last_status_code': status_code, 'delivered_at': time.time()})
+                WEBHOOK_ATTEMPTS.labels('delivered').inc()
+                print(f"Callback sent successfully: {status_code}")
+                return {'delivered': True, 'status_code': status_code, 'retry_in': None}
+            error = f"HTTP {status_code}"
+            retryable = status_code >= 500 or status_code in RETRYABLE_CLIENT_STATUS
+        except requests.RequestException as e:
+            error = str(e)
+            retryable = True
+
+        print(f"Callback failed ({attempts}/{self.max_attempts}): {error}")
+        fields = {'last_error': error}
+        if status_code is not None:
+            fields['last_status_code'] = status_code
+        if retryable and attempts < self.max_attempts:
+            fields['status'] = 'retrying'
+            client.hset(key, mapping=fields)
+            WEBHOOK_ATTEMPTS.labels('retry').inc()
+            return {'delivered': False, 'status_code': status_code, 'retry_in': self.backoff(attempts)}
+
+        fields['status'] = 'dead'
+        WEBHOOK_ATTEMPTS.labels('dead').inc()
+        pipe = client.pipeline()
+        pipe.hset(key, mapping=fields)
+        pipe.lrem('webhook:dead', 0, delivery_id)
+        pipe.lpush('webhook:dead', delivery_id)
+        pipe.ltrim('webhook:dead', 0, self.dead_max - 1)
+        pipe.execute()
+        return {'delivered': False, 'status_code': status_code, 'retry_in': None}
+
+    def dead_letters(self, limit=100):
+        """列出死信（最新的在前）"""
+        records = []
+        for delivery_id in get_redis().lrange('webhook:dead', 0, limit - 1):
+            record = self.get(delivery_id.decode())
+            if record is not None:
+                records.append(record)
+        return records
+
+    def replay(self, delivery_id):
+        """重送一筆投遞（重設次數），回傳是否找到紀錄"""
+        client = get_redis()
+        key = self._key(delivery_id)
+        if not client.exists(key):
+            return False
+        pipe = client.pipeline()
+        pipe.hset(key, mapping={'status': 'pending', 'attempts': 0})
+        pipe.expire(key, self.record_ttl)
+        pipe.lrem('webhook:dead', 0, delivery_id)
+        pipe.execute()
+        self._dispatch(delivery_id)
+        return True
+
+    def replay_dead(self, limit=100):
+        """重送死信列表中的投遞，回傳重送的 delivery_id"""
+        replayed = []
+        for delivery_id in get_redis().lrange('webhook:dead', 0, limit - 1):
+            if self.replay(delivery_id.decode()):
+                replayed.append(delivery_id.decode())
+        return replayed
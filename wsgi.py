@@ -0,0 +1,13 @@
+"""gunicorn 的進入點：gunicorn -c gunicorn.conf.py wsgi:app"""
+import importlib
+
+try:
+    from gevent import monkey
+    if monkey.is_module_patched('socket'):
+        # gevent worker 已替換 socket；gRPC（Vision 客戶端）也需改用 gevent 的事件迴圈，否則會卡住整個 worker
+        import grpc.experimental.gevent as grpc_gevent
+        grpc_gevent.init_gevent()
+except ImportError:
+    pass
+
+app = importlib.import_module('n8n-ocr-flow').app